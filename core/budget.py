@@ -0,0 +1,250 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - resource budgets
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import multiprocessing as mp
+import time
+import logging
+log = logging.getLogger("repo")
+
+from . import utils
+
+
+# how long does a failed reservation count as waiting for fair sharing (in seconds)
+# -> owners waiting without blocking retry at least this often
+WAITING_TIMEOUT = 3
+
+
+class ResourceBudget(object):
+    """A budget for a limited resource (RAM, disk space, etc.)
+    shared by all the worker processes of a repository update
+
+    Work units reserve their estimated resource usage before they start
+    and release it once they are done. A reservation that does not fit
+    into the budget blocks until enough of the budget is released.
+    As every waiter re-checks the budget once something is released,
+    small work units can backfill around a large one that still waits
+    for enough of the budget to be free.
+
+    The budget can be shared by several owners (repositories updated
+    at once). An owner then yields to any other waiting owner that holds
+    less of the budget, so that every owner gets a fair share
+    of the budget while they compete for it.
+
+    NOTE: the budget uses multiprocessing primitives, so it needs to be created
+    before the worker processes are started & is shared with them through
+    inheritance - it can't be sent to other processes through a queue
+    """
+
+    def __init__(self, name, capacity=None, unit_formatter=None, owners=None):
+        """
+        :param str name: name of the budget used in log messages
+        :param capacity: budget capacity, None means unlimited
+        :param unit_formatter: function for pretty printing budget amounts
+        :param owners: list of owner names for fair sharing
+        """
+        self._name = name
+        self._capacity = capacity
+        if unit_formatter is None:
+            unit_formatter = str
+        self._format = unit_formatter
+        self._used = mp.Value('L', 0, lock=False)
+        self._condition = mp.Condition()
+        self._owners = list(owners or [])
+        # how much of the budget each owner holds
+        self._owner_used = mp.Array('L', max(1, len(self._owners)), lock=False)
+        # when did each owner last fail to get a reservation
+        self._owner_waiting = mp.Array('d', max(1, len(self._owners)), lock=False)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def capacity(self):
+        """return budget capacity or None if the budget is unlimited"""
+        return self._capacity
+
+    @property
+    def used(self):
+        """return how much of the budget is currently reserved"""
+        with self._condition:
+            return self._used.value
+
+    @property
+    def enabled(self):
+        return self._capacity is not None
+
+    def for_owner(self, owner):
+        """return a view of the budget for one of its owners"""
+        return OwnerBudget(self, owner)
+
+    def reserve(self, amount, block=True, label=None, owner=None):
+        """reserve the given amount of the budget
+
+        If the amount is larger than the whole budget it is clamped
+        to the budget capacity, so that the work unit can still run once
+        it has the whole budget for itself.
+
+        :param int amount: amount to reserve
+        :param bool block: wait until the reservation fits into the budget
+        :param str label: what is the reservation for (for logging)
+        :param str owner: who makes the reservation (one of the budget owners)
+        :returns: the amount actually reserved (which needs to be released later)
+                  or None if block is False and the reservation does not fit
+        """
+        if not self.enabled:
+            return 0
+        amount = min(int(amount), self._capacity)
+        index = self._owner_index(owner)
+        with self._condition:
+            if not self._fits(amount, index):
+                if index is not None:
+                    self._owner_waiting[index] = time.time()
+                if not block:
+                    return None
+                log.info("%s budget: %s waiting for %s (%s of %s reserved)",
+                         self._name, label, self._format(amount),
+                         self._format(self._used.value), self._format(self._capacity))
+                while not self._fits(amount, index):
+                    if index is None:
+                        self._condition.wait()
+                    else:
+                        # keep the owner marked as waiting
+                        self._owner_waiting[index] = time.time()
+                        self._condition.wait(1)
+            self._used.value += amount
+            if index is not None:
+                self._owner_used[index] += amount
+                self._owner_waiting[index] = 0
+            return amount
+
+    def release(self, amount, owner=None):
+        """release a previously reserved amount of the budget"""
+        if not self.enabled or not amount:
+            return
+        index = self._owner_index(owner)
+        with self._condition:
+            self._used.value = max(0, self._used.value - int(amount))
+            if index is not None:
+                self._owner_used[index] = max(0, self._owner_used[index] - int(amount))
+            # wake up everyone, smaller reservations might fit
+            # even if the biggest waiting one still does not
+            self._condition.notify_all()
+
+    def _owner_index(self, owner):
+        if owner is None or owner not in self._owners:
+            return None
+        return self._owners.index(owner)
+
+    def _fits(self, amount, index=None):
+        if self._used.value + amount > self._capacity:
+            return False
+        if index is not None:
+            # yield to waiting owners holding less of the budget,
+            # ties are broken by owner order
+            now = time.time()
+            used = self._owner_used[index]
+            for other in range(len(self._owners)):
+                if other == index or now - self._owner_waiting[other] > WAITING_TIMEOUT:
+                    continue
+                other_used = self._owner_used[other]
+                if other_used < used or (other_used == used and other < index):
+                    return False
+        return True
+
+
+class OwnerBudget(object):
+    """A view of a shared budget for one of its owners"""
+
+    def __init__(self, budget, owner):
+        self._budget = budget
+        self._owner = owner
+
+    @property
+    def name(self):
+        return self._budget.name
+
+    @property
+    def capacity(self):
+        return self._budget.capacity
+
+    @property
+    def used(self):
+        return self._budget.used
+
+    @property
+    def enabled(self):
+        return self._budget.enabled
+
+    def reserve(self, amount, block=True, label=None):
+        return self._budget.reserve(amount, block=block, label=label, owner=self._owner)
+
+    def release(self, amount):
+        self._budget.release(amount, owner=self._owner)
+
+
+def memory_budget(capacity_mb, owners=None):
+    """return a RAM budget, capacity is in megabytes (None = unlimited)"""
+    if capacity_mb is None:
+        capacity = None
+    else:
+        capacity = capacity_mb * 2 ** 20
+    return ResourceBudget("memory", capacity, utils.bytes2PrettyUnitString, owners)
+
+
+def disk_budget(capacity_mb, owners=None):
+    """return a disk space budget, capacity is in megabytes (None = unlimited)"""
+    if capacity_mb is None:
+        capacity = None
+    else:
+        capacity = capacity_mb * 2 ** 20
+    return ResourceBudget("disk", capacity, utils.bytes2PrettyUnitString, owners)
+
+
+def scratch_budget(capacity_mb, owners=None):
+    """return a budget of the RAM backed scratch tier, capacity is in megabytes
+    (None = no scratch tier)"""
+    if capacity_mb is None:
+        capacity = None
+    else:
+        capacity = capacity_mb * 2 ** 20
+    return ResourceBudget("scratch", capacity, utils.bytes2PrettyUnitString, owners)
+
+
+def processing_budget(slots, owners=None):
+    """return a budget of processing slots (how many processing tasks can run at once)"""
+    return ResourceBudget("processing", slots, owners=owners)
+
+
+class Budgets(object):
+    """Budgets shared by all repositories updated at once"""
+
+    def __init__(self, memory, disk, processing, placement=None, memory_cgroup=None, scratch=None):
+        self.memory = memory
+        self.disk = disk
+        self.processing = processing
+        # CPU placement of processing runs, None = placement disabled
+        self.placement = placement
+        # cgroup v2 group the memory ceilings of processing runs are created in,
+        # None = no cgroup v2 delegation (RLIMIT_AS is used) or ceilings disabled
+        self.memory_cgroup = memory_cgroup
+        # space on the RAM backed scratch tier, None = no scratch tier
+        self.scratch = scratch
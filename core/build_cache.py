@@ -0,0 +1,279 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - build cache
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import os
+import json
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+log = logging.getLogger("repo")
+
+from . import utils
+
+ENTRY_SUFFIX = ".entry"
+FOLDER_ENTRY_SUFFIX = ".folder"
+INFO_SUFFIX = ".info"
+LOCK_FILENAME = "cache.lock"
+
+
+def cache_key(*parts):
+    """return a cache key for the given build inputs
+    -> all parts need to be strings (hashes, names, etc.),
+    None in any of the parts means the inputs are not known well
+    enough for caching and None is returned"""
+    if None in parts:
+        return None
+    return hashlib.sha1("\0".join(parts)).hexdigest()
+
+
+class BuildCache(object):
+    """Content addressed cache of build results
+
+    Results are stored under a key computed from all the inputs that
+    influence them (source data hash, settings hash, tool hash, etc.),
+    so a cached result can be used whenever the inputs are the same.
+    Least recently used results are evicted once the cache grows over
+    its size limit.
+
+    The cache is shared by all the processes of a repository update,
+    changes of the cache content are done under an exclusive lock.
+    """
+
+    # cache name for logging
+    label = "build cache"
+
+    def __init__(self, path, max_size=None):
+        """
+        :param str path: cache folder
+        :param max_size: cache size limit in bytes, None = unlimited
+        """
+        self._path = path
+        self._max_size = max_size
+        utils.createFolderPath(self._path)
+
+    @property
+    def path(self):
+        return self._path
+
+    def _entry_path(self, key):
+        # split the entries to sub-folders, so that the
+        # cache folder does not get too large
+        return os.path.join(self._path, key[:2], key + ENTRY_SUFFIX)
+
+    def get(self, key, target_path):
+        """copy the cached result for key to target_path
+
+        :returns: True on cache hit, False otherwise
+        """
+        if key is None:
+            return False
+        entry = self._entry_path(key)
+        lock = self._lock()
+        try:
+            if not os.path.isfile(entry):
+                return False
+            # mark the entry as recently used
+            os.utime(entry, None)
+            shutil.copyfile(entry, target_path)
+            return True
+        except Exception:
+            log.exception("%s: getting %s failed", self.label, key)
+            return False
+        finally:
+            self._unlock(lock)
+
+    def put(self, key, source_path):
+        """store a copy of the file in source_path under key
+        and evict old entries if the cache is over its size limit"""
+        if key is None:
+            return
+        entry = self._entry_path(key)
+        lock = self._lock()
+        try:
+            utils.createFolderPath(os.path.dirname(entry))
+            temp_entry = entry + ".tmp"
+            shutil.copyfile(source_path, temp_entry)
+            os.rename(temp_entry, entry)
+            self._evict()
+        except Exception:
+            log.exception("%s: storing %s failed", self.label, key)
+        finally:
+            self._unlock(lock)
+
+    def _evict(self):
+        """remove least recently used entries until the
+        cache fits into its size limit"""
+        if self._max_size is None:
+            return
+        entries = self._list_entries()
+        total_size = sum([size for mtime, size, path in entries])
+        entries.sort()
+        while entries and total_size > self._max_size:
+            mtime, size, path = entries.pop(0)
+            self._remove_entry(path)
+            total_size -= size
+            log.info("%s: evicted %s (%s)", self.label, os.path.basename(path),
+                     utils.bytes2PrettyUnitString(size))
+
+    def _list_entries(self):
+        """return a list of (last use time, size, path) tuples for all entries"""
+        entries = []
+        for root, dirs, files in os.walk(self._path):
+            for f in files:
+                if f.endswith(ENTRY_SUFFIX):
+                    path = os.path.join(root, f)
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _remove_entry(self, path):
+        os.remove(path)
+
+    @property
+    def size(self):
+        """size of all the entries in bytes"""
+        lock = self._lock()
+        try:
+            return sum([size for mtime, size, path in self._list_entries()])
+        finally:
+            self._unlock(lock)
+
+    def _lock(self):
+        lock = open(os.path.join(self._path, LOCK_FILENAME), "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _unlock(self, lock):
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+
+def _link_tree(source_path, target_path):
+    """hard link all files from source_path to target_path,
+    files are copied if they are on another filesystem"""
+    for root, dirs, files in os.walk(source_path):
+        target_root = os.path.normpath(os.path.join(target_path, os.path.relpath(root, source_path)))
+        utils.createFolderPath(target_root)
+        for f in files:
+            source_file = os.path.join(root, f)
+            target_file = os.path.join(target_root, f)
+            try:
+                os.link(source_file, target_file)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.copy2(source_file, target_file)
+
+
+def _tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+
+class FolderCache(BuildCache):
+    """Content addressed cache of intermediate build folders
+
+    Works like the build cache, but an entry is a whole folder
+    (for example importer output reused by later build steps).
+    Files are hard linked in & out of the cache, so a cached folder
+    takes space only once, no matter how many builds use it at once.
+    NOTE: users of the folder must not modify the linked files in place
+    (removing them is fine)
+
+    Every entry can carry a small info dictionary (how long it took
+    to build, etc.) stored next to it.
+    """
+
+    label = "folder cache"
+
+    def _entry_path(self, key):
+        return os.path.join(self._path, key[:2], key + FOLDER_ENTRY_SUFFIX)
+
+    def get(self, key, target_path):
+        """link the cached folder for key to target_path
+
+        :returns: info dictionary of the entry on cache hit, None otherwise
+        """
+        if key is None:
+            return None
+        entry = self._entry_path(key)
+        lock = self._lock()
+        try:
+            if not os.path.isdir(entry):
+                return None
+            os.utime(entry, None)
+            _link_tree(entry, target_path)
+            return self._read_info(entry)
+        except Exception:
+            log.exception("%s: getting %s failed", self.label, key)
+            return None
+        finally:
+            self._unlock(lock)
+
+    def put(self, key, source_path, info=None):
+        """store files of the folder in source_path under key
+        and evict old entries if the cache is over its size limit"""
+        if key is None:
+            return
+        entry = self._entry_path(key)
+        lock = self._lock()
+        try:
+            temp_entry = entry + ".tmp"
+            for path in (temp_entry, entry):
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+            _link_tree(source_path, temp_entry)
+            with open(entry + INFO_SUFFIX, "w") as f:
+                json.dump(info or {}, f)
+            os.rename(temp_entry, entry)
+            self._evict()
+        except Exception:
+            log.exception("%s: storing %s failed", self.label, key)
+        finally:
+            self._unlock(lock)
+
+    def _read_info(self, entry):
+        try:
+            with open(entry + INFO_SUFFIX, "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _list_entries(self):
+        entries = []
+        for root, dirs, files in os.walk(self._path):
+            for d in list(dirs):
+                if d.endswith(FOLDER_ENTRY_SUFFIX):
+                    # don't walk the entry content
+                    dirs.remove(d)
+                    path = os.path.join(root, d)
+                    entries.append((os.stat(path).st_mtime, _tree_size(path), path))
+        return entries
+
+    def _remove_entry(self, path):
+        shutil.rmtree(path)
+        if os.path.exists(path + INFO_SUFFIX):
+            os.remove(path + INFO_SUFFIX)
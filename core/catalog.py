@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - source data catalog
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import csv
+import urlparse
+
+from . import utils
+
+# Geofabrik used to serve the extracts with this path prefix
+LEGACY_PATH_PREFIX = "openstreetmap"
+
+
+class Duplicate(object):
+    """A source dropped from the catalog as another source
+    results in a package with the same repository sub-path"""
+
+    def __init__(self, repo_sub_path, url, kept_url):
+        self.repo_sub_path = repo_sub_path
+        self.url = url
+        self.kept_url = kept_url
+
+
+def load_url_catalog(csv_path):
+    """return a list of URLs from the first column of a CSV file"""
+    urls = []
+    f = open(csv_path, "r")
+    try:
+        for row in csv.reader(f):
+            if len(row) > 0:
+                urls.append(row[0])
+    finally:
+        f.close()
+    return urls
+
+
+def load_url_priorities(csv_path):
+    """return a URL -> priority class dictionary from the optional
+    second column of a CSV file, higher priority is more urgent"""
+    priorities = {}
+    f = open(csv_path, "r")
+    try:
+        for row in csv.reader(f):
+            if len(row) > 1 and row[1].strip():
+                try:
+                    priorities[row[0]] = int(row[1])
+                except ValueError:
+                    pass
+    finally:
+        f.close()
+    return priorities
+
+
+def is_legacy_url(url):
+    """report if the URL uses the legacy Geofabrik path prefix"""
+    components = utils.path2components(urlparse.urlparse(url)[2])
+    return bool(components) and components[0] == LEGACY_PATH_PREFIX
+
+
+def deduplicate_urls(urls, url_type):
+    """canonicalize URLs to the repository sub-path of the resulting package
+    and keep only one URL for every sub-path
+
+    If more URLs map to the same sub-path, the first URL not using the legacy
+    path prefix is kept (or just the first URL if all of them are legacy).
+
+    :returns: a (unique_urls, duplicates) tuple, unique URLs are in catalog order
+              and duplicates is a list of Duplicate instances
+    """
+    candidates = {}
+    order = []
+    for url in urls:
+        repo_sub_path = utils.url2repoPathFilenameName(url, url_type)[0]
+        if repo_sub_path not in candidates:
+            candidates[repo_sub_path] = []
+            order.append(repo_sub_path)
+        candidates[repo_sub_path].append(url)
+
+    unique_urls = []
+    duplicates = []
+    for repo_sub_path in order:
+        urls_for_path = candidates[repo_sub_path]
+        current = [url for url in urls_for_path if not is_legacy_url(url)]
+        if current:
+            kept_url = current[0]
+        else:
+            kept_url = urls_for_path[0]
+        unique_urls.append(kept_url)
+        for url in urls_for_path:
+            if url != kept_url:
+                duplicates.append(Duplicate(repo_sub_path, url, kept_url))
+    return unique_urls, duplicates
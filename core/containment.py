@@ -0,0 +1,225 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - memory containment of processing runs
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import os
+import re
+import time
+import resource
+import logging
+log = logging.getLogger("repo.process")
+
+from . import utils
+
+MOUNTS_PATH = "/proc/mounts"
+OWN_CGROUP_PATH = "/proc/self/cgroup"
+# sub-group the update processes are moved to, so that the update cgroup
+# can delegate the memory controller to the run sub-groups
+UPDATE_CGROUP = "modrana-update"
+RUN_CGROUP_PREFIX = "modrana-run-"
+
+# failure reason prefix of runs that breached their memory ceiling
+MEMORY_LIMIT = "memory_limit"
+# ceiling of a run = peak memory estimate * headroom,
+# the headroom doubles with every breach of the run
+MEMORY_LIMIT_HEADROOM = 2.0
+# with RLIMIT_AS a failed run counts as a breach if its sampled
+# peak memory got this close to the ceiling
+RLIMIT_BREACH_FRACTION = 0.8
+# ... or if it reported a failed allocation
+ALLOCATION_FAILURE_PATTERN = re.compile(r"bad_alloc|out of memory|cannot allocate memory|MemoryError",
+                                        re.IGNORECASE)
+
+
+def memory_ceiling(estimate, breaches=0):
+    """return memory ceiling (in bytes) of a run with the given peak memory estimate
+    that already breached its ceiling the given number of times"""
+    return int(estimate * MEMORY_LIMIT_HEADROOM * 2 ** breaches)
+
+
+def _read(path):
+    with open(path, "r") as f:
+        return f.read()
+
+
+def _write(path, value):
+    with open(path, "w") as f:
+        f.write(value)
+
+
+def _cgroup2_mount():
+    """return the cgroup v2 mount point or None"""
+    try:
+        for line in _read(MOUNTS_PATH).splitlines():
+            fields = line.split()
+            if len(fields) > 2 and fields[2] == "cgroup2":
+                return fields[1]
+    except IOError:
+        pass
+    return None
+
+
+def _own_cgroup(mount):
+    """return path of the cgroup v2 group of this process"""
+    for line in _read(OWN_CGROUP_PATH).splitlines():
+        if line.startswith("0::"):
+            return os.path.join(mount, line[3:].strip().lstrip("/"))
+    return None
+
+
+def prepare_cgroup():
+    """prepare cgroup v2 memory containment & return the cgroup under which
+    run sub-groups are created - None if cgroup v2 with memory controller
+    delegation is not available
+
+    If the memory controller is not yet enabled for sub-groups of our cgroup,
+    it is enabled, but only if this process is the only one in the group,
+    as all processes need to be moved to a sub-group first.
+    NOTE: needs to be called before the worker processes are started
+    """
+    try:
+        mount = _cgroup2_mount()
+        if mount is None:
+            return None
+        group = _own_cgroup(mount)
+        if group is not None and os.path.basename(group) == UPDATE_CGROUP:
+            # already prepared
+            group = os.path.dirname(group)
+        if group is None or not os.access(os.path.join(group, "cgroup.subtree_control"), os.W_OK):
+            return None
+        if "memory" not in _read(os.path.join(group, "cgroup.subtree_control")).split():
+            if "memory" not in _read(os.path.join(group, "cgroup.controllers")).split():
+                return None
+            pids = _read(os.path.join(group, "cgroup.procs")).split()
+            if pids != [str(os.getpid())]:
+                # other processes (not ours) would need to be moved
+                return None
+            leaf = os.path.join(group, UPDATE_CGROUP)
+            utils.createFolderPath(leaf)
+            _write(os.path.join(leaf, "cgroup.procs"), str(os.getpid()))
+            _write(os.path.join(group, "cgroup.subtree_control"), "+memory")
+        return group
+    except (IOError, OSError):
+        log.exception("cgroup v2 memory containment not available")
+        return None
+
+
+class RlimitCeiling(object):
+    """Memory ceiling of a run enforced by RLIMIT_AS
+
+    The address space limit is inherited by all the children of the run.
+    Allocations over the limit fail, so a breach shows up as a failed run
+    that reported a failed allocation or whose memory usage got close
+    to the ceiling. Other failures (crashes included) are not breaches,
+    the address space also holds reservations that are never used,
+    so a run that just crashed would be retried with a bigger ceiling
+    for nothing.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+
+    def apply(self):
+        """called in the run process before the command is executed"""
+        resource.setrlimit(resource.RLIMIT_AS, (self.limit, self.limit))
+
+    def breached(self, returncode, usage, output_lines=()):
+        """report if the run failed by breaching the ceiling
+
+        :param returncode: return code of the run
+        :param usage: resource usage of the run (see watchdog.run_watched())
+        :param output_lines: the last lines of the run output
+        """
+        if returncode == 0:
+            return False
+        peak_memory = (usage or {}).get('peak_memory', 0)
+        if peak_memory >= self.limit * RLIMIT_BREACH_FRACTION:
+            return True
+        return any([ALLOCATION_FAILURE_PATTERN.search(line) for line in output_lines])
+
+    def cleanup(self):
+        pass
+
+
+class CgroupCeiling(object):
+    """Memory ceiling of a run enforced by a cgroup v2 sub-group
+
+    The run is moved to its own sub-group with memory.max set to the ceiling,
+    so the kernel OOM killer only kills processes of the run on a breach
+    and the breach is counted in memory.events.
+    The ceiling can be used for more commands in sequence, the sub-group
+    is created again for every command.
+    """
+
+    def __init__(self, parent, limit):
+        self.limit = limit
+        self._path = os.path.join(parent, "%s%d-%d" % (RUN_CGROUP_PREFIX, os.getpid(), int(time.time() * 1000)))
+        self._create()
+
+    def _create(self):
+        os.mkdir(self._path)
+        _write(os.path.join(self._path, "memory.max"), str(self.limit))
+        swap_max = os.path.join(self._path, "memory.swap.max")
+        if os.path.exists(swap_max):
+            # don't let the run escape the ceiling to swap
+            _write(swap_max, "0")
+
+    def apply(self):
+        if not os.path.isdir(self._path):
+            # removed after a previous command
+            self._create()
+        _write(os.path.join(self._path, "cgroup.procs"), "0")
+
+    def breached(self, returncode, usage, output_lines=()):
+        try:
+            for line in _read(os.path.join(self._path, "memory.events")).splitlines():
+                name, value = line.split()
+                if name == "oom_kill" and int(value) > 0:
+                    return True
+        except (IOError, ValueError):
+            pass
+        return False
+
+    def cleanup(self):
+        if not os.path.isdir(self._path):
+            # already removed
+            return
+        # the group can only be removed once all its processes are gone
+        for i in range(10):
+            try:
+                os.rmdir(self._path)
+                return
+            except OSError:
+                time.sleep(0.5)
+        log.warning("removing cgroup %s failed", self._path)
+
+
+def create_ceiling(limit, cgroup=None):
+    """return a memory ceiling for a run
+
+    :param int limit: ceiling in bytes
+    :param cgroup: cgroup prepared by prepare_cgroup(), None = use RLIMIT_AS
+    """
+    if cgroup is not None:
+        try:
+            return CgroupCeiling(cgroup, limit)
+        except (IOError, OSError):
+            log.exception("creating cgroup for a run failed, using RLIMIT_AS")
+    return RlimitCeiling(limit)
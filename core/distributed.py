@@ -0,0 +1,503 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - distributed processing
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+"""Distributed processing of repository updates
+
+The coordinator runs a normal repository update, but instead of running
+processing tasks on local processing processes, it leases them to worker
+agents running on other machines. The protocol is plain HTTP with JSON bodies:
+
+POST /lease                 -> lease a task (200 + lease JSON, 204 no task
+                               right now, 410 the update is finished)
+GET  /source/<lease id>     -> download source data of the leased task
+POST /heartbeat/<lease id>  -> extend the lease (404 once the lease expired)
+PUT  /result/<lease id>     -> upload the result of the leased task
+POST /complete/<lease id>   -> report the task as done or failed
+
+A lease that is not extended in time expires and its task is reported
+as failed to the task scheduler, which then retries it like any
+other failed task, so it is dispatched to another worker.
+
+NOTE: there is no authentication, only run the coordinator on a trusted network
+"""
+
+import os
+import time
+import json
+import uuid
+import socket
+import shutil
+import httplib
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+import Queue
+import logging
+log = logging.getLogger("repo.distributed")
+
+from . import utils
+
+DEFAULT_PORT = 8750
+# how long is a task leased to a worker without a heartbeat (in seconds)
+DEFAULT_LEASE_TIMEOUT = 600
+# how often should an idle worker ask for a new task (in seconds)
+WORKER_POLL_INTERVAL = 5
+# how many times in a row can a worker fail to reach the coordinator before it exits
+WORKER_CONNECT_ATTEMPTS = 12
+# for how long should a finished coordinator tell workers
+# that the update is over before it shuts down (in seconds)
+FINISH_GRACE_PERIOD = 2 * WORKER_POLL_INTERVAL + 1
+# every worker keeps its temporary data in its own folder ("worker-<worker name>")
+# inside the repository temporary folder, so that workers sharing the temporary
+# folder with the coordinator or with other workers don't touch their data
+WORKER_FOLDER_PREFIX = "worker-"
+# folder for source data downloaded by a worker, inside the worker folder
+REMOTE_SOURCE_FOLDER = "remote_sources"
+BLOCK_SIZE = 2 ** 20
+
+
+def parse_address(address):
+    """return a (host, port) tuple for "host:port", ":port" or "port" """
+    host, _, port = str(address).rpartition(":")
+    return host or "", int(port or DEFAULT_PORT)
+
+
+class _Lease(object):
+    def __init__(self, task, worker, timeout):
+        self.id = uuid.uuid4().hex
+        self.task = task
+        self.worker = worker
+        self.timeout = timeout
+        self.started = time.time()
+        self.expires = self.started + timeout
+        self.result_uploaded = False
+
+
+class Coordinator(object):
+    """Leases processing tasks from the task queue to remote workers
+    and reports finished tasks back to the task scheduler
+
+    The coordinator takes the place of the processing processes,
+    so it runs as a stage worker of the repository update.
+    """
+
+    def __init__(self, repository, task_queue, result_queue, shutdown_signal, shutdown_count, address,
+                 lease_timeout=DEFAULT_LEASE_TIMEOUT):
+        """
+        :param repository: the repository being updated
+        :param task_queue: processing tasks from the task scheduler
+        :param result_queue: finished tasks for the task scheduler
+        :param shutdown_signal: sent by the scheduler once all tasks are done
+        :param int shutdown_count: how many shutdown signals the scheduler sends
+        :param address: a (host, port) tuple to listen on
+        :param int lease_timeout: lease timeout in seconds
+        """
+        self._repository = repository
+        self._task_queue = task_queue
+        self._result_queue = result_queue
+        self._shutdown_signal = shutdown_signal
+        self._shutdown_count = shutdown_count
+        self._address = address
+        self._lease_timeout = lease_timeout
+        self._lock = threading.Lock()
+        self._pending = []
+        self._leases = {}
+        self._finished = False
+
+    def run(self):
+        server = _CoordinatorServer(self._address, _CoordinatorHandler)
+        server.coordinator = self
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        log.info("coordinator listening on %s:%d", *server.server_address)
+        shutdowns = 0
+        while shutdowns < self._shutdown_count:
+            try:
+                task = self._task_queue.get(timeout=1)
+                self._task_queue.task_done()
+                if task == self._shutdown_signal:
+                    shutdowns += 1
+                elif self._repository._get_cached_result(task):
+                    self._result_queue.put((task.id, True, True, 0, None))
+                else:
+                    with self._lock:
+                        self._pending.append(task)
+            except Queue.Empty:
+                pass
+            self._expire_leases()
+        # let the workers know that there is nothing more to do
+        with self._lock:
+            self._finished = True
+        time.sleep(FINISH_GRACE_PERIOD)
+        server.shutdown()
+        server.server_close()
+        log.info("coordinator shutting down")
+
+    def lease(self, worker):
+        """lease the next pending task to the worker
+        -> return lease info, None if there is no task right now
+        or False if the update is finished"""
+        with self._lock:
+            if self._finished:
+                return False
+            if not self._pending:
+                return None
+            task = self._pending.pop(0)
+            lease = _Lease(task, worker, self._lease_timeout)
+            self._leases[lease.id] = lease
+        package = task.package
+        log.info("task %s leased to %s", task.label, worker)
+        return {
+            'lease': lease.id,
+            'package': package.id,
+            'task': task.name,
+            'filename': os.path.basename(package.source_data_path),
+            'source_size': package.source_size,
+            'lease_timeout': self._lease_timeout
+        }
+
+    def get_lease(self, lease_id):
+        """return a lease that has not expired yet or None"""
+        with self._lock:
+            return self._leases.get(lease_id)
+
+    def heartbeat(self, lease_id):
+        """extend the lease, return False if it already expired"""
+        with self._lock:
+            lease = self._leases.get(lease_id)
+            if lease is None:
+                return False
+            lease.expires = time.time() + lease.timeout
+            return True
+
+    def store_result(self, lease_id, stream, length):
+        """store an uploaded task result, return False if the lease expired"""
+        lease = self.get_lease(lease_id)
+        if lease is None:
+            return False
+        path = self._repository._get_remote_result_path(lease.task)
+        utils.createFolderPath(os.path.dirname(path))
+        part_path = path + ".part"
+        f = open(part_path, "wb")
+        try:
+            remaining = length
+            while remaining > 0:
+                data = stream.read(min(BLOCK_SIZE, remaining))
+                if not data:
+                    break
+                f.write(data)
+                remaining -= len(data)
+        finally:
+            f.close()
+        with self._lock:
+            # the lease might have expired during the upload
+            # and the task might already run elsewhere
+            if remaining > 0 or lease_id not in self._leases:
+                os.remove(part_path)
+                return False
+            os.rename(part_path, path)
+            lease.result_uploaded = True
+        self._repository._remote_result_stored(lease.task, path)
+        return True
+
+    def complete(self, lease_id, success, reason, processing_time):
+        """report a leased task as done, return False if the lease expired"""
+        with self._lock:
+            lease = self._leases.pop(lease_id, None)
+        if lease is None:
+            return False
+        if success and not lease.result_uploaded:
+            success = False
+            reason = "no result uploaded"
+        if success:
+            log.info("task %s done by %s", lease.task.label, lease.worker)
+        else:
+            reason = "%s (worker %s)" % (reason or "task failed", lease.worker)
+            log.error("task %s failed: %s", lease.task.label, reason)
+        self._result_queue.put((lease.task.id, success, False, processing_time, reason))
+        return True
+
+    def _expire_leases(self):
+        """report tasks of workers that stopped sending heartbeats as failed,
+        so that the scheduler dispatches them again"""
+        now = time.time()
+        with self._lock:
+            expired = [lease for lease in self._leases.values() if lease.expires < now]
+            for lease in expired:
+                del self._leases[lease.id]
+        for lease in expired:
+            reason = "lease expired, worker %s lost" % lease.worker
+            log.error("task %s: %s", lease.task.label, reason)
+            self._result_queue.put((lease.task.id, False, False, now - lease.started, reason))
+
+
+class _CoordinatorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _CoordinatorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        coordinator = self.server.coordinator
+        action, lease_id = self._parse_path()
+        body = self._read_json()
+        if action == "lease":
+            lease = coordinator.lease(body.get('worker', self.client_address[0]))
+            if lease is False:
+                self._reply(410)
+            elif lease is None:
+                self._reply(204)
+            else:
+                self._reply(200, lease)
+        elif action == "heartbeat":
+            self._reply(200 if coordinator.heartbeat(lease_id) else 404)
+        elif action == "complete":
+            ok = coordinator.complete(lease_id, body.get('success', False), body.get('reason'),
+                                      body.get('processing_time', 0))
+            self._reply(200 if ok else 404)
+        else:
+            self._reply(404)
+
+    def do_GET(self):
+        action, lease_id = self._parse_path()
+        lease = self.server.coordinator.get_lease(lease_id)
+        if action != "source" or lease is None:
+            self._reply(404)
+            return
+        path = lease.task.package.source_data_path
+        f = open(path, "rb")
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(os.path.getsize(path)))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, BLOCK_SIZE)
+        finally:
+            f.close()
+
+    def do_PUT(self):
+        action, lease_id = self._parse_path()
+        length = int(self.headers.get("Content-Length", 0))
+        if action == "result" and self.server.coordinator.store_result(lease_id, self.rfile, length):
+            self._reply(200)
+        else:
+            self._reply(404)
+
+    def _parse_path(self):
+        components = self.path.strip("/").split("/")
+        if len(components) > 1:
+            return components[0], components[1]
+        else:
+            return components[0], None
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return {}
+
+    def _reply(self, code, body=None):
+        self.send_response(code)
+        if body is not None:
+            data = json.dumps(body)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s", self.client_address[0], format % args)
+
+
+class WorkerAgent(object):
+    """Leases processing tasks from a coordinator, runs them
+    locally & uploads the results back to the coordinator
+
+    A worker runs one task at a time, more workers can run on a single machine.
+    Source data of the last task is kept, as the next task is often
+    another routing profile of the same package.
+    """
+
+    def __init__(self, repository, coordinator_url):
+        self._repository = repository
+        url = urlparse.urlparse(coordinator_url)
+        if not url.netloc:
+            # just host:port
+            url = urlparse.urlparse("http://%s" % coordinator_url)
+        self._host = url.hostname
+        self._port = url.port or DEFAULT_PORT
+        self._name = "%s-%d" % (socket.gethostname(), os.getpid())
+        self._temp_path = os.path.join(repository.temp_path, WORKER_FOLDER_PREFIX + self._name)
+        self._source_folder = os.path.join(self._temp_path, REMOTE_SOURCE_FOLDER)
+        # (package id, source path) of the last task
+        self._source = None
+
+    def run(self):
+        log.info("worker %s starting, coordinator: %s:%d", self._name, self._host, self._port)
+        failed_connections = 0
+        while True:
+            try:
+                status, lease = self._request("POST", "/lease", {'worker': self._name})
+            except (socket.error, httplib.HTTPException):
+                failed_connections += 1
+                if failed_connections >= WORKER_CONNECT_ATTEMPTS:
+                    log.error("coordinator can't be reached, worker shutting down")
+                    break
+                time.sleep(WORKER_POLL_INTERVAL)
+                continue
+            failed_connections = 0
+            if status == 410:
+                log.info("update finished, worker shutting down")
+                break
+            elif status != 200:
+                time.sleep(WORKER_POLL_INTERVAL)
+                continue
+            try:
+                self._run_lease(lease)
+            except (socket.error, httplib.HTTPException):
+                log.exception("connection to the coordinator failed during task %s", lease['task'])
+        self._remove_source()
+        shutil.rmtree(self._temp_path, ignore_errors=True)
+
+    def _run_lease(self, lease):
+        label = "%s/%s" % (lease['package'], lease['task'])
+        log.info("running %s", label)
+        start = time.time()
+        heartbeat_stop = threading.Event()
+        heartbeat = threading.Thread(target=self._send_heartbeats, args=(lease, heartbeat_stop))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            source_path = self._get_source(lease)
+            if source_path:
+                success, reason = self._repository.run_remote_task(
+                    lease, source_path, self._source_folder, self._temp_path,
+                    lambda path: self._upload_result(lease, path)
+                )
+            else:
+                success, reason = False, "source data download failed"
+        except Exception, e:
+            log.exception("task %s failed", label)
+            success, reason = False, "error: %s" % e
+        finally:
+            heartbeat_stop.set()
+            heartbeat.join()
+        status, _ = self._request("POST", "/complete/%s" % lease['lease'], {
+            'success': success,
+            'reason': reason,
+            'processing_time': time.time() - start
+        })
+        if status != 200:
+            log.error("task %s: lease expired, result discarded by the coordinator", label)
+        else:
+            log.info("task %s %s in %s", label, "done" if success else "failed",
+                     utils.prettyTimeDiff(time.time() - start))
+
+    def _send_heartbeats(self, lease, stop):
+        interval = max(1, lease['lease_timeout'] / 3)
+        while not stop.wait(interval):
+            try:
+                status, _ = self._request("POST", "/heartbeat/%s" % lease['lease'])
+                if status != 200:
+                    log.error("lease for %s/%s expired", lease['package'], lease['task'])
+                    return
+            except (socket.error, httplib.HTTPException):
+                log.warning("heartbeat for %s/%s failed", lease['package'], lease['task'])
+
+    def _get_source(self, lease):
+        """download source data for the lease, unless already downloaded for a previous task
+        -> return path to the source data or None if the download failed"""
+        package_id = lease['package']
+        if self._source and self._source[0] == package_id and \
+                os.path.getsize(self._source[1]) == lease['source_size']:
+            return self._source[1]
+        self._remove_source()
+        path = os.path.join(self._source_folder, os.path.dirname(package_id), lease['filename'])
+        utils.createFolderPath(os.path.dirname(path))
+        connection = httplib.HTTPConnection(self._host, self._port)
+        try:
+            connection.request("GET", "/source/%s" % lease['lease'])
+            response = connection.getresponse()
+            if response.status != 200:
+                return None
+            f = open(path, "wb")
+            try:
+                shutil.copyfileobj(response, f, BLOCK_SIZE)
+            finally:
+                f.close()
+        finally:
+            connection.close()
+        if os.path.getsize(path) != lease['source_size']:
+            log.error("incomplete source data for %s", package_id)
+            os.remove(path)
+            return None
+        self._source = (package_id, path)
+        return path
+
+    def _remove_source(self):
+        if self._source and os.path.exists(self._source[1]):
+            os.remove(self._source[1])
+        self._source = None
+
+    def _upload_result(self, lease, path):
+        """upload a result file to the coordinator, return True on success"""
+        connection = httplib.HTTPConnection(self._host, self._port)
+        try:
+            connection.putrequest("PUT", "/result/%s" % lease['lease'])
+            connection.putheader("Content-Type", "application/octet-stream")
+            connection.putheader("Content-Length", str(os.path.getsize(path)))
+            connection.endheaders()
+            f = open(path, "rb")
+            try:
+                while True:
+                    data = f.read(BLOCK_SIZE)
+                    if not data:
+                        break
+                    connection.send(data)
+            finally:
+                f.close()
+            return connection.getresponse().status == 200
+        finally:
+            connection.close()
+
+    def _request(self, method, path, body=None):
+        """send a JSON request to the coordinator
+        -> return a (status, decoded JSON body or None) tuple"""
+        connection = httplib.HTTPConnection(self._host, self._port, timeout=60)
+        try:
+            data = json.dumps(body or {})
+            connection.request(method, path, data, {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            content = response.read()
+            if content:
+                return response.status, json.loads(content)
+            else:
+                return response.status, None
+        finally:
+            connection.close()
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - pipeline engines
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import multiprocessing as mp
+import threading
+import resource
+import Queue
+import logging
+log = logging.getLogger("repo")
+
+from . import utils
+
+# engines
+# - every stage worker is a separate process
+ENGINE_PROCESSES = "processes"
+# - every stage worker is a thread of the main process
+ENGINE_THREADS = "threads"
+ENGINES = [ENGINE_PROCESSES, ENGINE_THREADS]
+DEFAULT_ENGINE = ENGINE_PROCESSES
+
+
+class ProcessEngine(object):
+    """Runs every pipeline stage worker in a separate process,
+    packages are pickled when passed between the stages"""
+
+    name = ENGINE_PROCESSES
+
+    def joinable_queue(self, maxsize=0):
+        return mp.JoinableQueue(maxsize)
+
+    def queue(self):
+        return mp.Queue()
+
+    def worker(self, target, daemon):
+        """return a new (not yet started) stage worker"""
+        worker = mp.Process(target=target)
+        worker.daemon = daemon
+        return worker
+
+    def start(self):
+        """called before the stage workers are started"""
+        pass
+
+    def offload(self, function, *args):
+        """run a CPU bound function outside of the stage worker
+        -> the stage workers are separate processes already,
+        so the function is just called"""
+        return function(*args)
+
+    def stop(self):
+        """called once all the stage workers are done"""
+        pass
+
+
+class ThreadEngine(ProcessEngine):
+    """Runs all the pipeline stage workers as threads of the main process
+
+    The stages spend most of their time waiting for downloads, preprocessor
+    subprocesses and disk IO, which does not need a Python process per worker.
+    Packages are passed between the stages without pickling. CPU bound
+    work (archive compression) is offloaded to a process pool, so that
+    it does not hold the interpreter lock.
+    """
+
+    name = ENGINE_THREADS
+
+    def __init__(self, offload_pool_size):
+        self._offload_pool_size = offload_pool_size
+        self._pool = None
+
+    def joinable_queue(self, maxsize=0):
+        return Queue.Queue(maxsize)
+
+    def queue(self):
+        return Queue.Queue()
+
+    def worker(self, target, daemon):
+        worker = threading.Thread(target=target)
+        worker.daemon = daemon
+        return worker
+
+    def start(self):
+        # start the pool before any stage threads are running,
+        # so that the pool processes are forked from a single threaded process
+        if self._pool is None:
+            self._pool = mp.Pool(self._offload_pool_size)
+
+    def offload(self, function, *args):
+        return self._pool.apply(function, args)
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def create_engine(name, offload_pool_size):
+    """return a pipeline engine instance
+
+    :param str name: one of the ENGINES
+    :param int offload_pool_size: how many processes can run offloaded work at once
+    """
+    if name == ENGINE_THREADS:
+        return ThreadEngine(offload_pool_size)
+    elif name == ENGINE_PROCESSES:
+        return ProcessEngine()
+    else:
+        raise ValueError("unknown engine: %s" % name)
+
+
+def log_resource_usage(engine):
+    """log peak memory usage of the update, so that the engines can be compared
+    -> preprocessors & (with the processes engine) stage workers are child processes"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    log.info("# %s engine peak RSS: main process %s, largest child process %s", engine.name,
+             utils.bytes2PrettyUnitString(own), utils.bytes2PrettyUnitString(children))
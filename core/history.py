@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - package history
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import os
+import json
+import time
+import fcntl
+import logging
+log = logging.getLogger("repo")
+
+from . import utils
+
+# processing speed estimate used when there is no history at all
+# (about an hour per GB of source data with default settings)
+DEFAULT_SECONDS_PER_BYTE = 3600.0 / 2 ** 30
+
+
+class JSONStore(object):
+    """A small JSON file based key-value store shared by all the processes
+    of a repository update
+
+    Records are updated with read-merge-write under an exclusive lock
+    on a lock file next to the store, so that more processes can safely
+    record their results into the same store.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._data = {}
+        self.reload()
+
+    @property
+    def path(self):
+        return self._path
+
+    def reload(self):
+        """(re)load the store from storage"""
+        self._data = self._read()
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def items(self):
+        return self._data.items()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def record(self, key, **values):
+        """update the record for key with the given values & save the store"""
+        lock = self._lock()
+        try:
+            self._data = self._read()
+            entry = self._data.setdefault(key, {})
+            entry.update(values)
+            entry['updated'] = int(time.time())
+            self._write(self._data)
+        finally:
+            self._unlock(lock)
+
+    def remove(self, key):
+        """remove the record for key & save the store"""
+        lock = self._lock()
+        try:
+            self._data = self._read()
+            if self._data.pop(key, None) is not None:
+                self._write(self._data)
+        finally:
+            self._unlock(lock)
+
+    def _read(self):
+        if not os.path.exists(self._path):
+            return {}
+        try:
+            with open(self._path, "r") as f:
+                return json.load(f)
+        except Exception:
+            log.exception("loading %s failed, starting with an empty store", self._path)
+            return {}
+
+    def _write(self, data):
+        # write to a temporary file first & then replace the store atomically,
+        # so that a crash during the write does not corrupt the store
+        temp_path = "%s.tmp" % self._path
+        with open(temp_path, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.rename(temp_path, self._path)
+
+    def _lock(self):
+        folder = os.path.dirname(self._path)
+        if folder:
+            utils.createFolderPath(folder)
+        lock = open("%s.lock" % self._path, "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _unlock(self, lock):
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+
+class PackageHistory(JSONStore):
+    """Results of past repository updates for the individual packages,
+    keyed by package repository sub-path (continent/country/etc.)"""
+
+    def record_task(self, key, task_name, **values):
+        """update the results of a single processing task of the package & save the store
+        -> task results are stored under 'tasks' in the package record"""
+        lock = self._lock()
+        try:
+            self._data = self._read()
+            entry = self._data.setdefault(key, {})
+            entry.setdefault('tasks', {}).setdefault(task_name, {}).update(values)
+            entry['updated'] = int(time.time())
+            self._write(self._data)
+        finally:
+            self._unlock(lock)
+
+    def predict_processing_time(self, key, source_size=None):
+        """predict how long processing of the given package will take (in seconds)
+        -> based on the last recorded run of the package, scaled by source data size change
+        -> if there is no record for the package, the prediction is based on the source
+        data size and the average processing speed of all recorded packages
+
+        :param str key: package repository sub-path
+        :param source_size: current source data size in bytes, if known
+        """
+        entry = self.get(key)
+        if entry and entry.get('processing_time'):
+            recorded_time = entry['processing_time']
+            recorded_size = entry.get('source_size')
+            if source_size and recorded_size:
+                return recorded_time * float(source_size) / recorded_size
+            else:
+                return recorded_time
+        if source_size:
+            return source_size * self.seconds_per_byte
+        else:
+            return 0
+
+    @property
+    def seconds_per_byte(self):
+        """median processing speed over all recorded packages"""
+        speeds = []
+        for key, entry in self.items():
+            if entry.get('processing_time') and entry.get('source_size'):
+                speeds.append(float(entry['processing_time']) / entry['source_size'])
+        if speeds:
+            speeds.sort()
+            return speeds[len(speeds) / 2]
+        else:
+            return DEFAULT_SECONDS_PER_BYTE
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - update journal
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import os
+import json
+import time
+import logging
+log = logging.getLogger("repo")
+
+# package states, in the order a package goes through them
+LOADED = "loaded"
+PROCESSED = "processed"
+PACKAGED = "packaged"
+PUBLISHED = "published"
+# the package failed in one of the stages
+FAILED = "failed"
+STATES = [LOADED, PROCESSED, PACKAGED, PUBLISHED, FAILED]
+
+JOURNAL_FILENAME = "journal.log"
+
+
+class UpdateJournal(object):
+    """Append-only on-disk journal of package state transitions
+    during a repository update
+
+    Every state transition is appended as a single JSON line & synced
+    to storage before the package moves on to the next stage, so after
+    a crash the journal tells what was already done for every package.
+    Packages are identified by their repository sub-path, which is stable
+    between updates.
+
+    All the stage processes append to the same journal file,
+    lines are written with a single write to a file opened in append mode,
+    so they don't get mixed.
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+    @property
+    def path(self):
+        return self._path
+
+    def reset(self):
+        """start a new journal, keeping the previous one as a backup"""
+        if os.path.exists(self._path):
+            os.rename(self._path, "%s.old" % self._path)
+
+    def record(self, package_id, state):
+        """append a state transition of a package to the journal"""
+        line = json.dumps({'time': int(time.time()), 'id': package_id, 'state': state})
+        fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, line + "\n")
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def load(self):
+        """return a package id -> last state dictionary
+        -> incomplete lines (from a crash during a write) are ignored"""
+        states = {}
+        if not os.path.exists(self._path):
+            return states
+        with open(self._path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    states[entry['id']] = entry['state']
+                except (ValueError, KeyError):
+                    log.warning("skipping damaged journal line: %r", line)
+        return states
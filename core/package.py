@@ -21,11 +21,13 @@
 
 import os
 import time
+import zlib
 import logging
 import shutil
 import urllib
 
 import core.utils as utils
+import core.pbf as pbf
 
 log = logging.getLogger("repo")
 source_log = logging.getLogger('repo.source.monav')
@@ -33,6 +35,10 @@ process_log = logging.getLogger('repo.process.monav')
 package_log = logging.getLogger('repo.package.monav')
 publish_log = logging.getLogger('repo.publish.monav')
 
+# name of the default processing task
+PROCESS_TASK = "process"
+
+
 class Package(object):
     # states
 
@@ -46,6 +52,9 @@ class Package(object):
         # this timestamp relates to when
         # the source data were last updated
         self.source_timestamp = None
+        # bounding box, entity counts, etc. of the source data
+        # (a pbf.PbfScan instance, None if not scanned)
+        self.source_scan = None
         # repository path suffix
         # ex.: europe/france/ for French regions
         self._repo_sub_path = ""
@@ -53,12 +62,44 @@ class Package(object):
         self._state = None
         # combined time spend on package processing in seconds
         self._processing_time = 0
+        # time spent on packaging the results in seconds
+        self.packaging_time = 0
+        # run time & peak memory usage of processing tasks, by task name
+        self.task_stats = {}
+        # names of processing tasks with results taken from the build cache
+        self.cached_tasks = []
         # current loading progress 0.0 = 0%, 1.0 = 100%
         self._loading_progress = 0.0
         # a path to the source data file
         self._source_file_path = metadata.get('filePath')
         # a temporary working directory for this package only
         self._temp_path = None
+        # fingerprint of the source data file (size, mtime, hash),
+        # recorded once the package is published
+        self.source_fingerprint = None
+        # processing attempts made so far
+        self.attempts = 0
+        # stage that failed for this package & why (None if nothing failed)
+        self.failed_stage = None
+        self.failure_reason = None
+        # priority class of the package, higher is more urgent
+        self.priority = 0
+        # how much of the temporary folder disk budget is reserved
+        # for this package (in bytes)
+        self.disk_reservation = 0
+        # scratch storage tier folder (RAM backed) the package works in,
+        # None = scratch data is kept in the temporary folder
+        self._scratch_tier_path = None
+        # how much of the scratch tier budget is reserved for this package (in bytes)
+        self.scratch_reservation = 0
+        # loader sharing downloaded source data with other repositories
+        # & name of the repository the package belongs to
+        self._source_loader = metadata.get('sourceLoader')
+        self._repository = metadata.get('repository')
+        # removes temporary data in the background (None = remove right away)
+        self._reaper = metadata.get('reaper')
+        # reference to shared source data (None if not shared)
+        self._source_handle = None
         # source data
         self._url = metadata.get('url')
         url_type = metadata.get('urlType')
@@ -70,19 +111,31 @@ class Package(object):
             self._repo_sub_path, self._filename, self._name = utils.pbfPath2repoPathFilenameName(
                 self.source_file_path, self._file_path_prefix
             )
-            self._source_data_path = self.source_file_path
         else: # url
             self._repo_sub_path, self._filename, self._name = utils.url2repoPathFilenameName(self._url, url_type)
-            self._source_data_path = os.path.join(self._temp_storage_path, self._filename)
-        # a temporary working directory for this package only (unique id prefix)
-        self._temp_path = os.path.join(metadata['tempPath'], str(metadata['packId']))
+        # a temporary working directory for this package only, named after the
+        # package id, so that it can be found again when resuming an interrupted update
+        self._temp_path = os.path.join(metadata['tempPath'], self.id.replace(os.sep, "."))
         # a subdirectory named after the package
         self._temp_storage_path = os.path.join(self._temp_path, self.name)
+        if self.source_file_path:
+            self._source_data_path = self.source_file_path
+        else: # url
+            self._source_data_path = os.path.join(self._temp_storage_path, self._filename)
+
+    @property
+    def id(self):
+        """stable package identifier - the repository sub-path"""
+        return self._repo_sub_path
 
     @property
     def name(self):
         return self._name
 
+    @property
+    def repo_sub_path(self):
+        return self._repo_sub_path
+
     @property
     def size(self):
         return  self._size
@@ -91,6 +144,15 @@ class Package(object):
     def state(self):
         return self._state
 
+    @property
+    def failed(self):
+        return self.failed_stage is not None
+
+    def fail(self, stage, reason):
+        """mark the package as failed, failed packages skip all the following stages"""
+        self.failed_stage = stage
+        self.failure_reason = reason
+
     @property
     def loading_progress(self):
         return self._loading_progress
@@ -103,6 +165,19 @@ class Package(object):
         """return how long this package took to process so far in seconds"""
         return self._processing_time
 
+    @property
+    def source_data_path(self):
+        """path to the source data (local file or downloaded data)"""
+        return self._source_data_path
+
+    @property
+    def source_hash(self):
+        """SHA1 hash of the source data or None if not known"""
+        if self.source_fingerprint:
+            return self.source_fingerprint.get('sha1')
+        else:
+            return None
+
     @property
     def source_file_path(self):
         return self._source_file_path
@@ -111,6 +186,65 @@ class Package(object):
     def temp_path(self):
         return self._temp_path
 
+    @property
+    def scratch_base_path(self):
+        """folder for processing scratch data of this package only,
+        on the scratch tier if the package has been placed there"""
+        if self._scratch_tier_path:
+            return os.path.join(self._scratch_tier_path, self.id.replace(os.sep, "."))
+        else:
+            return self._temp_path
+
+    @property
+    def scratch_path(self):
+        """a subdirectory of the scratch folder named after the package"""
+        return os.path.join(self.scratch_base_path, self.name)
+
+    @property
+    def on_scratch_tier(self):
+        return self._scratch_tier_path is not None
+
+    def place_scratch(self, tier_path, reservation):
+        """keep processing scratch data on the given scratch tier
+
+        :param str tier_path: scratch tier folder
+        :param int reservation: how much of the tier budget is reserved for the package
+        """
+        self._scratch_tier_path = tier_path
+        self.scratch_reservation = reservation
+
+    def clear_scratch(self):
+        """remove scratch data kept on the scratch tier
+        -> scratch data in the temporary folder are removed with it"""
+        if self._scratch_tier_path and os.path.exists(self.scratch_base_path):
+            shutil.rmtree(self.scratch_base_path)
+
+    @property
+    def source_size(self):
+        """return size of the source data file in bytes (0 if unknown)"""
+        try:
+            return os.path.getsize(self._source_data_path)
+        except OSError:
+            return 0
+
+    def estimate_peak_memory(self, *args, **kwargs):
+        """return estimated peak RAM usage (in bytes) during processing
+        of this package, 0 means unknown"""
+        return 0
+
+    def estimate_disk_usage(self, source_size=None):
+        """return estimated temporary folder usage (in bytes) of this package
+        -> source data stored in the temporary folder + processing scratch data
+
+        :param source_size: source data size, if known before the data is loaded
+        """
+        return 0
+
+    def estimate_scratch_usage(self):
+        """return estimated size (in bytes) of processing scratch data
+        of this package (0 = no scratch data)"""
+        return 0
+
     def _timeit(self, fn):
         def wrapped():
             start = time.time()
@@ -120,11 +254,24 @@ class Package(object):
         return wrapped
 
     def load(self):
-        """load any source data needed by the package to storage"""
+        """load any source data needed by the package to storage
+        -> return True if loading succeeded, False otherwise"""
         if self.source_file_path:
-            self._loadFromFile()
+            return self._loadFromFile()
         else:  # url
-            self._download()
+            return self._download()
+
+    def scan_source(self):
+        """scan the loaded source data PBF file & set the source timestamp
+        -> return the scan results, None if the source data can't be scanned"""
+        try:
+            self.source_scan = pbf.scan(self._source_data_path)
+        except (IOError, ValueError, zlib.error) as e:
+            source_log.warning('scanning source data of %s failed: %s', self.name, e)
+            return None
+        if self.source_scan.replication_timestamp:
+            self.source_timestamp = self.source_scan.replication_timestamp
+        return self.source_scan
 
     def _loadFromFile(self):
         """Use local PBF file as data source"""
@@ -135,6 +282,9 @@ class Package(object):
                     shutil.rmtree(self._temp_storage_path)
                 utils.createFolderPath(self._temp_storage_path)
                 return True
+            else:
+                source_log.error('source file for %s not found: %s', self.name, self._source_data_path)
+                return False
         except Exception:
             message = 'monav package: OSM PBF loading failed\n'
             message += 'name: %s\n' % self.name
@@ -144,21 +294,29 @@ class Package(object):
             return False
 
     def _download(self):
-        """download PBF extract from the URL and store it locally"""
+        """download PBF extract from the URL and store it locally
+        -> with a shared source loader the extract is only downloaded once
+        for all the repositories using it"""
         try:
-            if os.path.exists(self._source_data_path):
-                return
+            if self._source_loader is None and os.path.exists(self._source_data_path):
+                return True
                 # TODO: DEBUG, remove this
             else:
-                if os.path.exists(self._temp_storage_path):
+                if not os.path.exists(self._source_data_path) and os.path.exists(self._temp_storage_path):
                     source_log.info('removing old folder %s' % self._temp_storage_path)
                     shutil.rmtree(self._temp_storage_path)
                 utils.createFolderPath(self._temp_storage_path)
-                #        f = open(self.sourceDataPath, "w")
-                #        request = urllib2.urlopen(self.url)
-                urllib.urlretrieve(self._url, self._source_data_path)
-                #        f.write(request.read())
-                #        f.close()
+                if self._source_loader is not None:
+                    self._source_handle = self._source_loader.acquire(
+                        self._repository, self._url, self._source_data_path,
+                        lambda path: urllib.urlretrieve(self._url, path)
+                    )
+                else:
+                    #        f = open(self.sourceDataPath, "w")
+                    #        request = urllib2.urlopen(self.url)
+                    urllib.urlretrieve(self._url, self._source_data_path)
+                    #        f.write(request.read())
+                    #        f.close()
                 return True
         except Exception:
             message = 'monav package: OSM PBF download failed\n'
@@ -170,6 +328,16 @@ class Package(object):
             # traceback.print_exc(file=sys.stdout)
             return False
 
+    def can_resume(self, state):
+        """report if results of the given stage (see core.journal) from
+        an interrupted update are still available for this package"""
+        return False
+
+    def get_tasks(self):
+        """return names of the processing tasks of this package,
+        tasks of a package can run in parallel"""
+        return [PROCESS_TASK]
+
     def process(self):
         """process the source data"""
         pass
@@ -188,9 +356,18 @@ class Package(object):
         """
         pass
 
+    def release_source(self):
+        """release shared source data, so that it can be removed
+        once no other repository needs it"""
+        if self._source_handle is not None:
+            self._source_handle.release()
+            self._source_handle = None
+
     def clear_all(self):
         """clear all data created during package processing
         -> this currently means source & temporary data,
         not results, if they were already published"""
+        self.release_source()
+        self.clear_scratch()
 
 
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - OSM PBF file scanner
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import os
+import zlib
+import struct
+import logging
+log = logging.getLogger("repo.source")
+
+# how many data blocks are decoded for estimating entity counts,
+# counts of the other blocks are taken from the nearest decoded block
+PBF_SCAN_SAMPLES = 32
+
+# limits from the PBF format specification
+MAX_BLOB_HEADER_SIZE = 64 * 1024
+MAX_BLOB_SIZE = 32 * 1024 * 1024
+
+HEADER_BLOCK = "OSMHeader"
+DATA_BLOCK = "OSMData"
+
+# protobuf wire types
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+_FIXED32 = 5
+
+# bytes that end a varint (no continuation bit)
+_VARINT_ENDS = [chr(i) for i in range(128)]
+
+
+class PbfScan(object):
+    """Results of a PBF file scan
+
+    The header fields are exact, the entity counts are approximate
+    (extrapolated from a sample of the data blocks).
+    """
+
+    def __init__(self):
+        # (left, bottom, right, top) in degrees, None if not in the header
+        self.bbox = None
+        # when were the data last replicated from the main database
+        # (UNIX timestamp), None if not in the header
+        self.replication_timestamp = None
+        self.writing_program = None
+        # number & compressed size (in bytes) of data blocks
+        self.blocks = 0
+        self.data_size = 0
+        # how many data blocks have been decoded
+        self.sampled_blocks = 0
+        self.nodes = 0
+        self.ways = 0
+        self.relations = 0
+
+    def to_dict(self):
+        return {
+            'bbox': self.bbox,
+            'replication_timestamp': self.replication_timestamp,
+            'blocks': self.blocks,
+            'sampled_blocks': self.sampled_blocks,
+            'nodes': self.nodes,
+            'ways': self.ways,
+            'relations': self.relations
+        }
+
+
+def _varint(buf, pos):
+    """decode a varint at pos, return (value, position after the varint)"""
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise ValueError("truncated varint")
+        b = ord(buf[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError("varint too long")
+
+
+def _zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _fields(buf):
+    """iterate over (field number, wire type, value) of a protobuf message,
+    value is an integer for varints and a string for everything else"""
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        number = key >> 3
+        wire_type = key & 0x7
+        if wire_type == _VARINT:
+            value, pos = _varint(buf, pos)
+        elif wire_type == _LENGTH_DELIMITED:
+            length, pos = _varint(buf, pos)
+            value = buf[pos:pos + length]
+            if len(value) != length:
+                raise ValueError("truncated field")
+            pos += length
+        elif wire_type == _FIXED64:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == _FIXED32:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("unsupported wire type %d" % wire_type)
+        yield number, wire_type, value
+
+
+def _count_varints(data):
+    """number of varints in a packed field"""
+    return sum([data.count(end) for end in _VARINT_ENDS])
+
+
+def _blob_data(blob):
+    """return uncompressed content of a Blob message, None if the compression
+    is not supported (LZMA, etc.)"""
+    raw_size = None
+    for number, wire_type, value in _fields(blob):
+        if number == 1:
+            return value
+        elif number == 2:
+            raw_size = value
+        elif number == 3:
+            data = zlib.decompress(value)
+            if raw_size is not None and len(data) != raw_size:
+                raise ValueError("blob size mismatch")
+            return data
+    return None
+
+
+def _parse_header_block(data, scan):
+    for number, wire_type, value in _fields(data):
+        if number == 1:
+            # HeaderBBox in nanodegrees: left, right, top, bottom
+            bbox = dict([(n, _zigzag(v) / 1e9) for n, w, v in _fields(value)])
+            if len(bbox) == 4:
+                scan.bbox = (bbox[1], bbox[4], bbox[2], bbox[3])
+        elif number == 16:
+            scan.writing_program = value
+        elif number == 32:
+            scan.replication_timestamp = value
+
+
+def _count_entities(data):
+    """return (nodes, ways, relations) in a PrimitiveBlock"""
+    nodes = ways = relations = 0
+    for number, wire_type, group in _fields(data):
+        if number != 2:
+            # string table, granularity, etc.
+            continue
+        for group_number, group_wire_type, value in _fields(group):
+            if group_number == 1:
+                nodes += 1
+            elif group_number == 2:
+                # dense nodes - one varint in the packed id field per node
+                for dense_number, dense_wire_type, dense_value in _fields(value):
+                    if dense_number == 1:
+                        nodes += _count_varints(dense_value)
+                        break
+            elif group_number == 3:
+                ways += 1
+            elif group_number == 4:
+                relations += 1
+    return nodes, ways, relations
+
+
+def _read_blocks(f):
+    """return a list of (type, blob offset, blob size) tuples for all blocks in the file,
+    only the block headers are read"""
+    blocks = []
+    file_size = os.fstat(f.fileno()).st_size
+    while True:
+        prefix = f.read(4)
+        if not prefix:
+            break
+        if len(prefix) != 4:
+            raise ValueError("truncated block header length")
+        header_size = struct.unpack("!I", prefix)[0]
+        if header_size > MAX_BLOB_HEADER_SIZE:
+            raise ValueError("block header too large: %d" % header_size)
+        header = f.read(header_size)
+        if len(header) != header_size:
+            raise ValueError("truncated block header")
+        block_type = None
+        blob_size = None
+        for number, wire_type, value in _fields(header):
+            if number == 1:
+                block_type = value
+            elif number == 3:
+                blob_size = value
+        if block_type is None or blob_size is None or blob_size > MAX_BLOB_SIZE:
+            raise ValueError("invalid block header")
+        offset = f.tell()
+        if offset + blob_size > file_size:
+            raise ValueError("truncated block")
+        blocks.append((block_type, offset, blob_size))
+        f.seek(blob_size, os.SEEK_CUR)
+    return blocks
+
+
+def scan(path, samples=PBF_SCAN_SAMPLES):
+    """scan an OSM PBF file without decoding all of it
+
+    The header block is decoded & all the block headers are read
+    (the data blocks are skipped). Entities are counted in an evenly spread
+    sample of the data blocks and each other block is assumed to hold as many
+    entities as the nearest sampled block - PBF writers put a fixed number
+    of entities to a block & files are sorted (nodes, ways, relations),
+    so nearby blocks hold the same entity type.
+
+    :param str path: PBF file path
+    :param int samples: how many data blocks to decode at most
+    :returns: a PbfScan instance
+    :raises ValueError: if the file is not a valid PBF file
+    """
+    scan_result = PbfScan()
+    with open(path, "rb") as f:
+        blocks = _read_blocks(f)
+        if not blocks or blocks[0][0] != HEADER_BLOCK:
+            raise ValueError("no header block")
+        f.seek(blocks[0][1])
+        header = _blob_data(f.read(blocks[0][2]))
+        if header is not None:
+            _parse_header_block(header, scan_result)
+        data_blocks = [(offset, size) for block_type, offset, size in blocks if block_type == DATA_BLOCK]
+        scan_result.blocks = len(data_blocks)
+        scan_result.data_size = sum([size for offset, size in data_blocks])
+        if not data_blocks:
+            return scan_result
+        count = len(data_blocks)
+        sample_count = max(1, min(count, samples))
+        sampled = [index * count / sample_count for index in range(sample_count)]
+        sample_counts = {}
+        for index in sampled:
+            offset, size = data_blocks[index]
+            f.seek(offset)
+            data = _blob_data(f.read(size))
+            if data is not None:
+                sample_counts[index] = _count_entities(data)
+        scan_result.sampled_blocks = len(sample_counts)
+        if sample_counts:
+            decoded = sorted(sample_counts.keys())
+            totals = [0, 0, 0]
+            for index in range(count):
+                nearest = min(decoded, key=lambda sample_index: abs(sample_index - index))
+                for i in range(3):
+                    totals[i] += sample_counts[nearest][i]
+            scan_result.nodes, scan_result.ways, scan_result.relations = totals
+    return scan_result
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - processing phases from command output
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import os
+import re
+import time
+import collections
+import logging
+log = logging.getLogger("repo.process")
+
+from . import utils
+
+# "<label>: <number>" lines (for example "Nodes: 12345"),
+# optionally prefixed by the name of the reporting component
+COUNTER_PATTERN = re.compile(r"^(?:[^:]+:\s*)?(?P<name>[A-Za-z][A-Za-z _-]*?)\s*:\s*(?P<value>\d+)\s*$")
+# how many of the last output lines are kept
+RECENT_LINES = 50
+
+
+def counter_name(label):
+    """normalize a counter label to a key ("Number Of Nodes" -> "number_of_nodes")"""
+    return re.sub(r"[\s-]+", "_", label.strip().lower())
+
+
+class PhaseTracker(object):
+    """Follows the output of a running command in its log file
+    & splits the run to phases
+
+    A phase starts once a line matching its pattern is written and ends
+    once a line of another phase is written or the command exits,
+    so phase durations are as precise as the polling interval.
+    Counters ("<label>: <number>" lines) are gathered for the whole run,
+    the last value of a counter wins.
+
+    The tracker is polled by the watchdog while the command runs
+    (see watchdog.run_watched()).
+    """
+
+    def __init__(self, path, phases, label=None, counter_pattern=COUNTER_PATTERN):
+        """
+        :param str path: log file the command output is written to
+        :param phases: list of (phase name, compiled regular expression) tuples,
+                       the first matching phase wins
+        :param str label: what is running (for logging)
+        :param counter_pattern: compiled regular expression with name & value groups
+        """
+        self._path = path
+        self._phases = phases
+        self._label = label or path
+        self._counter_pattern = counter_pattern
+        # start after output of earlier runs appended to the same log
+        if os.path.exists(path):
+            self._offset = os.path.getsize(path)
+        else:
+            self._offset = 0
+        self._partial = ""
+        self._current = None
+        self._current_start = None
+        # phase name -> duration in seconds, in the order the phases ran
+        self.phases = collections.OrderedDict()
+        # counter name -> last value
+        self.counters = {}
+        # the last lines of the output (for failure diagnosis)
+        self.recent_lines = collections.deque(maxlen=RECENT_LINES)
+
+    def poll(self, now=None):
+        """parse output written since the last poll"""
+        if now is None:
+            now = time.time()
+        # the log is reopened every time, a file object would stay at EOF once it reached it
+        try:
+            with open(self._path, "r") as f:
+                f.seek(self._offset)
+                data = f.read()
+        except IOError:
+            # not created yet
+            return
+        if not data:
+            return
+        self._offset += len(data)
+        lines = (self._partial + data).split("\n")
+        # the last line might not be complete yet
+        self._partial = lines.pop()
+        for line in lines:
+            self._parse_line(line.strip(), now)
+
+    def finish(self, now=None):
+        """the command exited, parse the rest of the output & end the last phase"""
+        if now is None:
+            now = time.time()
+        self.poll(now)
+        if self._partial:
+            self._parse_line(self._partial.strip(), now)
+            self._partial = ""
+        self._end_phase(now)
+
+    def summary(self):
+        """return a phase durations string for logging"""
+        return ", ".join(["%s %s" % (name, utils.prettyTimeDiff(int(duration)))
+                          for name, duration in self.phases.items()])
+
+    def _parse_line(self, line, now):
+        if not line:
+            return
+        self.recent_lines.append(line)
+        for name, pattern in self._phases:
+            if pattern.search(line):
+                if name != self._current:
+                    self._end_phase(now)
+                    self._current = name
+                    self._current_start = now
+                    log.debug("%s: %s phase started", self._label, name)
+                break
+        match = self._counter_pattern.match(line)
+        if match:
+            self.counters[counter_name(match.group("name"))] = int(match.group("value"))
+
+    def _end_phase(self, now):
+        if self._current is None:
+            return
+        duration = now - self._current_start
+        # a phase can come up again (for example the importer is used by the router)
+        self.phases[self._current] = self.phases.get(self._current, 0) + duration
+        log.debug("%s: %s phase ended after %1.1f s", self._label, self._current, duration)
+        self._current = None
+        self._current_start = None
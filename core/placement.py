@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - CPU & NUMA placement of processing runs
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import os
+import glob
+import ctypes
+import ctypes.util
+import multiprocessing as mp
+import logging
+log = logging.getLogger("repo.process")
+
+NODE_PATH = "/sys/devices/system/node"
+STATUS_PATH = "/proc/self/status"
+
+
+def parse_cpu_list(cpu_list):
+    """parse a kernel CPU list ("0-3,8,10-11") to a list of CPU numbers"""
+    cpus = []
+    for part in cpu_list.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpu_list(cpus):
+    """format CPU numbers to a kernel CPU list"""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join([str(a) if a == b else "%d-%d" % (a, b) for a, b in ranges])
+
+
+def read_allowed_cpus():
+    """return CPUs the update is allowed to run on, None if not known"""
+    try:
+        with open(STATUS_PATH, "r") as f:
+            for line in f:
+                if line.startswith("Cpus_allowed_list:"):
+                    return parse_cpu_list(line.split(":", 1)[1])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def read_numa_nodes():
+    """return a list of CPU lists, one for every NUMA node
+    -> all CPUs in a single node if the topology is not available"""
+    allowed = read_allowed_cpus()
+    nodes = []
+    for node_path in sorted(glob.glob(os.path.join(NODE_PATH, "node[0-9]*"))):
+        try:
+            with open(os.path.join(node_path, "cpulist"), "r") as f:
+                cpus = parse_cpu_list(f.read())
+        except (IOError, ValueError):
+            continue
+        if allowed is not None:
+            cpus = [cpu for cpu in cpus if cpu in allowed]
+        if cpus:
+            nodes.append(cpus)
+    if not nodes:
+        nodes = [allowed or range(mp.cpu_count())]
+    return nodes
+
+
+def _load_sched_setaffinity():
+    """return sched_setaffinity() of the C library, None if not available"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        return libc.sched_setaffinity
+    except (OSError, AttributeError):
+        return None
+
+# resolved once in the parent process - finding the C library runs ldconfig,
+# which must not happen in a child forked to run a command
+_sched_setaffinity = _load_sched_setaffinity()
+
+
+def set_affinity(cpus):
+    """bind the calling process to the given CPUs
+    -> return False if the affinity could not be set
+
+    NOTE: called in the child process before the command is executed,
+    so it only builds the CPU mask & calls into the C library
+    """
+    if _sched_setaffinity is None:
+        return False
+    word_bits = ctypes.sizeof(ctypes.c_ulong) * 8
+    mask = (ctypes.c_ulong * (max(cpus) / word_bits + 1))()
+    for cpu in cpus:
+        mask[cpu / word_bits] |= 1 << (cpu % word_bits)
+    return _sched_setaffinity(0, ctypes.sizeof(mask), mask) == 0
+
+
+class CpuPlacement(object):
+    """Assigns CPU sets to processing runs, preferring a single NUMA node
+
+    Every run gets as many CPUs as it runs threads. The least used CPUs
+    of the node that has the most free capacity for the run are used,
+    so that the run and its memory stay on a single node. Runs with more
+    threads than a node has CPUs get the least used CPUs of the whole host.
+    CPUs are shared when processing is overcommitted - placement never
+    makes a run wait.
+
+    NOTE: CPU usage counts are shared through inheritance, so the placement
+    needs to be created before the processing processes are started
+    """
+
+    def __init__(self, nodes=None):
+        if nodes is None:
+            nodes = read_numa_nodes()
+        if _sched_setaffinity is None:
+            log.warning("sched_setaffinity() is not available, processing runs won't be bound to CPUs")
+        self._nodes = nodes
+        cpus = [cpu for node in nodes for cpu in node]
+        # how many runs use every CPU
+        self._usage = mp.Array('i', max(cpus) + 1)
+
+    @property
+    def nodes(self):
+        return self._nodes
+
+    def allocate(self, threads):
+        """return a (CPU list, node index) tuple for a run with the given
+        number of threads, node index is None if the run spans more nodes"""
+        threads = max(1, threads)
+        with self._usage.get_lock():
+            candidates = [(self._node_cost(node, threads), index)
+                          for index, node in enumerate(self._nodes) if len(node) >= threads]
+            if candidates:
+                cost, index = min(candidates)
+                cpus = self._least_used(self._nodes[index], threads)
+            else:
+                index = None
+                cpus = self._least_used([cpu for node in self._nodes for cpu in node], threads)
+            for cpu in cpus:
+                self._usage[cpu] += 1
+        return cpus, index
+
+    def release(self, cpus):
+        """return CPUs of a finished run"""
+        with self._usage.get_lock():
+            for cpu in cpus:
+                self._usage[cpu] = max(0, self._usage[cpu] - 1)
+
+    def _least_used(self, cpus, count):
+        return sorted(sorted(cpus, key=lambda cpu: self._usage[cpu])[:count])
+
+    def _node_cost(self, node, threads):
+        """runs sharing the least used CPUs of the node, then overall node load"""
+        shared = sum([self._usage[cpu] for cpu in self._least_used(node, threads)])
+        load = sum([self._usage[cpu] for cpu in node]) / float(len(node))
+        return shared, load
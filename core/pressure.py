@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - adaptive concurrency control
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import time
+import logging
+log = logging.getLogger("repo.process")
+
+PRESSURE_PATH = "/proc/pressure/%s"
+MEMINFO_PATH = "/proc/meminfo"
+
+# how often should the controller make a decision (in seconds)
+CONTROL_INTERVAL = 30
+# pressure stall thresholds (% of time in the last 10 seconds some task was stalled)
+# - above any of these, concurrency is decreased
+CPU_PRESSURE_HIGH = 80.0
+MEMORY_PRESSURE_HIGH = 10.0
+IO_PRESSURE_HIGH = 40.0
+# - below all of these, concurrency can be increased
+CPU_PRESSURE_LOW = 40.0
+MEMORY_PRESSURE_LOW = 1.0
+IO_PRESSURE_LOW = 10.0
+# available memory thresholds (fraction of total memory)
+MEMORY_AVAILABLE_LOW = 0.1
+MEMORY_AVAILABLE_HIGH = 0.25
+
+
+def read_pressure(resource):
+    """return the 10 second average of the "some" pressure stall
+    information for a resource (cpu, memory or io) in %
+    -> None if pressure stall information is not available"""
+    try:
+        f = open(PRESSURE_PATH % resource, "r")
+        try:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == "some":
+                    return float(fields[1].split("=")[1])
+        finally:
+            f.close()
+    except (IOError, IndexError, ValueError):
+        pass
+    return None
+
+
+def read_available_memory():
+    """return a (available, total) memory tuple in bytes
+    -> None if the information is not available"""
+    values = {}
+    try:
+        f = open(MEMINFO_PATH, "r")
+        try:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2:
+                    values[fields[0].rstrip(":")] = int(fields[1]) * 1024
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+    if "MemAvailable" in values and "MemTotal" in values:
+        return values["MemAvailable"], values["MemTotal"]
+    return None
+
+
+class ConcurrencyController(object):
+    """Adjusts how many processing tasks can run at once
+    according to the load of the whole host
+
+    The host might run other workloads, so the controller periodically
+    samples pressure stall information and available memory and moves
+    the concurrency limit between the given bounds:
+    - one step down if the host is under pressure
+    - one step up if the host is idle enough and all the currently
+      allowed tasks are running
+    - otherwise the limit stays the same
+    Running tasks are never stopped, a lower limit just means no new
+    tasks are started until enough of them finish.
+    """
+
+    def __init__(self, minimum, maximum, interval=CONTROL_INTERVAL):
+        self._minimum = max(1, minimum)
+        self._maximum = max(self._minimum, maximum)
+        self._interval = interval
+        # start with the minimum & add tasks while the host can take them
+        self._limit = self._minimum
+        self._last_decision = time.time()
+
+    @property
+    def limit(self):
+        return self._limit
+
+    def update(self, running):
+        """make a new decision if the control interval passed
+
+        :param int running: how many tasks are currently running
+        :returns: the current concurrency limit
+        """
+        now = time.time()
+        if now - self._last_decision < self._interval:
+            return self._limit
+        self._last_decision = now
+        cpu = read_pressure("cpu")
+        memory = read_pressure("memory")
+        io = read_pressure("io")
+        available_memory = read_available_memory()
+        if available_memory:
+            available, total = available_memory
+            available_fraction = available / float(total)
+        else:
+            available_fraction = None
+
+        def over(value, threshold):
+            return value is not None and value > threshold
+
+        def under(value, threshold):
+            return value is None or value < threshold
+
+        if over(cpu, CPU_PRESSURE_HIGH) or over(memory, MEMORY_PRESSURE_HIGH) or \
+                over(io, IO_PRESSURE_HIGH) or \
+                (available_fraction is not None and available_fraction < MEMORY_AVAILABLE_LOW):
+            new_limit = max(self._minimum, self._limit - 1)
+            decision = "host under pressure"
+        elif running >= self._limit and under(cpu, CPU_PRESSURE_LOW) and \
+                under(memory, MEMORY_PRESSURE_LOW) and under(io, IO_PRESSURE_LOW) and \
+                (available_fraction is None or available_fraction > MEMORY_AVAILABLE_HIGH):
+            new_limit = min(self._maximum, self._limit + 1)
+            decision = "host has spare capacity"
+        else:
+            new_limit = self._limit
+            decision = "holding"
+
+        message = "concurrency %d -> %d (%s): cpu %s, memory %s, io %s pressure, %s memory available, %d running" % (
+            self._limit, new_limit, decision, _percent(cpu), _percent(memory), _percent(io),
+            _percent(available_fraction and available_fraction * 100), running
+        )
+        log.info(message)
+        self._limit = new_limit
+        return self._limit
+
+
+def _percent(value):
+    if value is None:
+        return "n/a"
+    else:
+        return "%.1f%%" % value
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - background removal of temporary data
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import os
+import time
+import errno
+import shutil
+import itertools
+import subprocess
+import multiprocessing as mp
+from distutils.spawn import find_executable
+import logging
+log = logging.getLogger("repo.reaper")
+
+from . import utils
+
+TRASH_FOLDER = ".trash"
+# how often the reaper checks the trash folder (in seconds)
+REAPER_POLL_INTERVAL = 2
+# the trash is emptied with idle I/O priority, so that deleting big
+# scratch trees does not slow down the rest of the update
+DELETE_COMMAND = ["ionice", "-c3", "rm", "-rf"]
+
+_trash_counter = itertools.count()
+
+
+class Reaper(object):
+    """Removes temporary folders in the background
+
+    Folders are disposed of by renaming them to the trash folder,
+    which is atomic & immediate as long as the trash folder is on the same
+    filesystem. The reaper worker then deletes the trash content with idle
+    I/O priority. The trash folder is the only state, so folders can be disposed
+    of from any process and leftovers of a crashed update are deleted
+    by the next one.
+
+    NOTE: the stop event is shared through inheritance, so the reaper needs
+    to be created before the stage processes are started
+    """
+
+    def __init__(self, trash_path):
+        self._trash_path = trash_path
+        self._stop = mp.Event()
+
+    @property
+    def trash_path(self):
+        return self._trash_path
+
+    def __getstate__(self):
+        # only the trash folder is needed to dispose of folders
+        # (packages holding the reaper are pickled)
+        state = self.__dict__.copy()
+        state['_stop'] = None
+        return state
+
+    def dispose(self, path):
+        """move the folder to the trash, to be deleted in the background
+        -> folders on other filesystems are deleted right away"""
+        utils.createFolderPath(self._trash_path)
+        name = "%s.%d.%d.%d" % (os.path.basename(path.rstrip(os.sep)), os.getpid(),
+                                int(time.time()), next(_trash_counter))
+        try:
+            os.rename(path, os.path.join(self._trash_path, name))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            elif e.errno == errno.EXDEV:
+                shutil.rmtree(path)
+            else:
+                raise
+
+    def sweep(self, folder, keep):
+        """dispose of all sub-folders of the folder not listed in keep
+        -> used at startup to get rid of temporary data of crashed updates
+
+        :param str folder: folder to sweep
+        :param keep: names of sub-folders that are still in use
+        :returns: number of disposed folders
+        """
+        if not os.path.isdir(folder):
+            return 0
+        count = 0
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if name in keep or not os.path.isdir(path) or \
+                    os.path.abspath(path) == os.path.abspath(self._trash_path):
+                continue
+            log.info("disposing of stale temporary data: %s", path)
+            self.dispose(path)
+            count += 1
+        return count
+
+    def run(self):
+        """delete the trash content until stopped, then empty the trash"""
+        log.info("reaper starting")
+        while not self._stop.is_set():
+            self.empty_trash()
+            self._stop.wait(REAPER_POLL_INTERVAL)
+        self.empty_trash()
+        log.info("reaper shutting down")
+
+    def stop(self):
+        """let the reaper worker finish once the trash is empty"""
+        self._stop.set()
+
+    def empty_trash(self):
+        """delete everything in the trash folder"""
+        if not os.path.isdir(self._trash_path):
+            return
+        for name in os.listdir(self._trash_path):
+            path = os.path.join(self._trash_path, name)
+            start = time.time()
+            try:
+                _delete(path)
+            except Exception:
+                log.exception("deleting %s failed", path)
+                continue
+            log.debug("deleted %s in %1.1f s", path, time.time() - start)
+
+
+def _delete(path):
+    """delete a file or folder with idle I/O priority if possible"""
+    if find_executable(DELETE_COMMAND[0]):
+        if subprocess.call(DELETE_COMMAND + [path]) == 0 and not os.path.lexists(path):
+            return
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
@@ -21,9 +21,31 @@
 #---------------------------------------------------------------------------
 
 import multiprocessing as mp
+import Queue
+import collections
 import os
+import shutil
+import time
 import logging
 log = logging.getLogger("repo")
+process_log = logging.getLogger("repo.process")
+
+from . import budget
+from . import source
+from . import placement
+from . import simulate
+from . import build_cache
+from . import engine
+from . import distributed
+from . import history
+from . import journal
+from . import retry
+from . import containment
+from . import reaper
+from . import watchdog
+from . import pressure
+from . import schedule
+from . import utils
 
 # pool & queue sizes
 CPU_COUNT = mp.cpu_count()
@@ -33,8 +55,27 @@ PROCESSING_POOL_SIZE = CPU_COUNT
 PACKAGING_QUEUE_SIZE = QUEUE_SIZE
 PACKAGING_POOL_SIZE = CPU_COUNT
 PUBLISHING_QUEUE_SIZE = QUEUE_SIZE
+# source data size (in MB) below which packages take the fused processing path
+FUSION_THRESHOLD = 16
 # keywords
 SHUTDOWN_SIGNAL = "shutdown"
+# pipeline stages
+STAGE_LOADING = "loading"
+STAGE_PROCESSING = "processing"
+STAGE_PACKAGING = "packaging"
+STAGE_PUBLISHING = "publishing"
+# packages below the fusion threshold are processed, packaged
+# & published by a single processing task
+FUSED_TASK = "fused"
+# processing paths
+PATH_FUSED = "fused"
+PATH_STAGED = "staged"
+# how often (in seconds) should the task scheduler
+# check for new packages and finished tasks
+SCHEDULER_POLL_INTERVAL = 1
+# how long (in seconds) to wait for failures reported by the stages
+# to arrive through the failure queue once the update is done
+FAILURE_REPORT_TIMEOUT = 60
 # folders
 TEMP_PATH = "temp"
 RESULTS_PATH = "results"
@@ -46,21 +87,183 @@ GEOFABRIK_URL = 1
 DATA_SOURCE_FOLDER = "folder"
 DATA_SOURCE_DOWNLOAD = "download"
 DEFAULT_DATA_SOURCE = DATA_SOURCE_DOWNLOAD
+# package history folder
+HISTORY_PATH = "history"
+
+
+class Task(object):
+    """A single unit of package processing work
+
+    A package is processed by one or more tasks (for example one for every
+    routing profile). Tasks of all packages share the processing pool, so tasks
+    of different packages can run at the same time on any of the processing processes.
+    """
+
+    def __init__(self, task_id, package, name, memory_breaches=0):
+        self.id = task_id
+        self.package = package
+        self.name = name
+        # how many times the task breached its memory ceiling,
+        # the task runs alone with more headroom once it did
+        self.memory_breaches = memory_breaches
+
+    @property
+    def label(self):
+        return "%s/%s" % (self.package.name, self.name)
+
+
+class _PackageTasks(object):
+    """processing tasks state of a single package in the task scheduler"""
+
+    def __init__(self, package, task_names, concurrency, fused=False):
+        self.package = package
+        # a single task processes, packages & publishes the package
+        self.fused = fused
+        self.waiting = collections.deque(task_names)
+        self.running = 0
+        # tasks waiting for another attempt
+        self.retrying = 0
+        self.concurrency = max(1, concurrency)
+        # task name -> attempts made
+        self.attempts = {}
+        # failure reasons of tasks that ran out of attempts
+        self.failed = []
+        # task name -> how many times the task breached its memory ceiling
+        self.memory_breaches = {}
+        self.processing_time = 0
+        # tasks with results taken from the build cache
+        self.cached = []
+        self.priority = package.priority
+        # when was the package taken by the task scheduler
+        self.admitted = time.time()
+
+    @property
+    def can_start(self):
+        return self.waiting and self.running < self.concurrency
+
+    @property
+    def done(self):
+        return not self.waiting and not self.running and not self.retrying
 
 
 class Repository(object):
-    def __init__(self, manager):
+    def __init__(self, manager, budgets=None, source_loader=None, dry_run=False):
+        """
+        :param manager: the repository manager
+        :param budgets: budgets shared with other repositories updated at once,
+                        None = the repository gets budgets of its own
+        :param source_loader: loader sharing source data with other repositories
+                              updated at once, None = the repository gets a loader of its own
+        :param dry_run: the repository is only used to read its configuration & history
+                        (simulations), nothing that changes the system is set up - no memory
+                        cgroup, CPU placement, scratch tier, caches, reaper or journal
+        """
         self._manager = manager
+        self._dry_run = dry_run
+        # runs the stage workers as processes or threads
+        self._engine = engine.create_engine(manager.engine, manager.packaging_pool_size)
 
-        # the source queue is fed by the data loader
-        self._source_queue = mp.JoinableQueue(manager.source_queue_size)
+        # the source queue is fed by the data loader,
+        # priority packages skip the queue in a separate lane
+        self._source_queue = schedule.LaneQueue(self._engine, manager.source_queue_size)
+        # the task queue is fed by the task scheduler, that splits
+        # packages from the source queue to processing tasks
+        self._task_queue = self._engine.joinable_queue()
+        # the processing processes report finished tasks
+        # back to the scheduler through the result queue
+        self._result_queue = self._engine.queue()
+        # all stages report packages that failed through the failure queue
+        self._failure_queue = self._engine.queue()
+        # how many failures have been put to the failure queue
+        self._failure_count = mp.Value('L', 0)
+        # failed packages, gathered once the update is done
+        self._failures = []
+        # how many packages took the fused & staged processing paths
+        self._path_counters = {
+            PATH_FUSED: mp.Value('L', 0),
+            PATH_STAGED: mp.Value('L', 0)
+        }
+        # loading & processing retries, each used only by the corresponding stage process
+        self._load_retries = retry.RetryQueue(manager.max_attempts, manager.retry_delay)
+        self._task_retries = retry.RetryQueue(manager.max_attempts, manager.retry_delay)
         # the packaging queue is fed by the processing processes
-        self._packaging_queue = mp.JoinableQueue(manager.packaging_queue_size)
+        self._packaging_queue = self._engine.joinable_queue(manager.packaging_queue_size)
         # the publishing queue is fed by the packaging processes
-        self._publish_queue = mp.JoinableQueue(manager.publish_queue_size)
+        self._publish_queue = self._engine.joinable_queue(manager.publish_queue_size)
+
+        if budgets is None and dry_run:
+            budgets = budget.Budgets(
+                budget.memory_budget(manager.memory_budget),
+                budget.disk_budget(manager.disk_budget),
+                budget.processing_budget(None)
+            )
+        elif budgets is None:
+            budgets = budget.Budgets(
+                budget.memory_budget(manager.memory_budget),
+                budget.disk_budget(manager.disk_budget),
+                # the processing pool size limits the repository on its own
+                budget.processing_budget(None),
+                placement.CpuPlacement() if manager.cpu_placement else None,
+                containment.prepare_cgroup() if manager.memory_limit else None,
+                budget.scratch_budget(manager.scratch_budget) if manager.scratch_path else None
+            )
+        # RAM budget for package processing, shared by all processing processes
+        self._memory_budget = budgets.memory.for_owner(self.folder_name)
+        # temporary folder disk space budget, reserved by the loader
+        # and released once package temporary data is removed
+        self._disk_budget = budgets.disk.for_owner(self.folder_name)
+        # processing slots, shared with other repositories updated at once
+        self._processing_budget = budgets.processing.for_owner(self.folder_name)
+        # RAM backed scratch tier for processing scratch data of packages that fit,
+        # the scheduler places packages & the space is returned once they are packaged
+        self._scratch_budget = None
+        self._scratch_tier_path = None
+        if budgets.scratch is not None and budgets.scratch.enabled:
+            self._scratch_budget = budgets.scratch.for_owner(self.folder_name)
+            self._scratch_tier_path = os.path.join(manager.scratch_path, self.folder_name)
+        # assigns CPU sets to processing runs (None if disabled)
+        self._cpu_placement = budgets.placement
+        # cgroup v2 group for memory ceilings of processing runs,
+        # None = use RLIMIT_AS (if memory ceilings are enabled)
+        self._memory_cgroup = budgets.memory_cgroup
+
+        if source_loader is None:
+            source_loader = source.SharedSourceLoader(
+                os.path.join(manager.temp_path, source.SOURCE_STORE_FOLDER), [self.folder_name])
+        # downloads every source data file once for all repositories using it
+        self._source_loader = source_loader
+
+        # results of past updates, used for scheduling
+        self._history = history.PackageHistory(self.history_path)
+
+        # fingerprints of source data of published packages
+        self._fingerprints = history.JSONStore(self.fingerprints_path)
+        # cache of build results from previous updates
+        self._build_cache = None
+        if manager.build_cache_path and not dry_run:
+            cache_size = manager.build_cache_size
+            if cache_size is not None:
+                cache_size *= 2 ** 20
+            self._build_cache = build_cache.BuildCache(
+                os.path.join(manager.build_cache_path, self.folder_name), cache_size)
+        # removes temporary data of finished packages in the background
+        self._reaper = None
+        # package state transitions, for resuming interrupted updates
+        self._journal = None
+        if not dry_run:
+            self._reaper = reaper.Reaper(os.path.join(self.temp_path, reaper.TRASH_FOLDER))
+            self._journal = journal.UpdateJournal(os.path.join(self.temp_path, journal.JOURNAL_FILENAME))
+        # package states from an interrupted update (when resuming)
+        self._resume_states = {}
+        # package priorities from the source data catalog, by source (URL, etc.)
+        self._source_priorities = {}
+        # priorities of the scheduled packages, by package id
+        self._priorities = {}
 
         # loads data for processing
         self._loading_process = None
+        # schedules processing tasks
+        self._scheduling_process = None
         # publishes packages to online repository
         self._publishing_process = None
 
@@ -86,6 +289,56 @@ class Repository(object):
     def publish_queue(self):
         return self._publish_queue
 
+    @property
+    def engine(self):
+        return self._engine
+
+    @property
+    def memory_budget(self):
+        return self._memory_budget
+
+    @property
+    def cpu_placement(self):
+        return self._cpu_placement
+
+    def create_memory_ceiling(self, estimate, breaches=0):
+        """return a memory ceiling for a processing run with the given peak
+        memory estimate or None if memory ceilings are disabled
+        -> the ceiling doubles with every breach of the run"""
+        if not self.manager.memory_limit or not estimate:
+            return None
+        return containment.create_ceiling(containment.memory_ceiling(estimate, breaches),
+                                          self._memory_cgroup)
+
+    @property
+    def disk_budget(self):
+        return self._disk_budget
+
+    @property
+    def source_loader(self):
+        return self._source_loader
+
+    @property
+    def history(self):
+        return self._history
+
+    @property
+    def fingerprints(self):
+        return self._fingerprints
+
+    @property
+    def reaper(self):
+        return self._reaper
+
+    @property
+    def build_cache(self):
+        """return the build cache or None if build caching is disabled"""
+        return self._build_cache
+
+    @property
+    def journal(self):
+        return self._journal
+
     @property
     def loading_process(self):
         return self._loading_process
@@ -103,24 +356,59 @@ class Repository(object):
         if self._pre_update() == False:
             log.error('repository pre-update failed')
             return False
+        if self.manager.resume:
+            self._resume_states = self.journal.load()
+            log.info('%s: resuming interrupted update, %d packages in journal',
+                     self.name, len(self._resume_states))
+        else:
+            self.journal.reset()
             # start the loading process
         tempPath = self.temp_path
-        self._loading_process = mp.Process(target=self._load_data)
-        self._loading_process.daemon = True
+        # temporary data of packages an interrupted update can't continue with
+        # (or of all packages when not resuming) are left by crashed updates
+        keep = set([package_id.replace(os.sep, ".") for package_id in self._resume_states])
+        # worker agents might share the temporary folder
+        keep.add(distributed.REMOTE_SOURCE_FOLDER)
+        if os.path.isdir(tempPath):
+            keep.update([name for name in os.listdir(tempPath)
+                         if name.startswith(distributed.WORKER_FOLDER_PREFIX)])
+        stale = self._reaper.sweep(tempPath, keep)
+        if stale:
+            log.info('%s: %d stale temporary folders moved to the trash', self.name, stale)
+        if self._scratch_tier_path and os.path.isdir(self._scratch_tier_path) and os.listdir(self._scratch_tier_path):
+            # scratch data of an interrupted update are not reused,
+            # the packages are processed again
+            log.info('%s: removing scratch tier leftovers in %s', self.name, self._scratch_tier_path)
+            shutil.rmtree(self._scratch_tier_path)
+        update_start = int(time.time())
+        self._engine.start()
+        # the trash is emptied in the background for the whole update
+        reaper_process = self._engine.worker(self._reaper.run, daemon=True)
+        reaper_process.start()
+        self._loading_process = self._engine.worker(self._load_data, daemon=True)
         self._loading_process.start()
-        # start the processing processes
-        for i in range(self.processing_pool_size):
-            p = mp.Process(target=self._process_package)
-            p.daemon = False
-            p.start()
+        # start the task scheduler
+        self._scheduling_process = self._engine.worker(self._schedule_tasks, daemon=False)
+        self._scheduling_process.start()
+        coordinator_address = self.manager.coordinator_address
+        if coordinator_address:
+            # lease processing tasks to remote workers
+            coordinator = distributed.Coordinator(
+                self, self._task_queue, self._result_queue, SHUTDOWN_SIGNAL,
+                self.processing_pool_size, coordinator_address, self.manager.lease_timeout
+            )
+            self._engine.worker(coordinator.run, daemon=False).start()
+        else:
+            # start the processing processes
+            for i in range(self.processing_pool_size):
+                p = self._engine.worker(self._process_tasks, daemon=False)
+                p.start()
             # start the packaging processes
         for i in range(self.packaging_pool_size):
-            p = mp.Process(target=self._package_package)
-            p.daemon = True
+            p = self._engine.worker(self._package_package, daemon=True)
             p.start()
             # start the publishing process
-        self._publishing_process = mp.Process(target=self._publish_package)
-        self._publishing_process.daemon = True
+        self._publishing_process = self._engine.worker(self._publish_package, daemon=True)
         self._publishing_process.start()
 
         # start a method that first joins the first process, once it stops it joins
@@ -128,6 +416,13 @@ class Repository(object):
         # worker processes corresponding to the given Queue
         # -> this shut shut-down the whole operation in sequence on the individual stages dry up
         self._terminate_once_done()
+        self._engine.stop()
+        self._reaper.stop()
+        reaper_process.join()
+        self._log_failure_report()
+        self._log_placement_report(update_start)
+        log.info('## %s: %d packages fused, %d staged', self.name,
+                 self._path_counters[PATH_FUSED].value, self._path_counters[PATH_STAGED].value)
 
         # run post-update
         if self._post_update() == False:
@@ -141,9 +436,14 @@ class Repository(object):
         # first wait fo the loader to finish
         self.loading_process.join()
 
+        # the task scheduler is the only consumer of the source queue,
+        # it shuts down the processing pool once all the tasks are done
+        self.source_queue.join()
+        self.source_queue.put(SHUTDOWN_SIGNAL)
+        self._scheduling_process.join()
+
         # then shut down all the stages in sequence as they run out of work
         stages = [
-            (self.source_queue, self.processing_pool_size),
             (self.packaging_queue, self.packaging_pool_size),
             (self.publish_queue, 1)
         ]
@@ -159,7 +459,9 @@ class Repository(object):
 
     @property
     def processing_pool_size(self):
-        """returns the number of threads to start in the data processing pool
+        """returns the number of processes to start in the data processing pool
+        -> this is also the maximum number of processing tasks running at once,
+        with adaptive concurrency the actual number changes with host load
         NOTE: this number should not change once the processing threads are started,
         as it might prevent a clean shutdown"""
         return self._manager.processing_pool_size
@@ -171,6 +473,10 @@ class Repository(object):
         as it might prevent a clean shutdown"""
         return self._manager.packaging_pool_size
 
+    def log_settings(self):
+        """log repository specific settings before the update starts"""
+        pass
+
     def _pre_update(self):
         """this method is called before starting the repository update"""
         pass
@@ -183,15 +489,608 @@ class Repository(object):
     def _load_data(self):
         pass
 
-    def _process_package(self):
+    def _schedule_tasks(self):
+        """split packages from the source queue to processing tasks,
+        run the tasks on the processing pool and forward packages
+        to the packaging pool once all their tasks are done
+
+        Tasks are only submitted when there is an idle processing process,
+        so a new package is only taken from the source queue once there is
+        nothing else to run. This keeps the packages in the order
+        they have been loaded and leaves the source queue backpressure intact.
+        Priority packages are the exception - they are taken from their lane
+        of the source queue right away and their tasks go first.
+        """
+        packages = collections.OrderedDict()
+        tasks = {}
+        task_id = 0
+        in_flight = 0
+        # a task retried after a memory ceiling breach is running alone
+        isolated_running = False
+        loading_done = False
+        if self.manager.adaptive_concurrency:
+            controller = pressure.ConcurrencyController(self.manager.min_processing_pool_size,
+                                                        self.processing_pool_size)
+            process_log.info('adaptive concurrency enabled, %d to %d tasks at once',
+                             self.manager.min_processing_pool_size, self.processing_pool_size)
+        else:
+            controller = None
+        limit = self.processing_pool_size
+        while not loading_done or packages:
+            if controller:
+                limit = controller.update(in_flight)
+            # failed tasks whose retry delay passed can run again
+            for key, task_name in self._task_retries.pop_ready():
+                state = packages[key]
+                state.retrying -= 1
+                state.waiting.append(task_name)
+            # priority packages don't wait for the scheduler to run out of work
+            while not loading_done:
+                try:
+                    self._admit_package(packages, self.source_queue.get_priority_nowait())
+                    self.source_queue.task_done()
+                except Queue.Empty:
+                    break
+            # submit tasks while there are idle processing processes
+            out_of_tasks = False
+            while in_flight < limit and not isolated_running:
+                state = self._next_task_package(packages)
+                if state is None:
+                    out_of_tasks = True
+                    break
+                breaches = state.memory_breaches.get(state.waiting[0], 0)
+                if breaches and in_flight:
+                    # wait for the running tasks to finish so that the task can run alone
+                    break
+                # other repositories updated at once might use all the processing slots
+                if self._processing_budget.reserve(1, block=False) is None:
+                    break
+                task = Task(task_id, state.package, state.waiting.popleft(), breaches)
+                task_id += 1
+                tasks[task.id] = task
+                state.running += 1
+                in_flight += 1
+                if breaches:
+                    isolated_running = True
+                    process_log.info('running task %s alone after %d memory ceiling breaches',
+                                     task.label, breaches)
+                self._task_queue.put(task)
+
+            # there is nothing to run on the idle processing processes,
+            # so take a new package from the source queue
+            # (not while a task runs alone or the processing slots are used
+            # by other repositories - the package would just wait here)
+            if not loading_done and in_flight < limit and out_of_tasks:
+                try:
+                    package = self.source_queue.get(timeout=SCHEDULER_POLL_INTERVAL)
+                    self.source_queue.task_done()
+                    if package == SHUTDOWN_SIGNAL:
+                        loading_done = True
+                    else:
+                        self._admit_package(packages, package)
+                except Queue.Empty:
+                    pass
+                timeout = 0
+            else:
+                timeout = SCHEDULER_POLL_INTERVAL
+
+            # check for finished tasks
+            try:
+                if timeout:
+                    finished_id, success, cached, dt, reason = self._result_queue.get(timeout=timeout)
+                else:
+                    finished_id, success, cached, dt, reason = self._result_queue.get_nowait()
+            except Queue.Empty:
+                continue
+            in_flight -= 1
+            self._processing_budget.release(1)
+            task = tasks.pop(finished_id)
+            if task.memory_breaches:
+                isolated_running = False
+            key = id(task.package)
+            state = packages[key]
+            state.running -= 1
+            if cached:
+                # no processing has run, so there is no processing time to count
+                state.cached.append(task.name)
+            else:
+                state.processing_time += dt
+            if not success:
+                if reason and reason.startswith(containment.MEMORY_LIMIT):
+                    state.memory_breaches[task.name] = task.memory_breaches + 1
+                attempts = state.attempts.get(task.name, 0) + 1
+                state.attempts[task.name] = attempts
+                delay = self._task_retries.schedule((key, task.name), attempts)
+                if delay is None:
+                    state.failed.append("%s: %s" % (task.name, reason))
+                else:
+                    state.retrying += 1
+                    process_log.warning('task %s failed (%s), attempt %d/%d, retrying in %d s',
+                                        task.label, reason, attempts, self._task_retries.max_attempts, delay)
+            if state.done:
+                del packages[key]
+                self._tasks_done(state)
+
+        # all packages are processed, shut down the processing pool
+        for i in range(self.processing_pool_size):
+            self._task_queue.put(SHUTDOWN_SIGNAL)
+        self._task_queue.join()
+        process_log.info('task scheduler shutting down')
+
+    def _admit_package(self, packages, package):
+        """split a package taken from the source queue to processing tasks"""
+        if package.priority > schedule.PRIORITY_NORMAL:
+            process_log.info('%s: priority %d package %s', self.name, package.priority, package.name)
+        # all tasks of the package use the same scratch folder
+        self._place_scratch(package)
+        if self._should_fuse(package):
+            packages[id(package)] = _PackageTasks(package, [FUSED_TASK], 1, fused=True)
+        else:
+            packages[id(package)] = _PackageTasks(
+                package, package.get_tasks(),
+                self._get_task_concurrency(package)
+            )
+
+    def _next_task_package(self, packages):
+        """return state of the package with the highest priority
+        that has a task that can be started or None
+        -> priority grows the longer the package waits, so that low priority
+        packages are not starved, the first loaded package goes first
+        within the same priority"""
+        now = time.time()
+        best = None
+        best_priority = None
+        for state in packages.values():
+            if state.can_start:
+                priority = schedule.effective_priority(state.priority, now - state.admitted)
+                if (best is None or priority > best_priority or
+                        (priority == best_priority and state.admitted < best.admitted)):
+                    best = state
+                    best_priority = priority
+        return best
+
+    def _tasks_done(self, state):
+        """all tasks of a package are done, forward it to the packaging pool"""
+        package = state.package
+        package._addProcessingTime(state.processing_time)
+        package.cached_tasks = state.cached
+        package.attempts = max(state.attempts.values() or [1])
+        if state.failed:
+            # failed packages skip packaging & publishing
+            package.fail(STAGE_PROCESSING, "; ".join(state.failed))
+            self._report_failure(package)
+        elif state.fused:
+            # already packaged & published by the fused task
+            self._count_path(PATH_FUSED)
+        else:
+            self._record_state(package, journal.PROCESSED)
+            self._count_path(PATH_STAGED)
+            self.packaging_queue.put(package)
+
+    def _process_tasks(self):
+        """run processing tasks from the task queue"""
+        while True:
+            task = self._task_queue.get()
+            if task == SHUTDOWN_SIGNAL:
+                self._task_queue.task_done()
+                break
+            start = time.time()
+            reason = None
+            cached = False
+            try:
+                if task.name == FUSED_TASK:
+                    success = self._run_fused_task(task) is not False
+                elif self._get_cached_result(task):
+                    success = cached = True
+                else:
+                    success = self._run_task(task) is not False
+                if not success:
+                    reason = task.package.failure_reason or "task failed"
+            except Exception, e:
+                process_log.exception('task %s failed', task.label)
+                success = False
+                reason = "error: %s" % e
+            self._result_queue.put((task.id, success, cached, time.time() - start, reason))
+            self._task_queue.task_done()
+        process_log.info('processing shutting down')
+
+    def _get_task_concurrency(self, package):
+        """return how many tasks of the package can run at once"""
+        return len(package.get_tasks())
+
+    def _run_task(self, task):
+        """run a single processing task, return False if the task failed"""
+        return task.package.process()
+
+    def _get_cached_result(self, task):
+        """check if the result of the task is available without running it
+        -> return True if the task is done"""
+        return False
+
+    def _get_remote_result_path(self, task):
+        """return where to store the result of a task uploaded by a remote worker"""
+        raise NotImplementedError
+
+    def _remote_result_stored(self, task, path):
+        """called once the result of a task from a remote worker is stored"""
         pass
 
+    def run_remote_task(self, lease, source_path, source_folder, temp_path, upload):
+        """run a processing task leased from a coordinator by a worker agent
+
+        :param dict lease: the lease from the coordinator
+        :param str source_path: path to the downloaded source data
+        :param str source_folder: folder with the downloaded source data
+        :param str temp_path: temporary folder of the worker, package temporary
+                              data need to stay inside it
+        :param upload: function uploading a result file to the coordinator
+        :returns: a (success, failure reason) tuple
+        """
+        raise NotImplementedError
+
+    def _should_fuse(self, package):
+        """report if the package is small enough to be processed,
+        packaged & published by a single processing task"""
+        if self.manager.coordinator_address:
+            # remote workers only run single processing tasks
+            return False
+        threshold = self.manager.fusion_threshold
+        return bool(threshold) and package.source_size < threshold * 2 ** 20
+
+    def _run_fused_task(self, task):
+        """run all processing tasks of a small package, then package
+        & publish it right away, without going through the packaging
+        & publishing queues
+        -> return False if processing failed, packaging & publishing
+        failures are reported as for the staged path"""
+        package = task.package
+        package.cached_tasks = []
+        for name in package.get_tasks():
+            single_task = Task(task.id, package, name, task.memory_breaches)
+            if self._get_cached_result(single_task):
+                package.cached_tasks.append(name)
+                continue
+            start = time.time()
+            if self._run_task(single_task) is False:
+                return False
+            package._addProcessingTime(time.time() - start)
+        self._record_state(package, journal.PROCESSED)
+        if self._package_single(package):
+            self._publish_single(package)
+        return True
+
+    def _package_single(self, package):
+        """package a single package, return False if packaging failed"""
+        success = package.package()
+        if success:
+            # the results are out of the scratch data
+            self._release_scratch(package)
+        return success
+
+    def _publish_single(self, package):
+        """publish a single package, return False if publishing failed"""
+        return package.publish(self.publish_path)
+
+    def _count_path(self, path):
+        counter = self._path_counters[path]
+        with counter.get_lock():
+            counter.value += 1
+
+    def _get_processing_timeout(self, package):
+        """return run time limit (in seconds) of a single processing run for the package,
+        scaled with the source data size, None if run time is not limited"""
+        timeout_per_gb = self.manager.processing_timeout
+        if not timeout_per_gb:
+            return None
+        return int(watchdog.TIMEOUT_BASE + timeout_per_gb * package.source_size / float(2 ** 30))
+
     def _package_package(self):
         pass
 
     def _publish_package(self):
         pass
 
+    def _schedule_work(self, items):
+        """order source data work items according to the current scheduling policy"""
+        policy = self.manager.schedule
+        ordered = schedule.order_work(items, policy, self.history)
+        if policy == schedule.SCHEDULE_LPT:
+            predicted = int(schedule.total_predicted_time(ordered))
+            log.info("%s: %d packages scheduled longest first, predicted processing time: %s",
+                     self.name, len(ordered), utils.prettyTimeDiff(predicted))
+        else:
+            log.info("%s: %d packages scheduled (%s)", self.name, len(ordered), policy)
+        # priority packages are loaded first
+        for item in ordered:
+            item.priority = self._get_priority(item.key, item.source)
+            self._priorities[item.key] = item.priority
+        priority_count = len([item for item in ordered if item.priority > schedule.PRIORITY_NORMAL])
+        if priority_count:
+            log.info("%s: %d priority packages", self.name, priority_count)
+            ordered = schedule.order_by_priority(ordered)
+        return ordered
+
+    def _get_priority(self, package_id, source=None):
+        """return priority class of a package
+        -> the higher of the source data catalog priority & priority regions match"""
+        return max(self._source_priorities.get(source, schedule.PRIORITY_NORMAL),
+                   schedule.match_priority(package_id, self.manager.priority_regions))
+
+    @property
+    def simulation_settings(self):
+        """return repository specific settings used by the simulated packages
+        (by configuration file key)"""
+        return {}
+
+    def simulate(self, candidates):
+        """predict update results for candidate configurations
+        by replaying the packages recorded in the history store
+        :returns: a list of SimulationResult instances
+        """
+        results = []
+        for config in candidates:
+            items = [schedule.WorkItem(p.key, p.size, p) for p in self._get_simulation_packages(config)]
+            ordered = schedule.order_work(items, self.manager.schedule, self.history)
+            results.append(simulate.simulate([item.source for item in ordered], config))
+        return results
+
+    def _get_simulation_packages(self, config):
+        """return SimulatedPackage instances for the packages in the history store"""
+        raise NotImplementedError
+
+    def _record_history(self, package):
+        """record results of package processing for future updates"""
+        processing_time = package.processing_time
+        if package.cached_tasks:
+            # tasks with results from the build cache took no time,
+            # count them with their previously recorded run time instead
+            cached_time = self._get_cached_task_time(package)
+            if cached_time is None:
+                # nothing to go by, keep the previous record
+                return
+            processing_time += cached_time
+        if not processing_time:
+            # not processed during this update (resumed, etc.)
+            return
+        try:
+            values = {}
+            if package.source_scan:
+                values['source_scan'] = package.source_scan.to_dict()
+            self.history.record(package.repo_sub_path,
+                                processing_time=int(processing_time),
+                                packaging_time=int(package.packaging_time),
+                                source_size=package.source_size,
+                                **values)
+        except Exception:
+            log.exception("recording package history failed for %s", package.name)
+
+    def _get_cached_task_time(self, package):
+        """return recorded run time of the package tasks served from the build cache,
+        None if the package has no processing time recorded"""
+        entry = self.history.get(package.repo_sub_path)
+        if not entry or not entry.get('processing_time'):
+            return None
+        # older records only have the combined processing time
+        default_time = float(entry['processing_time']) / len(package.get_tasks())
+        recorded_tasks = entry.get('tasks', {})
+        return sum([recorded_tasks.get(name, {}).get('time', default_time)
+                    for name in package.cached_tasks])
+
+    def _log_placement_report(self, since):
+        """compare processing times with & without CPU placement for packages
+        processed since the given time that have been processed both ways"""
+        self.history.reload()
+        compared = []
+        for key, entry in sorted(self.history.items()):
+            tasks = entry.get('tasks', {}).values()
+            if entry.get('updated', 0) < since or not tasks:
+                continue
+            placed = [task.get('placed_time') for task in tasks]
+            unplaced = [task.get('unplaced_time') for task in tasks]
+            if None in placed or None in unplaced:
+                continue
+            compared.append((key, sum(placed), sum(unplaced)))
+        if not compared:
+            return
+        log.info("## %s: processing time with & without CPU placement:", self.name)
+        for key, placed, unplaced in compared:
+            log.info("# %s: %s placed, %s not placed", key,
+                     utils.prettyTimeDiff(placed), utils.prettyTimeDiff(unplaced))
+        placed_total = sum([c[1] for c in compared])
+        unplaced_total = sum([c[2] for c in compared])
+        log.info("## %s: %d packages, %s placed, %s not placed", self.name, len(compared),
+                 utils.prettyTimeDiff(placed_total), utils.prettyTimeDiff(unplaced_total))
+
+    def _record_task_history(self, package, task_name, **values):
+        """record results of a single processing task for future updates
+        (run time, peak memory usage, etc.)"""
+        try:
+            self.history.record_task(package.repo_sub_path, task_name, **values)
+        except Exception:
+            log.exception("recording task history failed for %s/%s", package.name, task_name)
+
+    def _is_published(self, package_id):
+        """report if all results of the package are present in the repository"""
+        return False
+
+    def _is_unchanged(self, package_id, source_file_path):
+        """report if the source data file did not change since the package
+        was last published (and its results are still in the repository)
+        -> size & modification time are checked first, content hash is only
+        computed if the file has the same size but was modified"""
+        stored = self.fingerprints.get(package_id)
+        if not stored or not self._is_published(package_id):
+            return False
+        fingerprint = utils.fileFingerprint(source_file_path, withHash=False)
+        if fingerprint['size'] != stored.get('size'):
+            return False
+        if fingerprint['mtime'] == stored.get('mtime'):
+            return True
+        if utils.hashFile(source_file_path) == stored.get('sha1'):
+            # same content, just remember the new modification time
+            self.fingerprints.record(package_id, mtime=fingerprint['mtime'])
+            return True
+        return False
+
+    def _record_fingerprint(self, package):
+        """record fingerprint of the source data of a published package"""
+        if package.source_fingerprint is None:
+            return
+        try:
+            self.fingerprints.record(package.id, **package.source_fingerprint)
+        except Exception:
+            log.exception("recording source data fingerprint failed for %s", package.name)
+
+    def _load_package(self, package, *args):
+        """load source data for the package & forward it for processing
+        :returns: True if loading succeeded, False otherwise"""
+        return False
+
+    def _retry_loading(self, package, *args):
+        """schedule another loading attempt for a package that failed to load,
+        the package fails once it runs out of attempts"""
+        # partially loaded data are not reused
+        self._clear_package(package)
+        delay = self._load_retries.schedule((package, args), package.attempts)
+        if delay is None:
+            package.fail(STAGE_LOADING, "loading failed")
+            self._report_failure(package)
+        else:
+            log.warning('%s: loading %s failed, attempt %d/%d, retrying in %d s', self.name,
+                        package.name, package.attempts, self._load_retries.max_attempts, delay)
+
+    def _run_loading_retries(self, block=False):
+        """run loading attempts for packages whose retry delay passed
+        :param bool block: wait for the next retry if none is ready yet
+        """
+        if block:
+            ready = self._load_retries.wait_ready()
+        else:
+            ready = self._load_retries.pop_ready()
+        for package, args in ready:
+            if not self._load_package(package, *args):
+                self._retry_loading(package, *args)
+
+    def _finish_loading_retries(self):
+        """wait for all remaining loading retries"""
+        while len(self._load_retries):
+            self._run_loading_retries(block=True)
+
+    def _report_failure(self, package):
+        """report a failed package & remove its temporary data"""
+        log.error('%s: %s failed during %s: %s', self.name, package.name,
+                  package.failed_stage, package.failure_reason)
+        self._record_state(package, journal.FAILED)
+        with self._failure_count.get_lock():
+            self._failure_count.value += 1
+        self._failure_queue.put((package.id, package.failed_stage, package.failure_reason, package.attempts))
+        self._clear_package(package)
+
+    def _log_failure_report(self):
+        """gather failures reported by all the stages & log a summary"""
+        # the stages have run out of work, but failures put to the queue
+        # just before that might still be on the way -> wait for all of them
+        deadline = time.time() + FAILURE_REPORT_TIMEOUT
+        while len(self._failures) < self._failure_count.value:
+            try:
+                timeout = max(0, deadline - time.time())
+                self._failures.append(self._failure_queue.get(timeout=timeout))
+            except Queue.Empty:
+                log.error("%s: %d reported failures did not arrive", self.name,
+                          self._failure_count.value - len(self._failures))
+                break
+        if self._failures:
+            log.error("## %s: %d packages failed:", self.name, len(self._failures))
+            for package_id, stage, reason, attempts in sorted(self._failures):
+                log.error("# %s - %s failed after %d attempts: %s", package_id, stage, attempts, reason)
+        else:
+            log.info("## %s: no failed packages", self.name)
+
+    @property
+    def failures(self):
+        """return a list of (package id, stage, reason, attempts) tuples
+        for packages that failed during the update"""
+        return self._failures
+
+    def _record_state(self, package, state):
+        """record package state transition to the update journal"""
+        try:
+            self.journal.record(package.id, state)
+        except Exception:
+            log.exception("journal write failed for %s (%s)", package.name, state)
+
+    def _resume_package(self, package):
+        """check if the package can continue from where an interrupted update left it
+
+        Already published packages are skipped and packages with processing or packaging
+        results available are sent directly to the corresponding stage.
+        Temporary data of packages that need to start from scratch are removed.
+
+        :returns: True if the package has been handled, False if it needs to be loaded
+        """
+        state = self._resume_states.get(package.id)
+        if state == journal.PUBLISHED:
+            log.info('%s: %s already published, skipping', self.name, package.name)
+            return True
+        elif state == journal.PACKAGED and package.can_resume(state):
+            log.info('%s: %s already packaged, resuming from publishing', self.name, package.name)
+            self._reserve_disk_space(package)
+            self.publish_queue.put(package)
+            return True
+        elif state == journal.PROCESSED and package.can_resume(state):
+            log.info('%s: %s already processed, resuming from packaging', self.name, package.name)
+            self._reserve_disk_space(package)
+            self.packaging_queue.put(package)
+            return True
+        elif state != journal.LOADED and os.path.exists(package.temp_path):
+            # no usable data from a previous update
+            package.clear_all()
+        return False
+
+    def _reserve_disk_space(self, package, source_size=None, block=True):
+        """reserve space in the temporary folder for the package
+        -> blocks until the package fits into the disk budget"""
+        estimate = package.estimate_disk_usage(source_size)
+        reserved = self.disk_budget.reserve(estimate, block=block, label=package.name)
+        if reserved is not None:
+            package.disk_reservation += reserved
+        return reserved
+
+    def _clear_package(self, package):
+        """remove all temporary data of the package and return
+        its reserved temporary disk space to the disk budget"""
+        try:
+            package.clear_all()
+        finally:
+            self.disk_budget.release(package.disk_reservation)
+            package.disk_reservation = 0
+            self._release_scratch(package)
+
+    def _place_scratch(self, package):
+        """put processing scratch data of the package on the scratch tier
+        if its estimated size fits into the scratch budget right now,
+        the package works in the temporary folder otherwise"""
+        if self._scratch_budget is None:
+            return
+        estimate = package.estimate_scratch_usage()
+        if not estimate or estimate > self._scratch_budget.capacity:
+            return
+        reserved = self._scratch_budget.reserve(estimate, block=False, label=package.name)
+        if reserved is not None:
+            package.place_scratch(self._scratch_tier_path, reserved)
+            process_log.info('%s: %s scratch data on the scratch tier (%s)', self.name, package.name,
+                             utils.bytes2PrettyUnitString(reserved))
+
+    def _release_scratch(self, package):
+        """remove scratch tier data of the package & return its scratch budget reservation
+        -> called once results of the package have been packaged"""
+        try:
+            package.clear_scratch()
+        finally:
+            if self._scratch_budget is not None and package.scratch_reservation:
+                self._scratch_budget.release(package.scratch_reservation)
+            package.scratch_reservation = 0
+
     ## Paths ##
     @property
     def temp_path(self):
@@ -199,6 +1098,19 @@ class Repository(object):
             self._manager.temp_path,
             self.folder_name)
 
+    @property
+    def history_path(self):
+        return os.path.join(
+            self._manager.history_path,
+            "%s.json" % self.folder_name)
+
+    @property
+    def fingerprints_path(self):
+        """source data fingerprints are stored next to the published repository"""
+        return os.path.join(
+            self._manager.repo_path,
+            "%s_fingerprints.json" % self.folder_name)
+
     @property
     def publish_path(self):
         return os.path.join(
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - retry queue
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import heapq
+import time
+
+DEFAULT_MAX_ATTEMPTS = 3
+# delay before the first retry in seconds,
+# it is doubled for every further retry
+DEFAULT_RETRY_DELAY = 60
+
+
+class RetryQueue(object):
+    """Items waiting for another attempt, with exponential backoff
+    between attempts & a limit on the number of attempts
+
+    NOTE: the retry queue is local to the process using it
+    """
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_RETRY_DELAY):
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._heap = []
+        # makes the heap order stable for items ready at the same time
+        self._counter = 0
+
+    @property
+    def max_attempts(self):
+        return self._max_attempts
+
+    def __len__(self):
+        return len(self._heap)
+
+    def get_delay(self, attempts):
+        """return the delay before the next attempt after the given number of attempts"""
+        return self._base_delay * 2 ** max(0, attempts - 1)
+
+    def schedule(self, item, attempts):
+        """schedule another attempt for the item
+
+        :param item: the item to retry
+        :param int attempts: how many attempts have already been made
+        :returns: the retry delay in seconds or None if there are no attempts left
+        """
+        if attempts >= self._max_attempts:
+            return None
+        delay = self.get_delay(attempts)
+        heapq.heappush(self._heap, (time.time() + delay, self._counter, item))
+        self._counter += 1
+        return delay
+
+    def pop_ready(self):
+        """return a list of items whose retry delay already passed"""
+        ready = []
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            ready.append(heapq.heappop(self._heap)[2])
+        return ready
+
+    def wait_ready(self):
+        """wait until the next item is ready & return all ready items"""
+        if not self._heap:
+            return []
+        delay = self._heap[0][0] - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return self.pop_ready()
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - work scheduling policies
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import time
+import Queue
+import fnmatch
+
+# scheduling policies
+# - longest (predicted) processing time first
+SCHEDULE_LPT = "lpt"
+# - smallest source data first
+SCHEDULE_ASCENDING = "ascending"
+# - in the order the source data was listed
+SCHEDULE_FIFO = "fifo"
+SCHEDULES = [SCHEDULE_LPT, SCHEDULE_ASCENDING, SCHEDULE_FIFO]
+DEFAULT_SCHEDULE = SCHEDULE_LPT
+
+
+# package priority classes, higher is more urgent
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 1
+# how long does a package need to wait in the task scheduler
+# to get one priority class higher (in seconds)
+PRIORITY_AGING_INTERVAL = 1800
+# how often to check the priority lane while waiting for a package (in seconds)
+LANE_POLL_INTERVAL = 0.2
+
+
+class WorkItem(object):
+    """A unit of work for the source data loader"""
+
+    def __init__(self, key, size, source):
+        """
+        :param str key: repository sub-path of the resulting package
+        :param size: source data size in bytes or None if not known
+        :param source: the source itself (URL, file path, etc.)
+        """
+        self.key = key
+        self.size = size
+        self.source = source
+        self.predicted_time = None
+        self.priority = PRIORITY_NORMAL
+
+    def __repr__(self):
+        return "WorkItem(%s, %s, %s)" % (self.key, self.size, self.predicted_time)
+
+
+def order_work(items, policy, history=None):
+    """order work items according to the scheduling policy
+
+    With the LPT policy the biggest jobs start first and the small ones
+    then fill the gaps on the remaining cores, which keeps the long tail
+    at the end of the update short.
+
+    :param list items: list of WorkItem instances
+    :param str policy: one of the SCHEDULES
+    :param history: PackageHistory instance used to predict processing time
+    :returns: a new list of ordered WorkItems
+    """
+    if policy == SCHEDULE_FIFO:
+        return list(items)
+    elif policy == SCHEDULE_ASCENDING:
+        # items with unknown size go last
+        known = [i for i in items if i.size is not None]
+        unknown = [i for i in items if i.size is None]
+        known.sort(key=lambda i: i.size)
+        return known + unknown
+    elif policy == SCHEDULE_LPT:
+        for item in items:
+            if history is not None:
+                item.predicted_time = history.predict_processing_time(item.key, item.size)
+            else:
+                item.predicted_time = item.size or 0
+        return sorted(items, key=lambda i: i.predicted_time, reverse=True)
+    else:
+        raise ValueError("unknown scheduling policy: %s" % policy)
+
+
+def order_by_priority(items):
+    """move items with higher priority to the front,
+    keeping the order within a priority class"""
+    return sorted(items, key=lambda i: -i.priority)
+
+
+def match_priority(key, patterns):
+    """return PRIORITY_HIGH if the repository sub-path matches any
+    of the shell-style patterns, PRIORITY_NORMAL otherwise
+    -> "europe/germany/*" matches both europe/germany and its sub-regions"""
+    for pattern in patterns:
+        if fnmatch.fnmatch(key, pattern) or fnmatch.fnmatch(key + "/", pattern):
+            return PRIORITY_HIGH
+    return PRIORITY_NORMAL
+
+
+def effective_priority(priority, waiting_time):
+    """return priority of a package that has been waiting for waiting_time
+    seconds, so that low priority packages don't wait forever"""
+    return priority + int(waiting_time / PRIORITY_AGING_INTERVAL)
+
+
+class LaneQueue(object):
+    """Source queue with a separate lane for priority packages
+
+    Packages with a priority above normal skip the packages already
+    waiting in the normal lane. Every lane is a bounded joinable
+    queue of the pipeline engine, so the backpressure on the loader
+    stays intact. Only one consumer (the task scheduler) can take
+    items from the queue.
+    """
+
+    def __init__(self, engine, maxsize=0):
+        self._priority_lane = engine.joinable_queue(maxsize)
+        self._normal_lane = engine.joinable_queue(maxsize)
+        # the lane the last item was taken from
+        self._last_lane = None
+
+    def put(self, item):
+        if getattr(item, "priority", PRIORITY_NORMAL) > PRIORITY_NORMAL:
+            self._priority_lane.put(item)
+        else:
+            self._normal_lane.put(item)
+
+    def get_priority_nowait(self):
+        """return an item from the priority lane, raise Queue.Empty if there is none"""
+        item = self._priority_lane.get_nowait()
+        self._last_lane = self._priority_lane
+        return item
+
+    def get(self, timeout=None):
+        """return an item, the priority lane goes first
+        -> raise Queue.Empty if there is no item before timeout"""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            try:
+                return self.get_priority_nowait()
+            except Queue.Empty:
+                pass
+            wait = LANE_POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    raise Queue.Empty
+            try:
+                item = self._normal_lane.get(timeout=wait)
+                self._last_lane = self._normal_lane
+                return item
+            except Queue.Empty:
+                pass
+
+    def task_done(self):
+        """mark the last item taken from the queue as done"""
+        self._last_lane.task_done()
+
+    def join(self):
+        self._priority_lane.join()
+        self._normal_lane.join()
+
+
+def total_predicted_time(items):
+    """return predicted processing time of all the items (in seconds)"""
+    return sum([i.predicted_time or 0 for i in items])
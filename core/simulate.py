@@ -0,0 +1,324 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - repository update simulator
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import itertools
+import collections
+import logging
+log = logging.getLogger("repo.simulate")
+
+from . import utils
+
+# settings used by the stage model, repositories can use more settings
+# (by configuration file key) when building the simulated packages
+POOL_SETTINGS = ["processing_pool_size", "packaging_pool_size",
+                 "source_queue_size", "packaging_queue_size", "cpu_count"]
+# budgets in megabytes, None = unlimited
+BUDGET_SETTINGS = ["memory_budget", "disk_budget"]
+
+# run types
+_TASK = 0
+_PACKAGING = 1
+# remaining work (in seconds) below which a run counts as finished
+_EPSILON = 1e-6
+
+
+class SimulatedTask(object):
+    """A processing task of a simulated package"""
+
+    def __init__(self, name, duration, peak_memory, reserved_memory, threads=1):
+        """
+        :param str name: task name
+        :param duration: run time in seconds
+        :param peak_memory: peak RAM usage in bytes
+        :param reserved_memory: how much of the memory budget the task reserves (in bytes)
+        :param threads: how many CPU cores the task keeps busy
+        """
+        self.name = name
+        self.duration = duration
+        self.peak_memory = peak_memory
+        self.reserved_memory = reserved_memory
+        self.threads = threads
+
+
+class SimulatedPackage(object):
+    """A package replayed through the model of the repository stages"""
+
+    def __init__(self, key, size, tasks, concurrency, packaging_time, disk_usage):
+        """
+        :param str key: package repository sub-path
+        :param size: source data size in bytes (used for scheduling)
+        :param tasks: list of SimulatedTask instances
+        :param int concurrency: how many tasks of the package can run at once
+        :param packaging_time: packaging run time in seconds
+        :param disk_usage: temporary folder usage in bytes (reserved by the loader)
+        """
+        self.key = key
+        self.size = size
+        self.tasks = tasks
+        self.concurrency = max(1, concurrency)
+        self.packaging_time = packaging_time
+        self.disk_usage = disk_usage
+
+
+class SimulationResult(object):
+    """Predicted results of an update with a candidate configuration"""
+
+    def __init__(self, config, makespan, peak_memory, peak_disk, idle_core_time):
+        self.config = config
+        self.makespan = makespan
+        self.peak_memory = peak_memory
+        self.peak_disk = peak_disk
+        self.idle_core_time = idle_core_time
+
+    @property
+    def idle_fraction(self):
+        """fraction of the available core time that was idle"""
+        total = self.makespan * self.config['cpu_count']
+        if total:
+            return self.idle_core_time / float(total)
+        else:
+            return 0.0
+
+
+class _Run(object):
+    """A processing task or packaging run in progress"""
+
+    def __init__(self, kind, work, threads, state, data=None):
+        self.kind = kind
+        # remaining run time with all threads on a core of their own (in seconds)
+        self.work = work
+        self.threads = max(1, threads)
+        self.state = state
+        self.data = data
+
+
+class _PackageState(object):
+    def __init__(self, package):
+        self.package = package
+        self.waiting = collections.deque(package.tasks)
+        self.running = 0
+        self.remaining = len(package.tasks)
+        self.disk_reservation = 0
+
+    @property
+    def can_start(self):
+        return self.waiting and self.running < self.package.concurrency
+
+
+def expand_candidates(baseline, sweeps):
+    """return the swept settings & a list of candidate configurations
+
+    :param dict baseline: the current configuration
+    :param sweeps: list of "key=value,value,..." strings, every combination
+                   of the swept values is a candidate, "none" means not set
+    """
+    keys = []
+    values = []
+    for sweep in sweeps:
+        key, sep, value_list = sweep.partition("=")
+        key = key.strip().replace("-", "_")
+        if not sep or key not in baseline:
+            raise ValueError("can't sweep %s, known settings: %s" % (sweep, ", ".join(sorted(baseline))))
+        keys.append(key)
+        values.append([_parse_value(v) for v in value_list.split(",")])
+    candidates = []
+    for combination in itertools.product(*values):
+        config = dict(baseline)
+        config.update(zip(keys, combination))
+        candidates.append(config)
+    return keys, candidates
+
+
+def _parse_value(value):
+    value = value.strip()
+    if value.lower() == "none":
+        return None
+    return int(value)
+
+
+def _megabytes(value):
+    if value is None:
+        return None
+    return value * 2 ** 20
+
+
+def simulate(packages, config):
+    """replay the packages through a model of the repository update stages
+
+    The model follows the real stages: the loader reserves temporary disk space
+    and fills the source queue, the task scheduler starts tasks of the first
+    package that has a task that can run once a processing process is idle,
+    tasks wait for the memory budget in the processing process, finished
+    packages go through the packaging queue to the packaging pool and are
+    published (and their disk space released) right after packaging.
+    Source data loading & publishing are assumed to take no time.
+    Run times are recorded with the run having the CPU cores it needs,
+    once the running tasks & packaging runs need more threads than there
+    are cores, the cores are shared & all the runs slow down evenly.
+
+    :param packages: SimulatedPackage instances in loading order
+    :param dict config: candidate configuration
+    :returns: a SimulationResult
+    """
+    pool_size = max(1, config['processing_pool_size'])
+    packaging_pool_size = max(1, config['packaging_pool_size'])
+    source_queue_size = max(1, config['source_queue_size'])
+    packaging_queue_size = max(1, config['packaging_queue_size'])
+    cores = max(1, config['cpu_count'])
+    memory_budget = _megabytes(config.get('memory_budget'))
+    disk_budget = _megabytes(config.get('disk_budget'))
+
+    to_load = collections.deque(packages)
+    source_queue = collections.deque()
+    # packages taken by the scheduler, in loading order
+    admitted = collections.OrderedDict()
+    # tasks in a processing process, waiting for the memory budget
+    memory_waiting = []
+    packaging_waiting = collections.deque()
+    # processing tasks & packaging runs in progress, in start order
+    running = []
+
+    now = 0.0
+    busy_slots = 0
+    packaging_running = 0
+    memory_reserved = 0
+    memory_used = 0
+    disk_used = 0
+    peak_memory = 0
+    peak_disk = 0
+    idle_core_time = 0.0
+    makespan = 0.0
+
+    def fits(used, amount, budget):
+        return budget is None or used + amount <= budget
+
+    while True:
+        changed = True
+        while changed:
+            changed = False
+            # the loader fills the source queue once the package fits into the disk budget
+            while to_load and len(source_queue) < source_queue_size:
+                package = to_load[0]
+                reservation = package.disk_usage
+                if disk_budget is not None:
+                    reservation = min(reservation, disk_budget)
+                if not fits(disk_used, reservation, disk_budget):
+                    break
+                to_load.popleft()
+                state = _PackageState(package)
+                state.disk_reservation = reservation
+                disk_used += reservation
+                peak_disk = max(peak_disk, disk_used)
+                source_queue.append(state)
+                changed = True
+            # packaging pool
+            while packaging_waiting and packaging_running < packaging_pool_size:
+                state = packaging_waiting.popleft()
+                packaging_running += 1
+                running.append(_Run(_PACKAGING, state.package.packaging_time, 1, state))
+                changed = True
+            # tasks that fit into the memory budget start running
+            for item in list(memory_waiting):
+                state, task, reservation = item
+                if fits(memory_reserved, reservation, memory_budget):
+                    memory_waiting.remove(item)
+                    memory_reserved += reservation
+                    memory_used += task.peak_memory
+                    peak_memory = max(peak_memory, memory_used)
+                    running.append(_Run(_TASK, task.duration, task.threads, state, (task, reservation)))
+                    changed = True
+            # the scheduler is blocked while the packaging queue is full
+            if len(packaging_waiting) >= packaging_queue_size:
+                continue
+            # submit tasks to idle processing processes
+            while busy_slots < pool_size:
+                state = None
+                for candidate in admitted.values():
+                    if candidate.can_start:
+                        state = candidate
+                        break
+                if state is None:
+                    if not source_queue:
+                        break
+                    # nothing to run, take a new package from the source queue
+                    state = source_queue.popleft()
+                    admitted[id(state)] = state
+                    if not state.can_start:
+                        # a package without tasks
+                        del admitted[id(state)]
+                        packaging_waiting.append(state)
+                    changed = True
+                    continue
+                task = state.waiting.popleft()
+                state.running += 1
+                busy_slots += 1
+                reservation = task.reserved_memory
+                if memory_budget is not None:
+                    reservation = min(reservation, memory_budget)
+                memory_waiting.append((state, task, reservation))
+                changed = True
+
+        if not running:
+            break
+        threads = sum([run.threads for run in running])
+        # oversubscribed cores are shared by all the runs
+        speed = min(1.0, cores / float(threads))
+        dt = min([run.work for run in running]) / speed
+        idle_core_time += max(0, cores - threads) * dt
+        now += dt
+        for run in running:
+            run.work -= dt * speed
+        finished = [run for run in running if run.work <= _EPSILON]
+        running = [run for run in running if run.work > _EPSILON]
+        for run in finished:
+            state = run.state
+            if run.kind == _TASK:
+                task, reservation = run.data
+                busy_slots -= 1
+                memory_reserved -= reservation
+                memory_used -= task.peak_memory
+                state.running -= 1
+                state.remaining -= 1
+                if not state.remaining:
+                    del admitted[id(state)]
+                    packaging_waiting.append(state)
+            else:
+                # packaged & published, temporary data is removed
+                packaging_running -= 1
+                disk_used -= state.disk_reservation
+                makespan = now
+
+    if to_load or source_queue or admitted or memory_waiting or packaging_waiting:
+        log.warning("simulation stalled with unfinished packages")
+    return SimulationResult(config, makespan, peak_memory, peak_disk, idle_core_time)
+
+
+def log_results(results, swept_keys):
+    """log simulation results of all candidates, fastest first"""
+    results = sorted(results, key=lambda r: r.makespan)
+    for index, result in enumerate(results):
+        settings = ", ".join(["%s=%s" % (key, result.config[key]) for key in swept_keys]) or "current settings"
+        log.info("%s%s: makespan %s, peak RAM %s, peak temp disk %s, idle core time %s (%.0f%%)",
+                 "* " if index == 0 else "  ", settings,
+                 utils.prettyTimeDiff(int(result.makespan)),
+                 utils.bytes2PrettyUnitString(result.peak_memory),
+                 utils.bytes2PrettyUnitString(result.peak_disk),
+                 utils.prettyTimeDiff(int(result.idle_core_time)), result.idle_fraction * 100)
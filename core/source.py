@@ -0,0 +1,183 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - shared source data loader
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import os
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+log = logging.getLogger("repo.source")
+
+from . import utils
+
+SOURCE_STORE_FOLDER = "sources"
+ENTRY_SUFFIX = ".pbf"
+SUBSCRIPTION_SEPARATOR = ".subscription."
+LOCK_SUFFIX = ".lock"
+
+
+def source_key(source):
+    """return a store key for a source (URL or file path)"""
+    return hashlib.sha1(source).hexdigest()
+
+
+class SourceHandle(object):
+    """Reference to source data held by a single package
+
+    The handle is a hard link to the shared store entry, placed
+    in the package temporary folder. The link count of the store entry
+    is the reference count, so it works across processes and survives
+    a crash of the update.
+    """
+
+    def __init__(self, loader, key, path):
+        self._loader = loader
+        self._key = key
+        self._path = path
+
+    @property
+    def path(self):
+        return self._path
+
+    def release(self):
+        """drop the reference, the store entry is removed once
+        the last consumer releases it"""
+        self._loader.release(self._key, self._path)
+
+
+class SharedSourceLoader(object):
+    """Fetches every source data file once for all the repositories
+    that use it
+
+    Repositories updated at once often use the same source data
+    (the same Geofabrik extract). The first repository that needs a source
+    fetches it to the shared store, all the others just get a hard link
+    to it. A subscription link is created for every subscribed repository
+    once a source is fetched, so that the data stays in the store until all
+    of them got their handle, even if the first one is already done with it.
+    Store entries are removed once the last consumer releases its handle
+    (when the package is cleared) - leftover subscriptions of repositories
+    that did not need a source are removed once the whole update is done.
+
+    The loader only holds paths, so it can be passed to packages & sent
+    between processes. Changes of a store entry are done under
+    an exclusive per-entry lock.
+    """
+
+    def __init__(self, path, subscribers):
+        """
+        :param str path: store folder
+        :param subscribers: names of the repositories using the loader
+        """
+        self._path = path
+        self._subscribers = list(subscribers)
+
+    @property
+    def path(self):
+        return self._path
+
+    def _entry_path(self, key):
+        return os.path.join(self._path, key + ENTRY_SUFFIX)
+
+    def _subscription_path(self, key, subscriber):
+        return os.path.join(self._path, key + SUBSCRIPTION_SEPARATOR + subscriber)
+
+    def acquire(self, subscriber, source, target_path, fetch):
+        """return a handle to the source data, linked to target_path
+
+        :param str subscriber: name of the repository requesting the data
+        :param str source: source URL or path, used as the store key
+        :param str target_path: where the package expects the source data
+        :param fetch: function fetching the source data to the given path,
+                      only called if the source is not in the store yet
+        :returns: a SourceHandle
+        """
+        key = source_key(source)
+        entry = self._entry_path(key)
+        utils.createFolderPath(self._path)
+        lock = self._lock(key)
+        try:
+            if os.path.exists(target_path):
+                # already linked, by an interrupted update
+                log.info("using already loaded %s", target_path)
+            else:
+                if not os.path.isfile(entry):
+                    temp_entry = entry + ".part"
+                    fetch(temp_entry)
+                    os.rename(temp_entry, entry)
+                    # keep the entry for all the other subscribers
+                    for name in self._subscribers:
+                        if name != subscriber:
+                            self._link(entry, self._subscription_path(key, name))
+                else:
+                    log.info("%s already loaded, sharing it", source)
+                os.link(entry, target_path)
+            # the subscription is replaced by the handle
+            self._unlink(self._subscription_path(key, subscriber))
+        finally:
+            self._unlock(lock)
+        return SourceHandle(self, key, target_path)
+
+    def release(self, key, path):
+        """remove the link at path, remove the store entry
+        if it was the last reference to it"""
+        if not os.path.isdir(self._path):
+            # the store was already cleared
+            self._unlink(path)
+            return
+        entry = self._entry_path(key)
+        lock = self._lock(key)
+        try:
+            self._unlink(path)
+            if os.path.isfile(entry) and os.stat(entry).st_nlink == 1:
+                log.info("last reference to %s released, removing it", entry)
+                self._unlink(entry)
+        finally:
+            self._unlock(lock)
+
+    def clear(self):
+        """remove the whole store, once no repository uses it"""
+        if os.path.exists(self._path):
+            shutil.rmtree(self._path)
+
+    def _link(self, entry, path):
+        try:
+            os.link(entry, path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _unlink(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _lock(self, key):
+        lock = open(os.path.join(self._path, key + LOCK_SUFFIX), "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _unlock(self, lock):
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
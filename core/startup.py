@@ -22,8 +22,13 @@
 import sys
 import time
 
-from core.repo import QUEUE_SIZE, DEFAULT_SOURCE_FOLDER
+from core.repo import QUEUE_SIZE, DEFAULT_SOURCE_FOLDER, FUSION_THRESHOLD
 from core.repo import DATA_SOURCE_DOWNLOAD, DATA_SOURCE_FOLDER, DEFAULT_DATA_SOURCE
+from core.schedule import SCHEDULES
+from core.engine import ENGINES, DEFAULT_ENGINE
+from core.distributed import DEFAULT_PORT, DEFAULT_LEASE_TIMEOUT
+from core.retry import DEFAULT_MAX_ATTEMPTS, DEFAULT_RETRY_DELAY
+from core.watchdog import DEFAULT_TIMEOUT_PER_GB, DEFAULT_STALL_TIMEOUT
 
 import core.argparse as argparse
 
@@ -31,6 +36,22 @@ import core.argparse as argparse
 class Startup:
     def __init__(self):
         parser = argparse.ArgumentParser(description="A flexible GPS navigation system.")
+        parser.add_argument(
+            'command', type=str, nargs='?',
+            help="update - update the repositories, "
+                 "simulate - predict update results for candidate configurations (see --sweep) "
+                 "from results of past updates DEFAULT: update",
+            choices=["update", "simulate"],
+            default="update"
+        )
+        parser.add_argument(
+            '--sweep', metavar='setting=value,value,...', type=str,
+            help='candidate values of a setting (configuration file key, "none" = not set) '
+                 'for the simulate command, can be used more times - every combination '
+                 'of the values is simulated, for example: --sweep processing_pool_size=2,4,8',
+            default=None,
+            action="append"
+        )
         # Config
         parser.add_argument(
             '-c', metavar="configuration file", type=str,
@@ -48,6 +69,82 @@ class Startup:
             action="store"
         )
 
+        parser.add_argument(
+            '--repositories', type=str,
+            help='comma separated list of repositories to update at once, the repositories '
+                 'share the processing pool & resource budgets DEFAULT: monav',
+            default=None,
+            action="store"
+        )
+
+        parser.add_argument(
+            '--engine', type=str,
+            help='how the pipeline stages run: '
+                 'processes - every stage worker is a separate process, '
+                 'threads - stage workers are threads of a single process, '
+                 'compression runs in a process pool DEFAULT: %s' % DEFAULT_ENGINE,
+            choices=ENGINES,
+            default=None,
+            action="store"
+        )
+
+        parser.add_argument(
+            '--coordinator', metavar='host:port', type=str,
+            help='run the update as a coordinator, leasing processing tasks to worker agents '
+                 'connecting to the given address (default port: %d)' % DEFAULT_PORT,
+            default=None,
+            action="store"
+        )
+
+        parser.add_argument(
+            '--worker', metavar='host:port', type=str,
+            help='run as a worker agent, processing tasks leased from the coordinator at the given address',
+            default=None,
+            action="store"
+        )
+
+        parser.add_argument(
+            '--lease-timeout', metavar='seconds', type=int,
+            help='tasks of workers that did not send a heartbeat for this long are dispatched again '
+                 'DEFAULT: %d' % DEFAULT_LEASE_TIMEOUT,
+            default=None,
+            action="store"
+        )
+
+        parser.add_argument(
+            '--schedule', type=str,
+            help='order in which packages are loaded & processed: '
+                 'lpt - longest predicted processing time first (based on history of past updates & source data size), '
+                 'ascending - smallest source data first, '
+                 'fifo - in the order the source data is listed DEFAULT: lpt',
+            choices=SCHEDULES,
+            default=None,
+            action="store"
+        )
+        parser.add_argument(
+            '--priority-regions', metavar='patterns', type=str,
+            help='comma separated shell-style patterns of repository sub-paths (for example europe/germany/*), '
+                 'matching packages are loaded & processed before all the others DEFAULT: not set',
+            default=None,
+            action="store"
+        )
+
+        parser.add_argument(
+            '--resume',
+            help='resume an interrupted update - skip packages that have already been published '
+                 'and reuse processing & packaging results still available in the temporary folder',
+            default=False,
+            action="store_true"
+        )
+
+        parser.add_argument(
+            '--full-update',
+            help="process all source data, even if it did not change since the last update "
+                 "(only affects the folder data source)",
+            default=False,
+            action="store_true"
+        )
+
         # Folders
 
         parser.add_argument(
@@ -69,6 +166,21 @@ class Startup:
             action="store"
         )
 
+        parser.add_argument(
+            '--history-folder', metavar='history folder', type=str,
+            help='path to the folder storing results of past updates (used for scheduling) DEFAULT: history',
+            default=None,
+            action="store"
+        )
+
+        parser.add_argument(
+            '--build-cache-folder', metavar='build cache folder', type=str,
+            help='path to the build cache folder, where packaged results are cached by their inputs '
+                 'DEFAULT: not set (build cache disabled)',
+            default=None,
+            action="store"
+        )
+
         parser.add_argument(
             '--log-folder', metavar='log folder', type=str,
             help='path to the log folder',
@@ -98,7 +210,41 @@ class Startup:
         )
         parser.add_argument(
             '--processing-pool-size', metavar='process count', type=int,
-            help='size of the processing pool DEFAULT: cpu count',
+            help='size of the processing pool (max. processing tasks running at once) DEFAULT: cpu count',
+            default=None,
+            action="store"
+        )
+        parser.add_argument(
+            '--fusion-threshold', metavar='megabytes', type=int,
+            help='packages with source data smaller than this are processed, packaged & published '
+                 'by a single processing task, 0 = disabled DEFAULT: %d' % FUSION_THRESHOLD,
+            default=None,
+            action="store"
+        )
+        parser.add_argument(
+            '--cpu-placement',
+            help="bind every preprocessor run to as many CPUs as it runs threads, "
+                 "preferring CPUs of a single NUMA node",
+            default=False,
+            action="store_true"
+        )
+        parser.add_argument(
+            '--memory-limit',
+            help="run every preprocessor with a hard memory ceiling taken from its "
+                 "peak memory estimate, runs that breach it are retried alone with more headroom",
+            default=False,
+            action="store_true"
+        )
+        parser.add_argument(
+            '--adaptive-concurrency',
+            help="adjust the number of processing tasks running at once to host load "
+                 "(pressure stall information & available memory)",
+            default=False,
+            action="store_true"
+        )
+        parser.add_argument(
+            '--min-processing-pool-size', metavar='process count', type=int,
+            help='minimum number of processing tasks running at once with adaptive concurrency DEFAULT: 1',
             default=None,
             action="store"
         )
@@ -121,6 +267,95 @@ class Startup:
             action="store"
         )
 
+        # resource budgets
+
+        parser.add_argument(
+            '--memory-budget', metavar='megabytes', type=int,
+            help='RAM budget for package processing, packages are only started once their estimated peak '
+                 'memory usage fits into the budget DEFAULT: not set (unlimited)',
+            default=None,
+            action="store"
+        )
+
+        parser.add_argument(
+            '--disk-budget', metavar='megabytes', type=int,
+            help='temporary folder disk space budget, source data loading waits until the '
+                 'estimated disk usage of a package fits into the budget DEFAULT: not set (unlimited)',
+            default=None,
+            action="store"
+        )
+        parser.add_argument(
+            '--scratch-folder', metavar='scratch tier folder', type=str,
+            help='RAM backed folder (tmpfs) for processing scratch data of packages that fit '
+                 'into the scratch budget DEFAULT: not set (scratch data in the temporary folder)',
+            default=None,
+            action="store"
+        )
+        parser.add_argument(
+            '--scratch-budget', metavar='megabytes', type=int,
+            help='space on the scratch tier usable for processing scratch data '
+                 'DEFAULT: space available in the scratch folder',
+            default=None,
+            action="store"
+        )
+
+        parser.add_argument(
+            '--build-cache-size', metavar='megabytes', type=int,
+            help='build cache size limit, least recently used results are evicted once it is reached '
+                 'DEFAULT: not set (unlimited)',
+            default=None,
+            action="store"
+        )
+        parser.add_argument(
+            '--importer-cache-folder', metavar='importer cache folder', type=str,
+            help='path to the importer cache folder, where preprocessor importer output is cached '
+                 'by its inputs & reused by later preprocessor runs '
+                 'DEFAULT: not set (import in every preprocessor run)',
+            default=None,
+            action="store"
+        )
+        parser.add_argument(
+            '--importer-cache-size', metavar='megabytes', type=int,
+            help='importer cache size limit, least recently used importer output is evicted once it is reached '
+                 'DEFAULT: not set (unlimited)',
+            default=None,
+            action="store"
+        )
+
+        # failure handling
+
+        parser.add_argument(
+            '--max-attempts', metavar='attempt count', type=int,
+            help='how many times should failed package loading or processing be tried DEFAULT: %d'
+                 % DEFAULT_MAX_ATTEMPTS,
+            default=None,
+            action="store"
+        )
+
+        parser.add_argument(
+            '--retry-delay', metavar='seconds', type=int,
+            help='delay before retrying a failed package, doubled with every further attempt DEFAULT: %d'
+                 % DEFAULT_RETRY_DELAY,
+            default=None,
+            action="store"
+        )
+
+        parser.add_argument(
+            '--processing-timeout', metavar='seconds per GB', type=int,
+            help='processing run time limit increase per GB of source data, runs over the limit '
+                 'are killed, 0 = unlimited DEFAULT: %d' % DEFAULT_TIMEOUT_PER_GB,
+            default=None,
+            action="store"
+        )
+
+        parser.add_argument(
+            '--stall-timeout', metavar='seconds', type=int,
+            help='kill processing runs that use no CPU time and write no output for this long, '
+                 '0 = disabled DEFAULT: %d' % DEFAULT_STALL_TIMEOUT,
+            default=None,
+            action="store"
+        )
+
         # Monav repository variables
 
         parser.add_argument(
@@ -155,7 +390,7 @@ class Startup:
         )
         parser.add_argument(
             '--monav-dont-sort-urls',
-            help="don't sort PBF URLs by size (sensible choice for very long lists or URLs)",
+            help="don't sort PBF URLs by size (sensible choice for very long lists or URLs), same as --schedule fifo",
             default=False,
             action="store_true"
         )
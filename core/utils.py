@@ -26,6 +26,7 @@ import urllib2
 import urlparse
 import zipfile
 import datetime
+import hashlib
 
 # URL types
 import sys
@@ -62,6 +63,33 @@ def zipDir(path, zipFilename, fakeRoot=None):
     z.close()
 
 
+def hashFile(path, blockSize=2 ** 20):
+    """return SHA1 hex digest of the file content
+    NOTE: the file is read in blocks so that it should handle really
+    large files"""
+    hasher = hashlib.sha1()
+    f = open(path, "rb")
+    try:
+        while True:
+            block = f.read(blockSize)
+            if not block:
+                break
+            hasher.update(block)
+    finally:
+        f.close()
+    return hasher.hexdigest()
+
+
+def fileFingerprint(path, withHash=True):
+    """return a dictionary with file size, modification time
+    and optionally SHA1 hash of the file content"""
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if withHash:
+        fingerprint['sha1'] = hashFile(path)
+    return fingerprint
+
+
 def createFolderPath(newPath):
     """Create a path for a directory and all needed parent folders
     -> parent directories will be created
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#----------------------------------------------------------------------------
+# modRana data repository - core - subprocess watchdog
+#----------------------------------------------------------------------------
+# Copyright 2012, Martin Kolman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#---------------------------------------------------------------------------
+
+import os
+import time
+import errno
+import signal
+import subprocess
+import logging
+log = logging.getLogger("repo.watchdog")
+
+from . import utils
+from . import placement
+from . import containment
+
+# how often to check the watched command (in seconds)
+POLL_INTERVAL = 5
+# run time limit of a processing run of empty source data (in seconds),
+# the limit grows with source data size
+TIMEOUT_BASE = 3600
+# run time limit increase per GB of source data (in seconds)
+DEFAULT_TIMEOUT_PER_GB = 4 * 3600
+# how long can a processing run go without progress (in seconds)
+DEFAULT_STALL_TIMEOUT = 3600
+# how long to wait for the process group to exit after SIGTERM before using SIGKILL
+KILL_GRACE_PERIOD = 10
+
+
+def process_group_usage(pgid):
+    """return a (CPU time in seconds, resident memory in bytes) tuple for all
+    processes in the process group, CPU time includes their already finished children
+    -> None if the information is not available (no /proc)"""
+    try:
+        pids = [p for p in os.listdir("/proc") if p.isdigit()]
+    except OSError:
+        return None
+    ticks = 0
+    pages = 0
+    for pid in pids:
+        try:
+            f = open("/proc/%s/stat" % pid, "r")
+            try:
+                stat = f.read()
+            finally:
+                f.close()
+        except IOError:
+            # the process already exited
+            continue
+        # the command name can contain spaces, so split after it
+        fields = stat[stat.rfind(")") + 2:].split()
+        if int(fields[2]) == pgid:
+            # utime, stime, cutime, cstime
+            ticks += sum([int(x) for x in fields[11:15]])
+            # resident set size
+            pages += int(fields[21])
+    return ticks / float(os.sysconf("SC_CLK_TCK")), pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def process_group_cpu_time(pgid):
+    """return CPU time (in seconds) used by all processes in the process group,
+    including their already finished children
+    -> None if the information is not available (no /proc)"""
+    usage = process_group_usage(pgid)
+    if usage is None:
+        return None
+    return usage[0]
+
+
+def folder_size(path):
+    """return size of all files in the folder (in bytes)"""
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                # the file was removed in the meantime
+                pass
+    return size
+
+
+def kill_process_group(process):
+    """terminate all processes in the process group led by the process,
+    SIGKILL is used if they don't exit in time after SIGTERM"""
+    pgid = process.pid
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(pgid, sig)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                # no processes left in the group
+                return
+            raise
+        if sig == signal.SIGTERM:
+            deadline = time.time() + KILL_GRACE_PERIOD
+            while time.time() < deadline:
+                # reap the group leader, so that it does not stay in the group as a zombie
+                process.poll()
+                try:
+                    os.killpg(pgid, 0)
+                except OSError:
+                    return
+                time.sleep(0.5)
+
+
+def _preexec(cpus, memory_ceiling):
+    """return a function run in the child process before the command is executed"""
+    def preexec():
+        os.setsid()
+        if cpus:
+            # the threads & children of the command inherit the affinity
+            placement.set_affinity(cpus)
+        if memory_ceiling is not None:
+            memory_ceiling.apply()
+    return preexec
+
+
+def run_watched(command, timeout=None, stall_timeout=None, watch_path=None,
+                poll_interval=POLL_INTERVAL, usage=None, cpus=None, memory_ceiling=None,
+                output=None, **kwargs):
+    """run a command under a watchdog
+
+    The command runs in its own process group, so that the watchdog can
+    kill it together with all its children. It is killed if it runs
+    longer than timeout or if it stalls - neither uses any CPU time nor
+    grows the watched output folder for stall_timeout seconds.
+
+    :param command: command for subprocess.Popen
+    :param timeout: maximum run time in seconds, None = unlimited
+    :param stall_timeout: maximum time without progress in seconds, None = no stall detection
+    :param watch_path: output folder whose growth counts as progress
+    :param usage: if set to a dictionary, peak resident memory of the process group
+                  (in bytes, sampled every poll_interval) is stored under 'peak_memory'
+                  & peak size of the watched output folder under 'peak_disk'
+    :param cpus: list of CPUs the command is bound to, None = no binding
+    :param memory_ceiling: memory ceiling of the command (see core.containment),
+                           None = no ceiling
+    :param output: follows the command output (see core.phases.PhaseTracker),
+                   polled while the command runs & finished once it exits
+    :param kwargs: passed to subprocess.Popen
+    :returns: a (return code, failure reason) tuple, failure reason is None
+              if the command was not killed by the watchdog and did not
+              breach its memory ceiling
+    """
+    start = time.time()
+    try:
+        process = subprocess.Popen(command, preexec_fn=_preexec(cpus, memory_ceiling), **kwargs)
+    except Exception:
+        if memory_ceiling is not None:
+            memory_ceiling.cleanup()
+        raise
+    # the command is the process group leader
+    pgid = process.pid
+    last_progress = None
+    last_progress_time = start
+    last_check = start
+    reason = None
+    while process.poll() is None:
+        time.sleep(min(poll_interval, 1))
+        now = time.time()
+        if output is not None:
+            output.poll(now)
+        if timeout and now - start > timeout:
+            reason = "timed out after %d s" % timeout
+        elif (stall_timeout or usage is not None) and now - last_check >= poll_interval:
+            last_check = now
+            group_usage = process_group_usage(pgid)
+            output_size = watch_path and folder_size(watch_path)
+            if group_usage is not None and usage is not None:
+                usage['peak_memory'] = max(usage.get('peak_memory', 0), group_usage[1])
+            if output_size is not None and usage is not None:
+                usage['peak_disk'] = max(usage.get('peak_disk', 0), output_size)
+            if stall_timeout:
+                progress = (group_usage and group_usage[0], output_size)
+                if progress != last_progress:
+                    last_progress = progress
+                    last_progress_time = now
+                elif now - last_progress_time > stall_timeout:
+                    reason = "stalled, no CPU time used and no output written for %d s" % stall_timeout
+        if reason:
+            log.error("killing %s (pid %d): %s", command, pgid, reason)
+            kill_process_group(process)
+            process.wait()
+            break
+    if output is not None:
+        output.finish()
+    if watch_path and usage is not None:
+        # the output might have grown since the last sample
+        usage['peak_disk'] = max(usage.get('peak_disk', 0), folder_size(watch_path))
+    if memory_ceiling is not None:
+        output_lines = output.recent_lines if output is not None else ()
+        if reason is None and memory_ceiling.breached(process.returncode, usage, output_lines):
+            reason = "%s: memory ceiling of %s breached" % (
+                containment.MEMORY_LIMIT, utils.bytes2PrettyUnitString(memory_ceiling.limit))
+            log.error("%s (pid %d): %s", command, pgid, reason)
+        memory_ceiling.cleanup()
+    return process.returncode, reason
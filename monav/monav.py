@@ -18,12 +18,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #---------------------------------------------------------------------------
 import shutil
-import subprocess
-import csv
 import os
-import multiprocessing as mp
+import re
+import subprocess
 import logging
 import time
+import multiprocessing as mp
+from distutils.spawn import find_executable
 log = logging.getLogger("repo")
 source_log = logging.getLogger('repo.source.monav')
 process_log = logging.getLogger('repo.process.monav')
@@ -32,18 +33,84 @@ publish_log = logging.getLogger('repo.publish.monav')
 
 from core.package import Package
 from core.repo import Repository
+from core.schedule import WorkItem, SCHEDULE_FIFO
+from core.build_cache import cache_key, FolderCache
 import core.repo as repo
+import core.journal as journal
+import core.catalog as catalog
 import core.utils as utils
+import core.watchdog as watchdog
+import core.simulate as simulate
+import core.placement as placement
+import core.phases as phases
 
 SOURCE_DATA_URLS_CSV = "monav/osm_pbf_extracts.csv"
 
 PREPROCESSOR_PATH = "monav-preprocessor"
 
+# rough monav-preprocessor peak RAM usage estimate for a single run:
+# MEMORY_BASE + MEMORY_FACTOR * source PBF size
+# -> Germany & France sized extracts need about 5-6 GB RAM for a single run
+MEMORY_BASE = 256 * 2 ** 20
+MEMORY_FACTOR = 3
+# rough estimate of the temporary data created by the preprocessor
+# runs for a package: SCRATCH_FACTOR * source PBF size
+# (this covers the routing data for all three modes & the archives)
+SCRATCH_FACTOR = 3
+
+# routing modes & corresponding preprocessor profiles,
+# every mode results in a separate routing data archive
+PROFILES = [
+    ("car", "motorcar"),
+    ("bike", "bicycle"),
+    ("pedestrian", "foot")
+]
+
+# preprocessor phases, recognized by the names of the preprocessor
+# modules in its verbose output
+PREPROCESSOR_PHASES = [
+    ("import", re.compile(r"osm ?importer|importing", re.IGNORECASE)),
+    ("contraction_hierarchies", re.compile(r"contraction ?hierarchies", re.IGNORECASE)),
+    ("gps_grid", re.compile(r"gps ?grid", re.IGNORECASE)),
+    ("address_lookup", re.compile(r"unicode ?tournament ?trie|address lookup", re.IGNORECASE))
+]
+# per-package preprocessor output logs are stored in this sub-folder of the log folder
+PREPROCESSOR_LOG_FOLDER = "preprocessor"
+
 
 class MonavRepository(Repository):
-    def __init__(self, manager):
-        Repository.__init__(self, manager)
+    def __init__(self, manager, budgets=None, source_loader=None, dry_run=False):
+        Repository.__init__(self, manager, budgets, source_loader, dry_run)
         self._preprocessor_path = manager.monav_preprocessor_path
+        # per-package preprocessor output logs
+        self._output_log_path = os.path.join(manager.log_folder_path, PREPROCESSOR_LOG_FOLDER, self.folder_name)
+        # hashes of the preprocessor binary & settings, used as build cache keys
+        self._base_ini_hash = None
+        self._preprocessor_hash = None
+        if self.build_cache:
+            self._base_ini_hash = self._hash_file(os.path.join(self.folder_name, "base.ini"))
+            self._preprocessor_hash = self._hash_file(find_executable(self._preprocessor_path))
+            if self._base_ini_hash is None or self._preprocessor_hash is None:
+                log.warning("Monav: preprocessor or base.ini not found, build cache will not be used")
+        # importer output reused by all routing profiles with the same importer inputs
+        # and by later updates
+        self._importer_cache = None
+        if manager.importer_cache_path and not dry_run:
+            cache_size = manager.importer_cache_size
+            if cache_size is not None:
+                cache_size *= 2 ** 20
+            self._importer_cache = FolderCache(
+                os.path.join(manager.importer_cache_path, self.folder_name), cache_size)
+            if self._base_ini_hash is None:
+                self._base_ini_hash = self._hash_file(os.path.join(self.folder_name, "base.ini"))
+                self._preprocessor_hash = self._hash_file(find_executable(self._preprocessor_path))
+            if self._base_ini_hash is None or self._preprocessor_hash is None:
+                log.warning("Monav: preprocessor or base.ini not found, importer cache will not be used")
+        # when did the current update start
+        self._update_start = None
+        # importer cache hits & misses, import time spent & saved (in seconds)
+        self._importer_stats = dict([(name, mp.Value('L', 0))
+                                     for name in ('hits', 'misses', 'time_spent', 'time_saved')])
 
     @property
     def name(self):
@@ -53,19 +120,73 @@ class MonavRepository(Repository):
     def folder_name(self):
         return "monav"
 
+    def log_settings(self):
+        log.info('# monav preprocessor threads: %d', self.manager.monav_preprocessor_threads)
+        log.info('# max parallel pp. per package: %d', self.manager.monav_parallel_threads)
+        ppThreshold = self.manager.monav_parallel_threshold
+        if ppThreshold:
+            log.info('# parallel pp. threshold: %d MB' % ppThreshold)
+        if self._importer_cache:
+            log.info('# importer cache: %s', self._importer_cache.path)
+
     def _pre_update(self):
         """make sure temporary & publishing folders exist"""
+        self._update_start = int(time.time())
         if utils.createFolderPath(self.temp_path) == False:
             return False
         if utils.createFolderPath(self.publish_path) == False:
             return False
         return True
 
+    def _post_update(self):
+        if self._importer_cache:
+            # compared to importing in every run, the cache saves import time
+            # & costs the disk space of the cached importer output
+            stats = dict([(name, value.value) for name, value in self._importer_stats.items()])
+            log.info("## %s: importer cache: %d imports reused, %d imports run (%s), "
+                     "%s of import time saved, %s on disk", self.name, stats['hits'], stats['misses'],
+                     utils.prettyTimeDiff(stats['time_spent']), utils.prettyTimeDiff(stats['time_saved']),
+                     utils.bytes2PrettyUnitString(self._importer_cache.size))
+            self._log_importer_cache_report(self._update_start)
+        return Repository._post_update(self)
+
+    def _log_importer_cache_report(self, since):
+        """compare run times & peak temporary disk usage with & without a reused import
+        for packages processed since the given time that have been processed both ways"""
+        self.history.reload()
+        compared = []
+        for key, entry in sorted(self.history.items()):
+            tasks = entry.get('tasks', {}).values()
+            if entry.get('updated', 0) < since or not tasks:
+                continue
+            values = [[task.get(name) for task in tasks] for name in
+                      ('cached_time', 'uncached_time', 'cached_peak_disk', 'uncached_peak_disk')]
+            if None in sum(values, []):
+                continue
+            cached_time, uncached_time, cached_disk, uncached_disk = values
+            compared.append((key, sum(cached_time), sum(uncached_time), max(cached_disk), max(uncached_disk)))
+        if not compared:
+            return
+        log.info("## %s: processing with & without reused imports (time, peak temporary disk usage):", self.name)
+        for key, cached_time, uncached_time, cached_disk, uncached_disk in compared:
+            log.info("# %s: %s & %s reused, %s & %s imported", key,
+                     utils.prettyTimeDiff(cached_time), utils.bytes2PrettyUnitString(cached_disk),
+                     utils.prettyTimeDiff(uncached_time), utils.bytes2PrettyUnitString(uncached_disk))
+        log.info("## %s: %d packages, %s reused, %s imported", self.name, len(compared),
+                 utils.prettyTimeDiff(sum([c[1] for c in compared])),
+                 utils.prettyTimeDiff(sum([c[2] for c in compared])))
+
     def _load_data(self):
         # check from where to load data
         if self.manager.args.data_source == repo.DATA_SOURCE_FOLDER:
             source_folder = self.manager.source_data_path
             files = self._load_local_source_data(source_folder)
+            # order the files according to the scheduling policy
+            items = []
+            for file_path, file_size in files:
+                repo_sub_path = utils.pbfPath2repoPathFilenameName(file_path, source_folder)[0]
+                items.append(WorkItem(repo_sub_path, file_size, file_path))
+            files = [(item.source, item.size) for item in self._schedule_work(items)]
             # convert the list of files to Monav packages and start
             # feeding them to the loading queue
             self._generate_monav_packages(source_folder, files)
@@ -92,117 +213,360 @@ class MonavRepository(Repository):
         source_log.info("found %d PBF files together %s in size",
             file_count, utils.bytes2PrettyUnitString(accumulated_size)
         )
+        if self.manager.incremental_update:
+            files = self._skip_unchanged_files(source_folder, files)
         return files
 
+    def _skip_unchanged_files(self, source_folder, files):
+        """skip PBF files that did not change since their package was last published,
+        the published archives for them are kept as they are"""
+        changed_files = []
+        skipped_size = 0
+        for file_path, file_size in files:
+            repo_sub_path = utils.pbfPath2repoPathFilenameName(file_path, source_folder)[0]
+            if self._is_unchanged(repo_sub_path, file_path):
+                skipped_size += file_size
+            else:
+                changed_files.append((file_path, file_size))
+        source_log.info("%d PBF files (%s) unchanged since last update, skipping them",
+            len(files) - len(changed_files), utils.bytes2PrettyUnitString(skipped_size)
+        )
+        return changed_files
+
+    def _is_published(self, package_id):
+        """check if archives for all modes are in the repository"""
+        name = os.path.basename(package_id)
+        for mode_name, mode_profile in PROFILES:
+            archive = os.path.join(self.publish_path, package_id, "%s_%s.tar.gz" % (name, mode_name))
+            if not os.path.isfile(archive):
+                return False
+        return True
+
     def _generate_monav_packages(self, source_folder, file_size_list):
         # generate a package for every PBF file
         pack_id = 0
+        file_count = len(file_size_list)
         for f, f_size in file_size_list:
+            # give packages that failed to load another try once their retry delay passes
+            self._run_loading_retries()
             try:
                 metadata = {
-                    'packId': pack_id,
                     'tempPath': self.temp_path,
                     'helperPath': self.folder_name,
                     'preprocessorPath': self._preprocessor_path,
+                    'outputLogPath': self._output_log_path,
+                    'reaper': self.reaper,
                     'filePath' : f,
                     'filePathPrefix' : source_folder
                 }
                 pack = MonavPackage(metadata)
                 pack_id += 1
+                if self._resume_package(pack):
+                    continue
                 size_string = utils.bytes2PrettyUnitString(f_size)
-                file_count = len(file_size_list)
                 source_log.info('loading %d/%d: %s (%s)', pack_id, file_count, pack.name, size_string)
-                pack.load()
-                self.source_queue.put(pack)
+                if not self._load_package(pack, f_size):
+                    self._retry_loading(pack, f_size)
             except Exception:
                 source_log.exception('loading PBF file failed: %s', f)
                 #source_log.error(e)
                 #traceback.print_exc(file=sys.stdout)
                 #source_log.exception("traceback:")
+        self._finish_loading_retries()
 
         source_log.info('all source files loaded')
 
     def _download_source_data(self):
         csv_file_path = self.manager.monav_csv_path
-        # get a CSV line count to get approximate repository update progress
-        urlCount = utils.countCSVLines(csv_file_path)
-        if not urlCount: # just to be sure
-            urlCount = 0
-        f = open(csv_file_path, "r")
-        reader = csv.reader(f)
         source_log.info('source data downloader starting')
         # read all URLs to a list
-        urls = []
-        for row in reader:
-            if len(row) > 0:
-                urls.append(row[0])
-        f.close()
-
-        if self.manager.args.monav_dont_sort_urls:
+        urls = catalog.load_url_catalog(csv_file_path)
+        self._source_priorities = catalog.load_url_priorities(csv_file_path)
+        url_type = self._get_source_url_type()
+        # drop URLs resulting in the same package before doing any work
+        urls, duplicates = catalog.deduplicate_urls(urls, url_type)
+        # URL count to get approximate repository update progress
+        urlCount = len(urls)
+
+        if self.manager.schedule == SCHEDULE_FIFO:
             source_log.info('URL sorting disabled')
-            sorted_urls = map(lambda x: (0, x), urls)
+            sized_urls = map(lambda x: (None, x), urls)
         else:
-            # sort the URLs by size
-            source_log.info('sorting URLs by size in ascending order')
-            sorted_urls, totalSize = utils.sortUrlsBySize(urls)
+            # get URL sizes for scheduling
+            source_log.info('checking URL sizes')
+            sized_urls, totalSize = utils.sortUrlsBySize(urls)
             source_log.info('total download size: %s', utils.bytes2PrettyUnitString(totalSize))
+        self._report_duplicates(duplicates, dict([(url, size) for size, url in sized_urls]))
+        # order the URLs according to the scheduling policy
+        items = []
+        for size, url in sized_urls:
+            repo_sub_path = utils.url2repoPathFilenameName(url, url_type)[0]
+            items.append(WorkItem(repo_sub_path, size, url))
+        sorted_urls = [(item.size, item.source) for item in self._schedule_work(items)]
 
         # download all the URLs
         pack_id = 0
         for size, url in sorted_urls:
+            # give packages that failed to download another try once their retry delay passes
+            self._run_loading_retries()
             try:
                 metadata = {
-                    'packId': pack_id,
                     'tempPath': self.temp_path,
                     'helperPath': self.folder_name,
                     'preprocessorPath': self._preprocessor_path,
+                    'outputLogPath': self._output_log_path,
+                    'reaper': self.reaper,
                     'url' : url,
-                    'urlType': self._get_source_url_type()
+                    'urlType': url_type,
+                    'sourceLoader': self.source_loader,
+                    'repository': self.folder_name
                 }
                 pack = MonavPackage(metadata)
                 pack_id+= 1
+                if self._resume_package(pack):
+                    continue
                 if size is None:
                     size_string = "unknown size"
                 else:
                     size_string = utils.bytes2PrettyUnitString(size)
                 source_log.info('downloading %d/%d: %s (%s)', pack_id, urlCount, pack.name, size_string)
-                pack.load()
-                self.source_queue.put(pack)
+                if not self._load_package(pack, size):
+                    self._retry_loading(pack, size)
             except Exception:
                 source_log.exception('loading url failed: %s', url)
                 #source_log.info(e)
                 #traceback.print_exc(file=sys.stdout)
                 #source_log.exception("traceback:")
+        self._finish_loading_retries()
 
         source_log.info('all downloads finished')
 
-    def _process_package(self):
-        """process OSM data in the PBF format into Monav routing data"""
-        while True:
-            package = self.source_queue.get()
-            if package == repo.SHUTDOWN_SIGNAL:
-                self.source_queue.task_done()
-                break
-                # process the data
-
-            # rough Monav-preprocessor thread count heuristics
-            # * the packages will probably spend the most time
-            # importing data, but many threads can speed up part of
-            # the computation quite a bit
-            # * with the default queue size (10), this means worst-case
-            # over-commit of about 2.5 for Monav threads (+ max 10 active packaging threads)
-            monavThreads = self.manager.monav_preprocessor_threads
-            # how many preprocessors can be run at once
-            maxParallelPreprocessors = self.manager.monav_parallel_threads
-            # source file size threshold (in MB) for running the preprocessors in parallel
-            parallelThreshold = self.manager.monav_parallel_threshold
-            # start packaging
-            package.process((monavThreads, maxParallelPreprocessors), parallelThreshold)
-            # signal task done
-            self.source_queue.task_done()
-            # forward the package to the packaging pool
-            self.packaging_queue.put(package)
-        process_log.info('processing shutting down')
+    def _load_package(self, package, size=None):
+        """load source data for the package & forward it for processing
+
+        :param size: source data size in bytes, None if not known before loading
+        :returns: True if loading succeeded, False otherwise
+        """
+        package.attempts += 1
+        package.priority = self._priorities.get(package.id, package.priority)
+        try:
+            # wait for enough free space in the temporary folder,
+            # if the source data size is not known, account for the package
+            # once the data is loaded
+            if size:
+                self._reserve_disk_space(package, size)
+            if not package.load():
+                return False
+            if not size:
+                self._reserve_disk_space(package)
+            if self.build_cache or self._importer_cache or \
+                    (self.manager.incremental_update and package.source_file_path):
+                package.source_fingerprint = utils.fileFingerprint(package.source_data_path)
+            scan = package.scan_source()
+            if scan:
+                source_log.info('%s: ~%d nodes, ~%d ways, ~%d relations in %d blocks, data from %s',
+                                package.name, scan.nodes, scan.ways, scan.relations, scan.blocks,
+                                time.strftime("%Y-%m-%d %H:%M", time.gmtime(scan.replication_timestamp))
+                                if scan.replication_timestamp else "unknown time")
+        except Exception:
+            source_log.exception('loading %s failed', package.name)
+            return False
+        self._record_state(package, journal.LOADED)
+        self.source_queue.put(package)
+        return True
+
+    def _report_duplicates(self, duplicates, url_sizes):
+        """log URLs dropped from the catalog & how much work that saved"""
+        if not duplicates:
+            return
+        saved_bytes = 0
+        saved_time = 0
+        for duplicate in duplicates:
+            # the dropped URL points to the same extract as the kept one
+            size = url_sizes.get(duplicate.kept_url)
+            saved_bytes += size or 0
+            saved_time += self.history.predict_processing_time(duplicate.repo_sub_path, size)
+            source_log.info('duplicate source for %s: %s (using %s)',
+                            duplicate.repo_sub_path, duplicate.url, duplicate.kept_url)
+        source_log.info('%d duplicate URLs dropped, saving %s of downloads and about %.1f hours of processing',
+                        len(duplicates), utils.bytes2PrettyUnitString(saved_bytes), saved_time / 3600.0)
+
+    def _hash_file(self, path):
+        if path and os.path.isfile(path):
+            return utils.hashFile(path)
+        else:
+            return None
+
+    def _get_cache_key(self, package, mode_name):
+        """build cache key for routing data of a single mode
+        -> the archive depends on the source data, settings, preprocessor,
+        package name (used inside the archive) & routing profile"""
+        return cache_key(package.source_hash, self._base_ini_hash, self._preprocessor_hash,
+                         package.name, mode_name, dict(PROFILES)[mode_name])
+
+    def _get_importer_key(self, package, mode_name):
+        """importer cache key for a single mode
+        -> the Monav importer applies the routing profile (speed profile) while importing,
+        so importer output can only be shared by modes using the same profile"""
+        return cache_key(package.source_hash, self._base_ini_hash, self._preprocessor_hash,
+                         dict(PROFILES)[mode_name])
+
+    def _get_task_concurrency(self, package):
+        """return how many preprocessors can run at once for the package"""
+        # how many preprocessors can be run at once
+        maxParallelPreprocessors = self.manager.monav_parallel_threads
+        # source file size threshold (in MB) for running the preprocessors in parallel
+        parallelThreshold = self.manager.monav_parallel_threshold
+        return package.get_parallel_run_count(maxParallelPreprocessors, parallelThreshold)
+
+    @property
+    def simulation_settings(self):
+        return {
+            'monav_preprocessor_threads': self.manager.monav_preprocessor_threads,
+            'monav_parallel_threads': self.manager.monav_parallel_threads,
+            'monav_parallel_threshold': self.manager.monav_parallel_threshold
+        }
+
+    def _get_simulation_packages(self, config):
+        """replay the packages from the history store, task run times & memory
+        peaks missing in older records are estimated like during an update"""
+        downloaded = self.manager.args.data_source != repo.DATA_SOURCE_FOLDER
+        task_names = [mode_name for mode_name, mode_profile in PROFILES]
+        packages = []
+        for key, entry in self.history.items():
+            size = entry.get('source_size') or 0
+            recorded_tasks = entry.get('tasks', {})
+            # older records only have the combined processing time
+            default_time = float(entry.get('processing_time') or 0) / len(task_names)
+            estimate = estimate_run_memory(size)
+            tasks = []
+            for name in task_names:
+                recorded = recorded_tasks.get(name, {})
+                tasks.append(simulate.SimulatedTask(
+                    name, recorded.get('time', default_time),
+                    recorded.get('peak_memory') or estimate, estimate,
+                    config['monav_preprocessor_threads']
+                ))
+            concurrency = parallel_run_count(size, config['monav_parallel_threads'],
+                                             config['monav_parallel_threshold'])
+            packages.append(simulate.SimulatedPackage(
+                key, size, tasks, concurrency, entry.get('packaging_time', 0),
+                estimate_disk_usage(size, downloaded)
+            ))
+        return packages
+
+    def _run_task(self, task):
+        """process OSM data in the PBF format into Monav routing data
+        for a single routing profile"""
+        package = task.package
+        # rough Monav-preprocessor thread count heuristics
+        # * the packages will probably spend the most time
+        # importing data, but many threads can speed up part of
+        # the computation quite a bit
+        # * with the default queue size (10), this means worst-case
+        # over-commit of about 2.5 for Monav threads (+ max 10 active packaging threads)
+        monavThreads = self.manager.monav_preprocessor_threads
+        # wait until the estimated peak RAM usage of the preprocessor
+        # run fits into the memory budget
+        estimate = package.estimate_peak_memory()
+        if task.memory_breaches and self.memory_budget.enabled:
+            # the estimate was too low, run alone with the whole budget
+            reserved = self.memory_budget.reserve(self.memory_budget.capacity, label=task.label)
+        else:
+            reserved = self.memory_budget.reserve(estimate, label=task.label)
+        # hard memory ceiling of the run, taken from the estimate
+        memory_ceiling = self.create_memory_ceiling(estimate, task.memory_breaches)
+        if memory_ceiling:
+            process_log.info('%s memory ceiling: %s', task.label,
+                             utils.bytes2PrettyUnitString(memory_ceiling.limit))
+        # bind the preprocessor threads to CPUs of a single NUMA node
+        cpus = None
+        if self.cpu_placement:
+            cpus, node = self.cpu_placement.allocate(monavThreads)
+            process_log.info('%s placed on CPUs %s (%s)', task.label, placement.format_cpu_list(cpus),
+                             "node %d" % node if node is not None else "more nodes")
+        try:
+            importer_key = None
+            if self._importer_cache:
+                importer_key = self._get_importer_key(package, task.name)
+            success = package.process_profile(task.name, monavThreads,
+                                              timeout=self._get_processing_timeout(package),
+                                              stall_timeout=self.manager.stall_timeout or None,
+                                              cpus=cpus, memory_ceiling=memory_ceiling,
+                                              importer_cache=self._importer_cache,
+                                              importer_key=importer_key)
+        finally:
+            if memory_ceiling:
+                memory_ceiling.cleanup()
+            if cpus:
+                self.cpu_placement.release(cpus)
+            self.memory_budget.release(reserved)
+        if success:
+            # run time & memory usage are used for simulating future updates,
+            # run times with & without placement are kept for comparison
+            stats = dict(package.task_stats.get(task.name, {}))
+            if 'time' in stats:
+                stats['placed_time' if cpus else 'unplaced_time'] = stats['time']
+                # so are run times & peak temporary disk usage with & without a reused import
+                path = 'cached' if stats.get('import_reused') else 'uncached'
+                stats['%s_time' % path] = stats['time']
+                stats['%s_peak_disk' % path] = stats['peak_disk']
+            self._record_task_history(package, task.name, **stats)
+            if 'import_reused' in stats:
+                self._count_import(stats['import_reused'], stats['import_time'])
+        return success
+
+    def _count_import(self, reused, import_time):
+        if reused:
+            counters = (self._importer_stats['hits'], self._importer_stats['time_saved'])
+        else:
+            counters = (self._importer_stats['misses'], self._importer_stats['time_spent'])
+        for counter, value in zip(counters, (1, import_time)):
+            with counter.get_lock():
+                counter.value += value
+
+    def _get_cached_result(self, task):
+        """check if there is already an archive with the same inputs in the build cache"""
+        if self.build_cache:
+            package = task.package
+            key = self._get_cache_key(package, task.name)
+            if self.build_cache.get(key, package.get_archive_path(task.name)):
+                process_log.info('build cache hit for %s, skipping processing', task.label)
+                return True
+        return False
+
+    def _get_remote_result_path(self, task):
+        return task.package.get_archive_path(task.name)
+
+    def _remote_result_stored(self, task, path):
+        if self.build_cache:
+            self.build_cache.put(self._get_cache_key(task.package, task.name), path)
+
+    def run_remote_task(self, lease, source_path, source_folder, temp_path, upload):
+        """process & package a single routing profile of a package
+        leased from a coordinator and upload the resulting archive"""
+        metadata = {
+            'tempPath': temp_path,
+            'helperPath': self.folder_name,
+            'preprocessorPath': self._preprocessor_path,
+            'filePath' : source_path,
+            'filePathPrefix' : source_folder
+        }
+        pack = MonavPackage(metadata)
+        mode = lease['task']
+        try:
+            if not pack.process_profile(mode, self.manager.monav_preprocessor_threads,
+                                        timeout=self._get_processing_timeout(pack),
+                                        stall_timeout=self.manager.stall_timeout or None):
+                return False, pack.failure_reason or "processing failed"
+            archive_path = pack.package_profile(mode)
+            if archive_path is None:
+                return False, "packaging failed"
+            if not upload(archive_path):
+                return False, "result upload failed"
+            return True, None
+        finally:
+            pack.clear_all()
 
     def _package_package(self):
         """create a compressed TAR archive from the Monav routing data
@@ -213,14 +577,36 @@ class MonavRepository(Repository):
             if package == repo.SHUTDOWN_SIGNAL:
                 self.packaging_queue.task_done()
                 break
-                # packaging
-            package.package()
+            if self._package_single(package):
+                # forward the package to the publishing process
+                self.publish_queue.put(package)
             # signal task done
             self.packaging_queue.task_done()
-            # forward the package to the publishing process
-            self.publish_queue.put(package)
         package_log.info('packaging shutting down')
 
+    def _package_single(self, package):
+        """package a single package & store the new archives in the build cache
+        -> return False if packaging failed"""
+        # compression is CPU bound, let the engine run it where it won't block other work
+        start = time.time()
+        success, package.results, package.compressed_modes = self.engine.offload(_compress_package, package)
+        package.packaging_time = time.time() - start
+        if success:
+            self._record_state(package, journal.PACKAGED)
+            # the archives are in the temporary folder, drop the scratch data
+            self._release_scratch(package)
+            # store the new archives in the build cache
+            if self.build_cache:
+                for mode in package.compressed_modes:
+                    key = self._get_cache_key(package, mode)
+                    self.build_cache.put(key, package.get_archive_path(mode))
+            return True
+        else:
+            # don't publish an incomplete set of archives
+            package.fail(repo.STAGE_PACKAGING, "packaging failed")
+            self._report_failure(package)
+            return False
+
     def _publish_package(self):
         """tak the compressed TARs and publish them to the modRana public folder
         and update the repository manifest accordingly"""
@@ -230,164 +616,326 @@ class MonavRepository(Repository):
             if package == repo.SHUTDOWN_SIGNAL:
                 self.publish_queue.task_done()
                 break
-            publish_log.info('publishing %s', package.name)
-            package.publish(self.publish_path)
+            self._publish_single(package)
             self.publish_queue.task_done()
         publish_log.info('publisher shutting down')
 
+    def _publish_single(self, package):
+        """publish a single package & remove its temporary data
+        -> return False if publishing failed"""
+        publish_log.info('publishing %s', package.name)
+        if package.publish(self.publish_path, cleanup=False):
+            self._record_state(package, journal.PUBLISHED)
+            self._record_history(package)
+            self._record_fingerprint(package)
+            self._clear_package(package)
+            return True
+        else:
+            package.fail(repo.STAGE_PUBLISHING, "publishing failed")
+            self._report_failure(package)
+            return False
+
+def parallel_run_count(source_size, max_parallel_preprocessors, parallel_threshold=None):
+    """return how many preprocessors will run in parallel for a package
+    with source data of the given size (in bytes)"""
+    # check the parallel threshold
+    if parallel_threshold is not None:
+        # check if file size in MB is larger than threshold
+        if (source_size / (2 ** 20)) > parallel_threshold:
+            # if threshold is crossed, don't run preprocessors in parallel
+            return 1
+    # there is only one preprocessor run per routing profile
+    return max(1, min(max_parallel_preprocessors, len(PROFILES)))
+
+
+def estimate_run_memory(source_size):
+    """estimate peak RAM usage of a single preprocessor run
+    for source data of the given size (in bytes)"""
+    return MEMORY_BASE + MEMORY_FACTOR * source_size
+
+
+def estimate_disk_usage(source_size, downloaded):
+    """estimate temporary folder usage of a package
+    with source data of the given size (in bytes)"""
+    usage = SCRATCH_FACTOR * source_size
+    if downloaded:
+        # the PBF file is downloaded to the temporary folder
+        usage += source_size
+    return usage
+
+
+def _compress_package(package):
+    """compress routing data of the package, return the result
+    together with the updated package packaging state
+    -> module level function, so that it can be run in a process pool"""
+    success = package.package()
+    return success, package.results, package.compressed_modes
+
+
 class MonavPackage(Package):
     def __init__(self, metadata):
         Package.__init__(self, metadata)
         self._helper_path = metadata.get('helperPath') # for accessing the base.ini file for Monav preprocessor
         self._preprocessor_path = metadata['preprocessorPath']
+        # folder for preprocessor output logs, None = keep them with the temporary data
+        self._output_log_path = metadata.get('outputLogPath')
 
         # paths to resulting data files
         self.results = []
-
-    def process(self, threads=(1, 1), parallel_threshold=None):
-        """process the PBF extract into Monav routing data"""
-        monav_threads, max_parallel_preprocessors = threads
-        # check the parallel threshold
-        if parallel_threshold is not None:
-            try:
-                file_size = os.path.getsize(self._source_data_path)
-            except OSError:
-                file_size = 0
-                # check if file size in MB is larger than threshold
-            if (file_size / (2 ** 20)) > parallel_threshold:
-                # if threshold is crossed, don't run preprocessors in parallel
-                max_parallel_preprocessors = 1
+        # modes compressed during packaging (not taken from the build cache)
+        self.compressed_modes = []
+
+    def get_parallel_run_count(self, max_parallel_preprocessors, parallel_threshold=None):
+        """return how many preprocessors will run in parallel for this package"""
+        return parallel_run_count(self.source_size, max_parallel_preprocessors, parallel_threshold)
+
+    def estimate_peak_memory(self, parallel_runs=1):
+        """estimate peak RAM usage of the preprocessor runs for this package"""
+        return estimate_run_memory(self.source_size) * parallel_runs
+
+    def estimate_scratch_usage(self):
+        """estimate preprocessor scratch & routing data size of this package"""
+        return SCRATCH_FACTOR * self.source_size
+
+    def estimate_disk_usage(self, source_size=None):
+        """estimate temporary folder usage of this package
+        -> downloaded source data + preprocessor scratch & archives"""
+        if source_size is None:
+            source_size = self.source_size
+        return estimate_disk_usage(source_size, downloaded=not self.source_file_path)
+
+    def _get_routing_data_path(self, mode_name):
+        return os.path.join(self.scratch_path, "routing_%s" % mode_name)
+
+    def get_output_log_path(self, mode_name):
+        """return path of the preprocessor output log for the routing profile"""
+        if self._output_log_path:
+            return os.path.join(self._output_log_path, "%s.%s.log" % (self.id.replace(os.sep, "."), mode_name))
+        else:
+            return os.path.join(self._temp_storage_path, "%s.log" % mode_name)
+
+    def get_archive_path(self, mode_name):
+        return os.path.join(self._temp_storage_path, "%s_%s.tar.gz" % (self.name, mode_name))
+
+    def can_resume(self, state):
+        """check if routing data or archives for all modes
+        are still available from an interrupted update"""
+        modes = self.get_tasks()
+        if state == journal.PROCESSED:
+            return all([os.path.isdir(self._get_routing_data_path(mode)) for mode in modes])
+        elif state == journal.PACKAGED:
+            archives = [self.get_archive_path(mode) for mode in modes]
+            if all([os.path.isfile(path) for path in archives]):
+                self.results = archives
+                return True
+        return False
+
+    def get_tasks(self):
+        """every routing profile is processed by a separate preprocessor run"""
+        return [mode_name for mode_name, mode_profile in PROFILES]
+
+    def process(self, monav_threads=1):
+        """process the PBF extract into Monav routing data
+        -> the preprocessor is run for all the routing profiles in sequence"""
+        results = [self.process_profile(mode_name, monav_threads) for mode_name in self.get_tasks()]
+        return all(results)
+
+    def process_profile(self, mode_name, monav_threads=1, timeout=None, stall_timeout=None, cpus=None,
+                        memory_ceiling=None, importer_cache=None, importer_key=None):
+        """process the PBF extract into Monav routing data for a single routing profile
+
+        The preprocessor is run in a temporary folder separate for every routing profile
+        and the results are then moved to the package storage folder.
+        NOTE: the temporary folder is used to avoid multiple preprocessors mixing their
+        temporary data, as profiles of a package can be processed at once
+
+        With an importer cache the import is a separate preprocessor run, its output
+        is cached under importer_key & the routing data is built from the cached
+        importer output by another run - once the importer output is cached,
+        the import is skipped.
+
+        :param timeout: preprocessor run time limit in seconds, None = unlimited
+        :param stall_timeout: kill the preprocessor if it makes no progress
+                              for this many seconds, None = don't check
+        :param cpus: list of CPUs the preprocessor is bound to, None = no binding
+        :param memory_ceiling: hard memory ceiling of the preprocessor run
+                               (see core.containment), None = no ceiling
+        :param importer_cache: a FolderCache for importer output, None = import in every run
+        :param importer_key: importer cache key (see MonavRepository._get_importer_key())
+        """
         try:
-            if parallel_threshold is None and max_parallel_preprocessors == 1:
-                process_log.info('processing %s', self.name)
-            elif max_parallel_preprocessors == 1:
-                process_log.info('processing %s in 1 thread (threshold reached)', self.name)
-            else: # >1
-                process_log.info('processing %s in %d threads', self.name, max_parallel_preprocessors)
+            process_log.info('processing %s (%s)', self.name, mode_name)
             start_time = time.time()
-            input_file = self._source_data_path
-            output_folder = self._temp_storage_path
-            base_INI_Path = os.path.join(self._helper_path, "base.ini")
-            preprocessor_path = self._preprocessor_path
-
-            def get_task(mode_name, mode_profile, index):
-                """prepare task that runs the preprocessor in temPath separate for every preprocessor instance and move
-                the result to resultPath
-                NOTE: the temporary folder is used to avoid multiple preprocessors mixing their temporary data"""
-                temp_output_folder = os.path.join(output_folder, str(index))
-                result_path = os.path.join(temp_output_folder, "routing_%s" % mode_name)
-                # compile arguments
-                args = ['%s' % preprocessor_path, '-di', '-dro="%s"' % mode_name, '-t=%d' % monav_threads, '--verbose',
-                        '--settings="%s"' % base_INI_Path,
-                        '--input="%s"' % input_file, '--output="%s"' % temp_output_folder, '--name="%s"' % self.name,
-                        '--profile="%s"' % mode_profile, '-dd']
-
-                return args, result_path, self._temp_storage_path
-
-            def run_preprocessor(queue):
-                """this function is run in an internal pool inside the Monav package"""
-
-                while True:
-                    current_task = queue.get()
-                    if current_task == repo.SHUTDOWN_SIGNAL:
-                        queue.task_done()
-                        return
-                    args, from_path, to_path = current_task
-                    # create the independent per-preprocessor path
-                    os.makedirs(from_path)
-
-                    # open /dev/null so that the stdout & stderr output for the command can be dumped into it
-                    dev_null = open(os.devnull, "w")
-                    # call the preprocessor
-                    subprocess.call(reduce(lambda x, y: x + " " + y, args), shell=True, stdout=dev_null, stderr=dev_null)
-                    # move the results to the main folder
-                    shutil.move(from_path, to_path)
-                    # cleanup
-                    dev_null.close()
-                    queue.task_done()
-
-            tasks = [
-                get_task("car", "motorcar", 0),
-                get_task("bike", "bicycle", 1),
-                get_task("pedestrian", "foot", 2)
-            ]
-
-            preproc_queue = mp.JoinableQueue()
-            for i in range(max_parallel_preprocessors):
-                p = mp.Process(target=run_preprocessor, args=(preproc_queue,))
-                p.daemon = True
-                p.start()
-            for task in tasks:
-                preproc_queue.put(task)
-                # wait for the processes to finish
-            preproc_queue.join()
-            # shutdown them down
-            for i in range(max_parallel_preprocessors):
-                preproc_queue.put(repo.SHUTDOWN_SIGNAL)
-            preproc_queue.join()
-            # run preprocessors in parallel (depending on current settings)
-            #      pool = mp.Pool(processes=maxParallelPreprocessors)
-            #      pool.map(runPreprocessor, tasks)
-            # closing the pool is important, otherwise the workers in the poll will
-            # not exit - after a while the inactive threads will accumulate and
-            # no more new ones can be started
-            #      pool.close()
-            # just to be sure
-            #      pool.join()
+            temp_output_folder = os.path.join(self.scratch_path, mode_name)
+            result_path = os.path.join(temp_output_folder, "routing_%s" % mode_name)
+            # remove any leftovers from an interrupted run
+            stored_result_path = os.path.join(self.scratch_path, "routing_%s" % mode_name)
+            for path in (temp_output_folder, stored_result_path):
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+            # the preprocessor output goes to a per-package log, appended by every attempt,
+            # that is parsed to preprocessing phases while the preprocessor runs
+            log_path = self.get_output_log_path(mode_name)
+            utils.createFolderPath(os.path.dirname(log_path))
+            output_tracker = phases.PhaseTracker(log_path, PREPROCESSOR_PHASES,
+                                                 label="%s (%s)" % (self.name, mode_name))
+            usage = {}
+            run_kwargs = {
+                'timeout': timeout, 'stall_timeout': stall_timeout, 'cpus': cpus,
+                'memory_ceiling': memory_ceiling, 'usage': usage, 'output': output_tracker
+            }
+            stats = {}
+            if importer_cache is not None and importer_key is not None:
+                info = importer_cache.get(importer_key, temp_output_folder)
+                if info is None:
+                    # import only, without removing the importer output
+                    import_start = time.time()
+                    utils.createFolderPath(temp_output_folder)
+                    if not self._run_preprocessor(mode_name, ['-di'], monav_threads, log_path, **run_kwargs):
+                        shutil.rmtree(temp_output_folder)
+                        return False
+                    import_time = int(time.time() - import_start)
+                    importer_cache.put(importer_key, temp_output_folder, {'time': import_time})
+                    stats.update({'import_reused': False, 'import_time': import_time})
+                else:
+                    process_log.info('reusing cached importer output for %s (%s), import took %s',
+                                     self.name, mode_name, utils.prettyTimeDiff(info.get('time', 0)))
+                    stats.update({'import_reused': True, 'import_time': info.get('time', 0)})
+                flags = ['-dro="%s"' % mode_name, '-dd']
+            else:
+                flags = ['-di', '-dro="%s"' % mode_name, '-dd']
+            # create the independent per-preprocessor path
+            os.makedirs(result_path)
+            if not self._run_preprocessor(mode_name, flags, monav_threads, log_path, **run_kwargs):
+                shutil.rmtree(temp_output_folder)
+                return False
+            # move the results to the main folder
+            shutil.move(result_path, self.scratch_path)
+            # cleanup
+            shutil.rmtree(temp_output_folder)
             td = int(time.time() - start_time)
-            process_log.info('processed %s in %s', self.name, utils.prettyTimeDiff(td))
+            process_log.info('processed %s (%s) in %s (%s)', self.name, mode_name, utils.prettyTimeDiff(td),
+                             output_tracker.summary() or "no phases recognized")
+            stats.update({
+                'time': td,
+                'peak_memory': usage.get('peak_memory', 0),
+                'peak_disk': usage.get('peak_disk', 0),
+                'phases': dict([(name, round(duration, 1)) for name, duration in output_tracker.phases.items()]),
+                'counters': output_tracker.counters
+            })
+            self.task_stats[mode_name] = stats
             return True
         except Exception:
             message = 'monav package: Monav routing data processing failed\n'
-            message += 'name: %s' % self.name
+            message += 'name: %s\n' % self.name
+            message += 'mode: %s' % mode_name
             process_log.exception(message)
+            self.failure_reason = "preprocessor run failed"
+            return False
+
+    def _run_preprocessor(self, mode_name, flags, monav_threads, log_path, **kwargs):
+        """run the preprocessor with the given stage flags for a single routing profile
+        -> return False if the run failed
+
+        :param kwargs: passed to watchdog.run_watched()
+        """
+        temp_output_folder = os.path.join(self.scratch_path, mode_name)
+        base_INI_Path = os.path.join(self._helper_path, "base.ini")
+        # compile arguments
+        args = ['%s' % self._preprocessor_path] + flags + ['-t=%d' % monav_threads,
+                '--verbose', '--settings="%s"' % base_INI_Path,
+                '--input="%s"' % self._source_data_path, '--output="%s"' % temp_output_folder,
+                '--name="%s"' % self.name, '--profile="%s"' % dict(PROFILES)[mode_name]]
+        output_log = open(log_path, "a")
+        output_log.write("## %s: %s\n" % (time.strftime("%Y.%m.%d-%H:%M:%S"), " ".join(args)))
+        output_log.flush()
+        # call the preprocessor, killing it if it runs for too long or gets stuck
+        try:
+            rc, reason = watchdog.run_watched(reduce(lambda x, y: x + " " + y, args),
+                                              watch_path=temp_output_folder,
+                                              shell=True, stdout=output_log, stderr=subprocess.STDOUT,
+                                              **kwargs)
+        finally:
+            output_log.close()
+        if reason or rc != 0:
+            self.failure_reason = reason or "preprocessor exited with code %d" % rc
+            process_log.error('processing %s (%s) failed: %s', self.name, mode_name, self.failure_reason)
             return False
+        return True
 
     def package(self):
         """compress the Monav routing data"""
-        modes = ["car", "bike", "pedestrian"]
+        modes = self.get_tasks()
         package_log.info('packaging %s', self.name)
+        self.compressed_modes = []
         for mode in modes:
-            path = os.path.join(self._temp_storage_path, "routing_%s" % mode)
-            archive_path = os.path.join(self._temp_storage_path, "%s_%s.tar.gz" % (self.name, mode))
-            try:
-                # fakeRoot -> we need to have this structure inside the archive:
-                # /country/routing_x/
-                # as the files are stored in temp/monav/number/country/routing_x
-                # we supply a prefix, that is subtracted from the path using os.path.relpath()
-                # Example:
-                # temp/monav/0/azores/routing_car - temp/monav/0 = /azores/routing_car
-                utils.tarDir(path, archive_path, fakeRoot=self._temp_path)
-                #TODO: MD5 hash for archives
+            path = self._get_routing_data_path(mode)
+            archive_path = self.get_archive_path(mode)
+            if not os.path.isdir(path) and os.path.isfile(archive_path):
+                # the archive has been taken from the build cache
+                # or uploaded by a remote worker
                 self.results.append(archive_path)
-            except Exception:
-                message = 'monav package: compression failed\n'
-                message += 'path: %s' % path
-                message += 'archive: %s' % archive_path
-                package_log.exception(message)
-        if self.results:
-            return True
-        else:
-            return False
+                continue
+            if self.package_profile(mode):
+                self.results.append(archive_path)
+                self.compressed_modes.append(mode)
+        # all the modes need to be packaged
+        return len(self.results) == len(modes)
+
+    def package_profile(self, mode_name):
+        """compress the Monav routing data of a single routing profile
+        -> return the archive path or None if compression failed"""
+        path = self._get_routing_data_path(mode_name)
+        archive_path = self.get_archive_path(mode_name)
+        try:
+            # fakeRoot -> we need to have this structure inside the archive:
+            # /country/routing_x/
+            # as the files are stored in temp/monav/number/country/routing_x
+            # we supply a prefix, that is subtracted from the path using os.path.relpath()
+            # Example:
+            # temp/monav/0/azores/routing_car - temp/monav/0 = /azores/routing_car
+            # (the archive is created in the temporary folder even if the routing data
+            # are on the scratch tier)
+            utils.createFolderPath(os.path.dirname(archive_path))
+            utils.tarDir(path, archive_path, fakeRoot=self.scratch_base_path)
+            #TODO: MD5 hash for archives
+            return archive_path
+        except Exception:
+            message = 'monav package: compression failed\n'
+            message += 'path: %s' % path
+            message += 'archive: %s' % archive_path
+            package_log.exception(message)
+            return None
 
     def publish(self, main_repo_path, cleanup=True):
-        """publish the package to the online repository"""
-
+        """publish the package to the online repository
+        -> archives from a previous update are replaced"""
+        published = True
         for path2file in self.results:
             finalRepoPath = os.path.join(main_repo_path, self._repo_sub_path)
             try:
                 # try to make sure the folder exists
                 utils.createFolderPath(finalRepoPath)
-                # move the results
-                shutil.move(path2file, finalRepoPath)
+                # move the results, replacing the previously published archive
+                shutil.move(path2file, os.path.join(finalRepoPath, os.path.basename(path2file)))
             except Exception:
                 message = 'monav package: publishing failed\n'
                 message += 'file: %s' % path2file
                 message += 'target path: %s' % finalRepoPath
                 publish_log.exception(message)
+                published = False
         if cleanup: # clean up any source & temporary files
             self.clear_all()
+        return published and bool(self.results)
 
     def clear_all(self):
-        """remove the whole temporary directory for this pack"""
-        shutil.rmtree(self.temp_path)
+        """remove the whole temporary directory for this pack
+        -> big temporary directories take a while to delete,
+        so they are left to the reaper if the package has one"""
+        self.release_source()
+        self.clear_scratch()
+        if os.path.exists(self.temp_path):
+            if self._reaper:
+                self._reaper.dispose(self.temp_path)
+            else:
+                shutil.rmtree(self.temp_path)
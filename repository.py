@@ -19,6 +19,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #---------------------------------------------------------------------------
 
+import os
 import multiprocessing as mp
 import time
 import logging
@@ -30,13 +31,33 @@ from core import repo
 from core import utils
 from core import startup
 from core import repo_log
+from core import schedule
+from core import retry
+from core import watchdog
+from core import engine
+from core import distributed
+from core import budget
+from core import source
+from core import simulate
+from core import placement
+from core import containment
 
 # keywords
 SHUTDOWN_KEYWORD = "shutdown"
+# commands
+COMMAND_UPDATE = "update"
+COMMAND_SIMULATE = "simulate"
 # folders
 TEMP_PATH = "temp"
 RESULTS_PATH = "results"
 CONFIG_FILE_PATH = "repository.conf"
+# repository types that can be updated, by folder name
+REPOSITORY_TYPES = {
+    "monav": MonavRepository
+}
+DEFAULT_REPOSITORIES = "monav"
+# how often to check if concurrently updated repositories are done (in seconds)
+REPOSITORY_POLL_INTERVAL = 1
 
 # decorators
 def integer(fn):
@@ -62,11 +83,55 @@ class Manager(object):
         self._args = startup.Startup().getArgs()
         self._conf = ConfigObj(self.config_path)
 
+        # resolve the log folder just once, the default is timestamped
+        # & all logs of the update need to end up in the same folder
+        self._log_folder_path = self._wrapVariable(
+            self.args.log_folder, "log_folder",
+            "logs/repo_update_logs_%s" % time.strftime("%Y.%m.%d-%H:%M:%S"))
+
         # initialize logging
         repo_log.init_logging(self.log_folder_path)
 
-        # for now, update all repositories
-        self.updateAll()
+        if self.args.command == COMMAND_SIMULATE:
+            # predict update results for candidate configurations
+            self.simulate()
+        elif self.worker_url:
+            # process tasks for a coordinator running the update
+            self.runWorker()
+        else:
+            # for now, update all repositories
+            self.updateAll()
+
+    def runWorker(self):
+        """run a worker agent processing tasks leased from a coordinator"""
+        log.info("## starting worker agent ##")
+        monav = MonavRepository(self)
+        distributed.WorkerAgent(monav, self.worker_url).run()
+        log.info("## worker agent finished ##")
+
+    def simulate(self):
+        """replay results of past updates from the history store through a model
+        of the repository stages for every candidate configuration"""
+        log.info("## simulating repository update ##")
+        for name in self.repositories:
+            # only the configuration & history of the repository are used
+            repository = REPOSITORY_TYPES[name](self, dry_run=True)
+            baseline = {}
+            for key in simulate.POOL_SETTINGS + simulate.BUDGET_SETTINGS:
+                baseline[key] = getattr(self, key)
+            baseline.update(repository.simulation_settings)
+            try:
+                keys, candidates = simulate.expand_candidates(baseline, self.args.sweep or [])
+            except ValueError as e:
+                log.error("# %s", e)
+                return
+            if not len(repository.history):
+                log.error("# %s: no packages in %s, nothing to simulate", repository.name, repository.history.path)
+                continue
+            log.info("## %s: %d packages, %d candidate configurations", repository.name,
+                     len(repository.history), len(candidates))
+            simulate.log_results(repository.simulate(candidates), keys)
+        log.info("## simulation finished ##")
 
     def updateAll(self):
         log.info("## starting repository update ##")
@@ -80,40 +145,122 @@ class Manager(object):
         self.source_queue_size,
         self.packaging_queue_size,
         self.publish_queue_size)
-        log.info("## updating Monav repository" )
-        log.info('# monav preprocessor threads: %d', self.monav_preprocessor_threads)
-        log.info('# max parallel pp. per package: %d', self.monav_parallel_threads)
-        ppThreshold = self.monav_parallel_threshold
-        if ppThreshold:
-            log.info('# parallel pp. threshold: %d MB' % ppThreshold)
-        start_monav = time.time()
-        monav = MonavRepository(self)
-        monav.update()
-        # log how long the Monav update took
-        dt_monav = int(time.time() - start_monav)
-        if dt_monav > 60:
-            prettyTime = "%s (%d s)" % (utils.prettyTimeDiff(dt_monav), dt_monav)
-            # show seconds for exact benchmarking once pretty time
-            # switches to larger units
+        log.info("# engine: %s", self.engine)
+        if self.coordinator_address:
+            log.info("# coordinator mode, listening on %s:%d, lease timeout: %d s",
+                     self.coordinator_address[0], self.coordinator_address[1], self.lease_timeout)
+        log.info("# scheduling policy: %s", self.schedule)
+        if self.priority_regions:
+            log.info("# priority regions: %s", ", ".join(self.priority_regions))
+        if self.adaptive_concurrency:
+            log.info("# adaptive concurrency: %d to %d processing tasks",
+                     self.min_processing_pool_size, self.processing_pool_size)
+        memoryBudget = self.memory_budget
+        if memoryBudget:
+            log.info("# memory budget: %d MB", memoryBudget)
+        if self.build_cache_path:
+            log.info("# build cache: %s", self.build_cache_path)
+        diskBudget = self.disk_budget
+        if diskBudget:
+            log.info("# disk budget: %d MB", diskBudget)
+
+        names = self.repositories
+        if self.coordinator_address and len(names) > 1:
+            log.error("# coordinator mode supports a single repository, only updating %s", names[0])
+            names = names[:1]
+        if len(names) > 1:
+            log.info("# updating %d repositories at once: %s", len(names), ", ".join(names))
+            # the repositories share the processing slots
+            processingBudget = self.processing_pool_size
         else:
-            prettyTime = utils.prettyTimeDiff(dt_monav)
-        log.info("## Monav repository updated in %s " % prettyTime)
+            processingBudget = None
+        # budgets shared by all the repositories, every repository gets
+        # a fair share of them while they compete for them
+        cpuPlacement = None
+        if self.cpu_placement:
+            cpuPlacement = placement.CpuPlacement()
+            log.info("# CPU placement: %d NUMA nodes (CPUs %s)", len(cpuPlacement.nodes),
+                     " | ".join([placement.format_cpu_list(node) for node in cpuPlacement.nodes]))
+        memoryCgroup = None
+        if self.memory_limit:
+            # needs to be done before any processing process is started
+            memoryCgroup = containment.prepare_cgroup()
+            log.info("# memory ceilings: %s", "cgroup v2 (%s)" % memoryCgroup if memoryCgroup else "RLIMIT_AS")
+        scratchBudget = None
+        if self.scratch_path:
+            scratchBudget = budget.scratch_budget(self.scratch_budget, owners=names)
+            if scratchBudget.enabled:
+                log.info("# scratch tier: %s, budget: %s", self.scratch_path,
+                         utils.bytes2PrettyUnitString(scratchBudget.capacity))
+            else:
+                log.error("# scratch tier %s not available, scratch data stay in the temporary folder",
+                          self.scratch_path)
+        budgets = budget.Budgets(
+            budget.memory_budget(memoryBudget, owners=names),
+            budget.disk_budget(diskBudget, owners=names),
+            budget.processing_budget(processingBudget, owners=names),
+            cpuPlacement,
+            memoryCgroup,
+            scratchBudget
+        )
+        # every source data file is downloaded once for all the repositories
+        sourceLoader = source.SharedSourceLoader(
+            os.path.join(self.temp_path, source.SOURCE_STORE_FOLDER), names)
+        repositories = [REPOSITORY_TYPES[name](self, budgets, sourceLoader) for name in names]
+
+        timings = []
+        if len(repositories) == 1:
+            repository = repositories[0]
+            timings.append((repository, self._updateRepository(repository)))
+        else:
+            # update every repository in its own process
+            running = []
+            for repository in repositories:
+                process = mp.Process(target=self._updateRepository, args=(repository,))
+                process.start()
+                running.append((repository, process, time.time()))
+            while running:
+                for item in list(running):
+                    repository, process, start_repo = item
+                    process.join(REPOSITORY_POLL_INTERVAL)
+                    if not process.is_alive():
+                        running.remove(item)
+                        timings.append((repository, int(time.time() - start_repo)))
+
+        # all repositories are done, drop sources some of them did not need
+        sourceLoader.clear()
 
         log.info("## Summary:")
-        log.info("## Monav repository updated in %s (%d s)" %
-                 (utils.prettyTimeDiff(dt_monav), dt_monav)
-        )
+        for repository, dt_repo in timings:
+            log.info("## %s repository updated in %s (%d s)" %
+                     (repository.name, utils.prettyTimeDiff(dt_repo), dt_repo)
+            )
 
         # log how long the repository update took
         dt = int(time.time() - start)
-        if dt > 60:
-            prettyTime = "%s (%d s)" % (utils.prettyTimeDiff(dt), dt)
-        else:
-            prettyTime = utils.prettyTimeDiff(dt)
-        log.info("## Repository updated in %s " % prettyTime)
+        log.info("## Repository updated in %s " % self._prettyDuration(dt))
 
         log.info("## repository update finished ##")
 
+    def _updateRepository(self, repository):
+        """update a single repository, return how long the update took (in seconds)"""
+        log.info("## updating %s repository", repository.name)
+        repository.log_settings()
+        start = time.time()
+        repository.update()
+        dt = int(time.time() - start)
+        log.info("## %s repository updated in %s " % (repository.name, self._prettyDuration(dt)))
+        engine.log_resource_usage(repository.engine)
+        return dt
+
+    def _prettyDuration(self, dt):
+        if dt > 60:
+            # show seconds for exact benchmarking once pretty time
+            # switches to larger units
+            return "%s (%d s)" % (utils.prettyTimeDiff(dt), dt)
+        else:
+            return utils.prettyTimeDiff(dt)
+
     @property
     def config(self):
         """return parsed config file"""
@@ -153,10 +300,177 @@ class Manager(object):
         """source data path wrapper"""
         return self._wrapVariable(self.args.source_data_folder, "source_data_folder", repo.DEFAULT_SOURCE_FOLDER)
 
+    @property
+    def resume(self):
+        """resume an interrupted update"""
+        return self.args.resume
+
+    @property
+    def incremental_update(self):
+        """only process source data that changed since the last update wrapper"""
+        if self.args.full_update:
+            return False
+        result = self._wrapVariable(None, "incremental_update", True)
+        return result not in (False, "False", "false", "0", "no")
+
+    @property
+    def history_path(self):
+        """package history folder path wrapper"""
+        return self._wrapVariable(self.args.history_folder, "history_folder", repo.HISTORY_PATH)
+
+    @property
+    def schedule(self):
+        """scheduling policy wrapper"""
+        if self.args.monav_dont_sort_urls:
+            return schedule.SCHEDULE_FIFO
+        policy = self._wrapVariable(self.args.schedule, "schedule", schedule.DEFAULT_SCHEDULE)
+        if policy not in schedule.SCHEDULES:
+            log.error("unknown scheduling policy %s, using %s", policy, schedule.DEFAULT_SCHEDULE)
+            policy = schedule.DEFAULT_SCHEDULE
+        return policy
+
+    @property
+    def cpu_placement(self):
+        """bind preprocessor runs to CPUs of a single NUMA node wrapper"""
+        if self.args.cpu_placement:
+            return True
+        result = self._wrapVariable(None, "cpu_placement", False)
+        return result in (True, "True", "true", "1", "yes")
+
+    @property
+    def memory_limit(self):
+        """hard memory ceiling of preprocessor runs wrapper"""
+        if self.args.memory_limit:
+            return True
+        result = self._wrapVariable(None, "memory_limit", False)
+        return result in (True, "True", "true", "1", "yes")
+
+    @property
+    def priority_regions(self):
+        """priority regions wrapper
+        -> list of shell-style repository sub-path patterns"""
+        result = self._wrapVariable(self.args.priority_regions, "priority_regions", [])
+        if not isinstance(result, list):
+            # ConfigObj returns a list for comma separated values, the CLI option a string
+            result = result.split(",")
+        return [pattern.strip() for pattern in result if pattern.strip()]
+
+    @property
+    def adaptive_concurrency(self):
+        """adjust processing concurrency to host load wrapper"""
+        if self.args.adaptive_concurrency:
+            return True
+        result = self._wrapVariable(None, "adaptive_concurrency", False)
+        return result in (True, "True", "true", "1", "yes")
+
+    @property
+    @integer
+    def min_processing_pool_size(self):
+        """minimum number of processing tasks running at once
+        with adaptive concurrency wrapper"""
+        return self._wrapVariable(self.args.min_processing_pool_size, "min_processing_pool_size", 1)
+
+    @property
+    def engine(self):
+        """pipeline engine wrapper"""
+        name = self._wrapVariable(self.args.engine, "engine", engine.DEFAULT_ENGINE)
+        if name not in engine.ENGINES:
+            log.error("unknown engine %s, using %s", name, engine.DEFAULT_ENGINE)
+            name = engine.DEFAULT_ENGINE
+        return name
+
+    @property
+    def coordinator_address(self):
+        """address for the coordinator to listen on wrapper
+        -> a (host, port) tuple or None if not running as a coordinator"""
+        address = self._wrapVariable(self.args.coordinator, "coordinator", None)
+        if address:
+            return distributed.parse_address(address)
+        else:
+            return None
+
+    @property
+    def worker_url(self):
+        """coordinator URL for the worker agent wrapper
+        -> None if not running as a worker"""
+        return self.args.worker
+
+    @property
+    @integer
+    def lease_timeout(self):
+        """task lease timeout in seconds wrapper"""
+        return self._wrapVariable(self.args.lease_timeout, "lease_timeout", distributed.DEFAULT_LEASE_TIMEOUT)
+
+    @property
+    @integer
+    def fusion_threshold(self):
+        """source data size (in MB) below which packages are processed,
+        packaged & published by a single processing task wrapper
+        -> 0 disables stage fusion"""
+        return self._wrapVariable(self.args.fusion_threshold, "fusion_threshold", repo.FUSION_THRESHOLD)
+
+    @property
+    @integer
+    def max_attempts(self):
+        """maximum package attempt count wrapper"""
+        return self._wrapVariable(self.args.max_attempts, "max_attempts", retry.DEFAULT_MAX_ATTEMPTS)
+
+    @property
+    @integer
+    def retry_delay(self):
+        """retry delay in seconds wrapper"""
+        return self._wrapVariable(self.args.retry_delay, "retry_delay", retry.DEFAULT_RETRY_DELAY)
+
+    @property
+    @integer
+    def processing_timeout(self):
+        """processing run time limit increase per GB of source data (in seconds) wrapper
+        -> 0 means processing run time is not limited"""
+        return self._wrapVariable(self.args.processing_timeout, "processing_timeout", watchdog.DEFAULT_TIMEOUT_PER_GB)
+
+    @property
+    @integer
+    def stall_timeout(self):
+        """how long can processing go without progress (in seconds) wrapper
+        -> 0 disables stall detection"""
+        return self._wrapVariable(self.args.stall_timeout, "stall_timeout", watchdog.DEFAULT_STALL_TIMEOUT)
+
+    @property
+    def build_cache_path(self):
+        """build cache folder path wrapper
+        -> None means build caching is disabled"""
+        return self._wrapVariable(self.args.build_cache_folder, "build_cache_folder", None)
+
+    @property
+    def importer_cache_path(self):
+        """importer cache folder path wrapper
+        -> None means importer output is not reused"""
+        return self._wrapVariable(self.args.importer_cache_folder, "importer_cache_folder", None)
+
+    @property
+    def importer_cache_size(self):
+        """importer cache size limit in megabytes wrapper
+        -> None means the cache size is not limited"""
+        result = self._wrapVariable(self.args.importer_cache_size, "importer_cache_size", None)
+        if result is not None:
+            return int(result)
+        else:
+            return result
+
+    @property
+    def build_cache_size(self):
+        """build cache size limit in megabytes wrapper
+        -> None means the cache size is not limited"""
+        result = self._wrapVariable(self.args.build_cache_size, "build_cache_size", None)
+        if result is not None:
+            return int(result)
+        else:
+            return result
+
     @property
     def log_folder_path(self):
-        """source data path wrapper"""
-        return self._wrapVariable(self.args.log_folder, "log_folder", "logs/repo_update_logs_%s" % time.strftime("%Y.%m.%d-%H:%M:%S"))
+        """log folder path wrapper"""
+        return self._log_folder_path
 
     @property
     @integer
@@ -194,6 +508,65 @@ class Manager(object):
         """packaging pool size wrapper"""
         return self._wrapVariable(self.args.packaging_pool_size, "packaging_pool_size", mp.cpu_count())
 
+    @property
+    def repositories(self):
+        """names of the repositories to update wrapper
+        -> repositories are updated at once, sharing the resource budgets"""
+        result = self._wrapVariable(self.args.repositories, "repositories", DEFAULT_REPOSITORIES)
+        if not isinstance(result, list):
+            # ConfigObj returns a list for comma separated values, the CLI option a string
+            result = result.split(",")
+        names = []
+        for name in result:
+            name = name.strip()
+            if name not in REPOSITORY_TYPES:
+                log.error("unknown repository type: %s, known types: %s",
+                          name, ", ".join(sorted(REPOSITORY_TYPES)))
+            elif name not in names:
+                names.append(name)
+        return names
+
+    # Resource budget wrappers
+
+    @property
+    def memory_budget(self):
+        """RAM budget for package processing in megabytes wrapper
+        -> None means the memory budget is not enforced"""
+        result = self._wrapVariable(self.args.memory_budget, "memory_budget", None)
+        if result is not None:
+            return int(result)
+        else:
+            return result
+
+    @property
+    def disk_budget(self):
+        """temporary folder disk space budget in megabytes wrapper
+        -> None means the disk budget is not enforced"""
+        result = self._wrapVariable(self.args.disk_budget, "disk_budget", None)
+        if result is not None:
+            return int(result)
+        else:
+            return result
+
+    @property
+    def scratch_path(self):
+        """RAM backed scratch tier folder path wrapper
+        -> None means all scratch data are kept in the temporary folder"""
+        return self._wrapVariable(self.args.scratch_folder, "scratch_folder", None)
+
+    @property
+    def scratch_budget(self):
+        """scratch tier budget in megabytes wrapper
+        -> defaults to the space available in the scratch tier folder"""
+        result = self._wrapVariable(self.args.scratch_budget, "scratch_budget", None)
+        if result is not None:
+            return int(result)
+        scratchPath = self.scratch_path
+        if scratchPath and os.path.isdir(scratchPath):
+            stat = os.statvfs(scratchPath)
+            return stat.f_bavail * stat.f_frsize / 2 ** 20
+        return None
+
     # Monav variable wrappers
 
     @property
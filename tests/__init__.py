@@ -0,0 +1,4 @@
+import logging
+
+# the code under test logs to the "repo" logger hierarchy
+logging.getLogger("repo").addHandler(logging.NullHandler())
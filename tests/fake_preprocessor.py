@@ -0,0 +1,42 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""stand-in for monav-preprocessor used by the tests
+
+Writes importer output for -di and routing data for -dro=<mode>,
+the FAKE_PREPROCESSOR_SLEEP environment variable sets how long a run takes.
+"""
+import os
+import sys
+import time
+
+args = {}
+for arg in sys.argv[1:]:
+    if "=" in arg:
+        name, value = arg.split("=", 1)
+        args[name] = value.strip('"')
+    else:
+        args[arg] = True
+
+output = args["--output"]
+importer_output = os.path.join(output, "OSM Importer_edges")
+print("OSM Importer: importing %s" % args["--input"])
+sys.stdout.flush()
+time.sleep(float(os.environ.get("FAKE_PREPROCESSOR_SLEEP", "0.1")))
+if "-di" in args:
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    with open(importer_output, "w") as f:
+        f.write(args["--profile"])
+if "-dro" not in args:
+    sys.exit(0)
+if not os.path.isfile(importer_output):
+    print("no importer output")
+    sys.exit(1)
+if "-dd" in args:
+    os.remove(importer_output)
+routing_path = os.path.join(output, "routing_%s" % args["-dro"])
+if not os.path.isdir(routing_path):
+    os.makedirs(routing_path)
+with open(os.path.join(routing_path, "data.bin"), "wb") as f:
+    f.write(os.urandom(4096))
+print("done")
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import unittest
+
+from core import budget
+
+
+class ResourceBudgetTest(unittest.TestCase):
+
+    def test_unlimited(self):
+        unlimited = budget.ResourceBudget("test")
+        self.assertFalse(unlimited.enabled)
+        self.assertEqual(unlimited.reserve(10 ** 12), 0)
+
+    def test_reserve_and_release(self):
+        limited = budget.ResourceBudget("test", 10)
+        self.assertEqual(limited.reserve(4), 4)
+        self.assertEqual(limited.reserve(6, block=False), 6)
+        self.assertEqual(limited.reserve(1, block=False), None)
+        limited.release(6)
+        self.assertEqual(limited.used, 4)
+
+    def test_oversized_reservation_is_clamped(self):
+        limited = budget.ResourceBudget("test", 10)
+        self.assertEqual(limited.reserve(100), 10)
+
+    def test_blocked_reservation_waits_for_release(self):
+        limited = budget.ResourceBudget("test", 10)
+        limited.reserve(8)
+        reserved = []
+        waiter = threading.Thread(target=lambda: reserved.append(limited.reserve(5)))
+        waiter.start()
+        time.sleep(0.2)
+        self.assertEqual(reserved, [])
+        # a small reservation backfills around the blocked one
+        self.assertEqual(limited.reserve(2, block=False), 2)
+        limited.release(8)
+        waiter.join(5)
+        self.assertEqual(reserved, [5])
+        self.assertEqual(limited.used, 7)
+
+
+class FairShareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shared = budget.ResourceBudget("test", 10, owners=["monav", "other"])
+        self.monav = self.shared.for_owner("monav")
+        self.other = self.shared.for_owner("other")
+
+    def test_owner_yields_to_waiting_owner_with_less(self):
+        self.assertEqual(self.monav.reserve(8), 8)
+        # doesn't fit, the other owner is now waiting
+        self.assertEqual(self.other.reserve(5, block=False), None)
+        self.monav.release(4)
+        # fits, but the waiting owner holds less of the budget
+        self.assertEqual(self.monav.reserve(2, block=False), None)
+        self.assertEqual(self.other.reserve(5, block=False), 5)
+        self.assertEqual(self.monav.reserve(1, block=False), 1)
+
+    def test_waiting_mark_expires(self):
+        original = budget.WAITING_TIMEOUT
+        budget.WAITING_TIMEOUT = 0.1
+        try:
+            self.monav.reserve(8)
+            self.assertEqual(self.other.reserve(5, block=False), None)
+            self.monav.release(4)
+            time.sleep(0.2)
+            # the other owner gave up waiting
+            self.assertEqual(self.monav.reserve(2, block=False), 2)
+        finally:
+            budget.WAITING_TIMEOUT = original
+
+    def test_ties_broken_by_owner_order(self):
+        shared = budget.ResourceBudget("test", 10, owners=["first", "second", "third"])
+        first, second, third = [shared.for_owner(name) for name in ("first", "second", "third")]
+        third.reserve(10)
+        self.assertEqual(second.reserve(5, block=False), None)
+        self.assertEqual(first.reserve(5, block=False), None)
+        third.release(10)
+        # both waiting owners hold nothing, the one listed first goes first
+        self.assertEqual(second.reserve(5, block=False), None)
+        self.assertEqual(first.reserve(5, block=False), 5)
+        self.assertEqual(second.reserve(5, block=False), 5)
+
+    def test_blocked_owner_gets_its_share(self):
+        self.monav.reserve(10)
+        reserved = []
+        waiter = threading.Thread(target=lambda: reserved.append(self.other.reserve(6)))
+        waiter.start()
+        time.sleep(0.2)
+        self.monav.release(6)
+        # the released space goes to the waiting owner, not back to the one holding most
+        self.assertEqual(self.monav.reserve(6, block=False), None)
+        waiter.join(5)
+        self.assertEqual(reserved, [6])
+
+
+if __name__ == "__main__":
+    unittest.main()
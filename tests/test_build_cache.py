@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import os
+import Queue
+import shutil
+import tempfile
+import unittest
+
+from core import history
+from core import repo
+
+TASKS = ["car", "bike", "pedestrian"]
+
+
+class _Package(object):
+
+    def __init__(self, processing_time, cached_tasks):
+        self.name = "malta"
+        self.repo_sub_path = "europe/malta"
+        self.processing_time = processing_time
+        self.cached_tasks = cached_tasks
+        self.packaging_time = 1
+        self.source_size = 1000
+        self.source_scan = None
+        self.failure_reason = None
+
+    def get_tasks(self):
+        return TASKS
+
+
+class _Repository(repo.Repository):
+    """just the processing task runner & history of a repository,
+    archives of the cached tasks are in the build cache"""
+
+    def __init__(self, history_store=None, cached=()):
+        self._history = history_store
+        self._cached = cached
+        self._task_queue = Queue.Queue()
+        self._result_queue = Queue.Queue()
+        self.ran = []
+
+    def _get_cached_result(self, task):
+        return task.name in self._cached
+
+    def _run_task(self, task):
+        self.ran.append(task.name)
+        return True
+
+
+class CachedTaskTest(unittest.TestCase):
+
+    def test_cache_hit_reported(self):
+        repository = _Repository(cached=["car"])
+        package = _Package(0, [])
+        for task_id, name in enumerate(["car", "bike"]):
+            repository._task_queue.put(repo.Task(task_id, package, name))
+        repository._task_queue.put(repo.SHUTDOWN_SIGNAL)
+        repository._process_tasks()
+        results = [repository._result_queue.get_nowait() for i in range(2)]
+        self.assertEqual([(task_id, success, cached) for task_id, success, cached, dt, reason in results],
+                         [(0, True, True), (1, True, False)])
+        self.assertEqual(repository.ran, ["bike"])
+
+
+class CachedHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.history = history.PackageHistory(os.path.join(self.path, "history.json"))
+        self.repository = _Repository(self.history)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _processing_time(self):
+        return self.history.get("europe/malta", {}).get('processing_time')
+
+    def test_all_cached_without_record(self):
+        self.repository._record_history(_Package(0, list(TASKS)))
+        self.assertEqual(self._processing_time(), None)
+
+    def test_all_cached_keeps_recorded_time(self):
+        self.history.record("europe/malta", processing_time=300, source_size=1000)
+        self.repository._record_history(_Package(0, list(TASKS)))
+        self.assertEqual(self._processing_time(), 300)
+
+    def test_partially_cached(self):
+        self.history.record("europe/malta", processing_time=300, source_size=1000)
+        self.history.record_task("europe/malta", "car", time=200)
+        # bike & pedestrian are taken from the build cache, only car has run
+        self.repository._record_history(_Package(250, ["bike", "pedestrian"]))
+        # older records only have the combined time -> a third for each task
+        self.assertEqual(self._processing_time(), 250 + 2 * 100)
+        self.history.record_task("europe/malta", "bike", time=20)
+        self.repository._record_history(_Package(250, ["bike", "pedestrian"]))
+        self.assertEqual(self._processing_time(), 250 + 20 + 150)
+
+    def test_not_cached(self):
+        self.repository._record_history(_Package(250, []))
+        self.assertEqual(self._processing_time(), 250)
+
+
+if __name__ == "__main__":
+    unittest.main()
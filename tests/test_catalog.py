@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from core import catalog
+
+GEOFABRIK = "http://download.geofabrik.de/"
+
+
+class DeduplicateTest(unittest.TestCase):
+
+    def _deduplicate(self, urls):
+        return catalog.deduplicate_urls(urls, None)
+
+    def test_legacy_and_latest_urls_are_duplicates(self):
+        urls = [
+            GEOFABRIK + "openstreetmap/europe/malta.osm.pbf",
+            GEOFABRIK + "europe/germany-latest.osm.pbf",
+            GEOFABRIK + "europe/malta-latest.osm.pbf",
+        ]
+        unique, duplicates = self._deduplicate(urls)
+        # the current URL is kept, in the place of the first URL of the package
+        self.assertEqual(unique, [GEOFABRIK + "europe/malta-latest.osm.pbf",
+                                  GEOFABRIK + "europe/germany-latest.osm.pbf"])
+        self.assertEqual(len(duplicates), 1)
+        self.assertEqual(duplicates[0].repo_sub_path, "europe/malta")
+        self.assertEqual(duplicates[0].url, urls[0])
+        self.assertEqual(duplicates[0].kept_url, urls[2])
+
+    def test_first_legacy_url_kept_if_all_legacy(self):
+        urls = [GEOFABRIK + "openstreetmap/europe/malta.osm.pbf",
+                GEOFABRIK + "openstreetmap//europe/malta.osm.pbf"]
+        unique, duplicates = self._deduplicate(urls)
+        self.assertEqual(unique, urls[:1])
+        self.assertEqual([d.url for d in duplicates], urls[1:])
+
+    def test_exact_duplicates(self):
+        url = GEOFABRIK + "africa/egypt-latest.osm.pbf"
+        unique, duplicates = self._deduplicate([url, url])
+        self.assertEqual(unique, [url])
+        # the same URL twice is not reported as a different source
+        self.assertEqual(duplicates, [])
+
+    def test_unique_urls_untouched(self):
+        urls = [GEOFABRIK + "africa/egypt-latest.osm.pbf", GEOFABRIK + "europe/malta-latest.osm.pbf"]
+        self.assertEqual(self._deduplicate(urls), (urls, []))
+
+
+if __name__ == "__main__":
+    unittest.main()
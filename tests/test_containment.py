@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import signal
+import shutil
+import tempfile
+import unittest
+
+from core import containment
+from core import phases
+from core import watchdog
+
+MB = 2 ** 20
+
+
+class MemoryCeilingTest(unittest.TestCase):
+
+    def test_ceiling_doubles_with_breaches(self):
+        self.assertEqual(containment.memory_ceiling(100 * MB), 200 * MB)
+        self.assertEqual(containment.memory_ceiling(100 * MB, 2), 800 * MB)
+
+
+class RlimitBreachTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ceiling = containment.RlimitCeiling(1000 * MB)
+
+    def test_success_is_no_breach(self):
+        self.assertFalse(self.ceiling.breached(0, {'peak_memory': 999 * MB}, ["std::bad_alloc"]))
+
+    def test_crash_is_no_breach(self):
+        for returncode in (-signal.SIGABRT, -signal.SIGSEGV, 134):
+            self.assertFalse(self.ceiling.breached(returncode, {'peak_memory': 100 * MB},
+                                                   ["Segmentation fault"]))
+
+    def test_peak_memory_close_to_ceiling(self):
+        self.assertTrue(self.ceiling.breached(-signal.SIGABRT, {'peak_memory': 900 * MB}))
+        self.assertFalse(self.ceiling.breached(1, {'peak_memory': 700 * MB}))
+
+    def test_allocation_failure_reported(self):
+        lines = ["importing", "terminate called after throwing an instance of 'std::bad_alloc'"]
+        self.assertTrue(self.ceiling.breached(-signal.SIGABRT, {'peak_memory': 100 * MB}, lines))
+
+
+class WatchedCeilingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.path, "output.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _run(self, code):
+        tracker = phases.PhaseTracker(self.log_path, [])
+        with open(self.log_path, "a") as output:
+            return watchdog.run_watched([sys.executable, "-c", code], usage={}, output=tracker,
+                                        memory_ceiling=containment.RlimitCeiling(300 * MB),
+                                        stdout=output, stderr=output)
+
+    def test_failed_allocation_is_breach(self):
+        rc, reason = self._run("x = bytearray(600 * 2 ** 20)")
+        self.assertNotEqual(rc, 0)
+        self.assertTrue(reason.startswith(containment.MEMORY_LIMIT), reason)
+
+    def test_crash_is_ordinary_failure(self):
+        rc, reason = self._run("import os; os.abort()")
+        self.assertEqual(rc, -signal.SIGABRT)
+        self.assertEqual(reason, None)
+
+
+if __name__ == "__main__":
+    unittest.main()
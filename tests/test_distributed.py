@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""coordinator & worker agents sharing a temporary folder on localhost"""
+import os
+import sys
+import time
+import shutil
+import socket
+import tarfile
+import tempfile
+import unittest
+import subprocess
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_PREPROCESSOR = os.path.join(REPO_PATH, "tests", "fake_preprocessor.py")
+PACKAGES = ["europe/malta", "europe/andorra", "africa/egypt"]
+MODES = ["car", "bike", "pedestrian"]
+# how long can the whole update take (in seconds)
+UPDATE_TIMEOUT = 180
+
+
+def _free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _wait(process, timeout):
+    deadline = time.time() + timeout
+    while process.poll() is None:
+        if time.time() > deadline:
+            process.kill()
+            process.wait()
+            return None
+        time.sleep(0.5)
+    return process.returncode
+
+
+class DistributedUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="mdr-test-")
+        self.source_path = os.path.join(self.path, "source")
+        for package_id in PACKAGES:
+            path = os.path.join(self.source_path, package_id + ".osm.pbf")
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write(os.urandom(50 * 1024))
+        # the preprocessor is run through the shell
+        self.preprocessor = os.path.join(self.path, "preprocessor")
+        with open(self.preprocessor, "w") as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, FAKE_PREPROCESSOR))
+        os.chmod(self.preprocessor, 0755)
+        # the coordinator & the workers all use the same temporary folder
+        self.temp_path = os.path.join(self.path, "temp")
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        shutil.rmtree(self.path)
+
+    def _start(self, name, args):
+        output = open(os.path.join(self.path, "%s.out" % name), "w")
+        args = [sys.executable, "repository.py",
+                "--temp-folder", self.temp_path,
+                "--monav-preprocessor-path", self.preprocessor,
+                "--log-folder", os.path.join(self.path, name, "logs"),
+                "--history-folder", os.path.join(self.path, name, "history"),
+                "--repository-folder", os.path.join(self.path, name, "results")] + args
+        process = subprocess.Popen(args, cwd=REPO_PATH, stdout=output, stderr=subprocess.STDOUT)
+        self.processes.append(process)
+        return process
+
+    def _output(self, name):
+        with open(os.path.join(self.path, "%s.out" % name)) as f:
+            return f.read()
+
+    def test_coordinator_with_two_workers(self):
+        address = "127.0.0.1:%d" % _free_port()
+        coordinator = self._start("coordinator", [
+            "--data-source", "folder", "--source-data-folder", self.source_path,
+            "--coordinator", address, "--processing-pool-size", "4"])
+        workers = [self._start("worker%d" % i, ["--worker", address]) for i in range(2)]
+
+        self.assertEqual(_wait(coordinator, UPDATE_TIMEOUT), 0, self._output("coordinator"))
+        for i, worker in enumerate(workers):
+            self.assertEqual(_wait(worker, 60), 0, self._output("worker%d" % i))
+            self.assertIn("running ", self._output("worker%d" % i))
+
+        # all the profiles of all the packages were published
+        results_path = os.path.join(self.path, "coordinator", "results", "monav")
+        for package_id in PACKAGES:
+            name = os.path.basename(package_id)
+            for mode in MODES:
+                archive_path = os.path.join(results_path, package_id, "%s_%s.tar.gz" % (name, mode))
+                self.assertTrue(os.path.isfile(archive_path), archive_path)
+                with tarfile.open(archive_path) as archive:
+                    self.assertIn("%s/routing_%s/data.bin" % (name, mode), archive.getnames())
+        # the workers removed their own temporary folders & nothing else
+        temp_content = os.listdir(os.path.join(self.temp_path, "monav"))
+        self.assertEqual([name for name in temp_content if name.startswith("worker-")], [])
+        for package_id in PACKAGES:
+            self.assertTrue(os.path.isfile(os.path.join(self.source_path, package_id + ".osm.pbf")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import Queue
+import threading
+import unittest
+import multiprocessing as mp
+
+from core import repo
+
+
+class _FeederQueue(Queue.Queue):
+    """hands over items with a delay, like the feeder thread of a process queue"""
+
+    def put(self, item, block=True, timeout=None):
+        threading.Timer(0.3, Queue.Queue.put, (self, item)).start()
+
+
+class _Package(object):
+
+    def __init__(self, package_id):
+        self.id = package_id
+        self.name = package_id
+        self.failed_stage = repo.STAGE_PACKAGING
+        self.failure_reason = "packaging failed"
+        self.attempts = 1
+
+
+class _Repository(repo.Repository):
+    """just the failure reporting of a repository"""
+
+    def __init__(self):
+        self._failure_queue = _FeederQueue()
+        self._failure_count = mp.Value('L', 0)
+        self._failures = []
+
+    @property
+    def name(self):
+        return "test"
+
+    def _record_state(self, package, state):
+        pass
+
+    def _clear_package(self, package):
+        pass
+
+
+class FailureReportTest(unittest.TestCase):
+
+    def test_failures_on_the_way_are_reported(self):
+        repository = _Repository()
+        repository._report_failure(_Package("europe/malta"))
+        repository._report_failure(_Package("africa/egypt"))
+        repository._log_failure_report()
+        self.assertEqual([failure[0] for failure in sorted(repository.failures)],
+                         ["africa/egypt", "europe/malta"])
+
+    def test_no_failures(self):
+        repository = _Repository()
+        repository._log_failure_report()
+        self.assertEqual(repository.failures, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
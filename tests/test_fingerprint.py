@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from core import history
+from core import utils
+from core.repo import Repository
+
+
+class _Repository(Repository):
+    """just the fingerprint store of a repository with published packages"""
+
+    def __init__(self, fingerprints, published=True):
+        self._fingerprints = fingerprints
+        self._published = published
+
+    def _is_published(self, package_id):
+        return self._published
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.source_path = os.path.join(self.path, "malta.osm.pbf")
+        self._write("malta")
+        self.store = history.JSONStore(os.path.join(self.path, "fingerprints.json"))
+        self.store.record("europe/malta", **utils.fileFingerprint(self.source_path))
+        self.repository = _Repository(self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _write(self, content, mtime=None):
+        with open(self.source_path, "wb") as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(self.source_path, (mtime, mtime))
+
+    def _unchanged(self):
+        return self.repository._is_unchanged("europe/malta", self.source_path)
+
+    def test_untouched_file_is_unchanged(self):
+        self.assertTrue(self._unchanged())
+
+    def test_size_change(self):
+        self._write("malta, bigger")
+        self.assertFalse(self._unchanged())
+
+    def test_same_content_new_mtime(self):
+        mtime = time.time() + 100
+        self._write("malta", mtime)
+        self.assertTrue(self._unchanged())
+        # the new modification time is remembered
+        self.assertEqual(self.store.get("europe/malta")['mtime'], os.stat(self.source_path).st_mtime)
+
+    def test_same_size_new_content(self):
+        self._write("MALTA", time.time() + 100)
+        self.assertFalse(self._unchanged())
+
+    def test_unknown_or_unpublished_package(self):
+        self.assertFalse(self.repository._is_unchanged("europe/gozo", self.source_path))
+        self.assertFalse(_Repository(self.store, published=False)._is_unchanged("europe/malta", self.source_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
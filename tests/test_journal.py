@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from core import journal
+from monav.monav import MonavPackage
+
+
+class UpdateJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.journal = journal.UpdateJournal(os.path.join(self.path, journal.JOURNAL_FILENAME))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_last_state_wins(self):
+        self.journal.record("europe/malta", journal.LOADED)
+        self.journal.record("europe/malta", journal.PROCESSED)
+        self.journal.record("africa/egypt", journal.LOADED)
+        self.journal.record("europe/malta", journal.PACKAGED)
+        self.assertEqual(self.journal.load(), {"europe/malta": journal.PACKAGED,
+                                               "africa/egypt": journal.LOADED})
+
+    def test_line_cut_by_crash_is_ignored(self):
+        self.journal.record("europe/malta", journal.PROCESSED)
+        with open(self.journal.path, "a") as f:
+            f.write('{"time": 1, "id": "europe/malta", "sta')
+        self.assertEqual(self.journal.load(), {"europe/malta": journal.PROCESSED})
+
+    def test_reset_keeps_backup(self):
+        self.journal.record("europe/malta", journal.PUBLISHED)
+        self.journal.reset()
+        self.assertEqual(self.journal.load(), {})
+        self.assertTrue(os.path.isfile(self.journal.path + ".old"))
+
+    def test_missing_journal(self):
+        self.assertEqual(self.journal.load(), {})
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        source_folder = os.path.join(self.path, "source")
+        os.makedirs(os.path.join(source_folder, "europe"))
+        source_path = os.path.join(source_folder, "europe", "malta.osm.pbf")
+        open(source_path, "wb").close()
+        self.package = MonavPackage({
+            'tempPath': os.path.join(self.path, "temp"),
+            'preprocessorPath': "monav-preprocessor",
+            'filePath': source_path,
+            'filePathPrefix': source_folder
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_resume_packaged(self):
+        self.assertFalse(self.package.can_resume(journal.PACKAGED))
+        for mode in self.package.get_tasks():
+            path = self.package.get_archive_path(mode)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "wb").close()
+        self.assertTrue(self.package.can_resume(journal.PACKAGED))
+        self.assertEqual(len(self.package.results), len(self.package.get_tasks()))
+
+    def test_resume_processed_needs_all_modes(self):
+        modes = self.package.get_tasks()
+        for mode in modes[:-1]:
+            os.makedirs(os.path.join(self.package.scratch_path, "routing_%s" % mode))
+        self.assertFalse(self.package.can_resume(journal.PROCESSED))
+        os.makedirs(os.path.join(self.package.scratch_path, "routing_%s" % modes[-1]))
+        self.assertTrue(self.package.can_resume(journal.PROCESSED))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import os
+import zlib
+import struct
+import shutil
+import tempfile
+import unittest
+
+from core import pbf
+
+
+def _varint(value):
+    data = ""
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data += chr(byte | 0x80)
+        else:
+            return data + chr(byte)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _int_field(number, value):
+    return _varint(number << 3) + _varint(value)
+
+
+def _bytes_field(number, data):
+    return _varint(number << 3 | 2) + _varint(len(data)) + data
+
+
+def _block(block_type, data):
+    blob = _int_field(2, len(data)) + _bytes_field(3, zlib.compress(data))
+    header = _bytes_field(1, block_type) + _int_field(3, len(blob))
+    return struct.pack("!I", len(header)) + header + blob
+
+
+def _primitive_block(group):
+    string_table = _bytes_field(1, _bytes_field(1, ""))
+    return string_table + _bytes_field(2, group)
+
+
+def _dense_nodes(count):
+    ids = "".join([_varint(_zigzag(1)) for i in range(count)])
+    return _primitive_block(_bytes_field(2, _bytes_field(1, ids)))
+
+
+def _ways(count):
+    return _primitive_block("".join([_bytes_field(3, _int_field(1, i)) for i in range(count)]))
+
+
+def _relations(count):
+    return _primitive_block("".join([_bytes_field(4, _int_field(1, i)) for i in range(count)]))
+
+
+HEADER = (_bytes_field(1, _int_field(1, _zigzag(14 * 10 ** 9)) + _int_field(2, _zigzag(15 * 10 ** 9)) +
+                          _int_field(3, _zigzag(36 * 10 ** 9)) + _int_field(4, _zigzag(35 * 10 ** 9))) +
+          _bytes_field(4, "OsmSchema-V0.6") + _bytes_field(16, "test") + _int_field(32, 1500000000))
+
+
+class ScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _write(self, blocks):
+        path = os.path.join(self.path, "test.osm.pbf")
+        with open(path, "wb") as f:
+            f.write(_block(pbf.HEADER_BLOCK, HEADER))
+            for data in blocks:
+                f.write(_block(pbf.DATA_BLOCK, data))
+        return path
+
+    def test_header(self):
+        scan = pbf.scan(self._write([_dense_nodes(10)]))
+        self.assertEqual(scan.bbox, (14.0, 35.0, 15.0, 36.0))
+        self.assertEqual(scan.replication_timestamp, 1500000000)
+        self.assertEqual(scan.writing_program, "test")
+
+    def test_small_file_counted_exactly(self):
+        # fewer blocks than samples -> every block is decoded
+        path = self._write([_dense_nodes(100)] * 3 + [_ways(50)] * 2 + [_relations(7)])
+        scan = pbf.scan(path, samples=10 ** 6)
+        self.assertEqual(scan.blocks, 6)
+        self.assertEqual(scan.sampled_blocks, 6)
+        self.assertEqual((scan.nodes, scan.ways, scan.relations), (300, 100, 7))
+
+    def test_sampled_counts(self):
+        # each entity type spans a few sampled blocks, like in real extracts
+        path = self._write([_dense_nodes(100)] * 40 + [_ways(50)] * 20 + [_relations(7)] * 8)
+        scan = pbf.scan(path, samples=16)
+        self.assertEqual(scan.blocks, 68)
+        self.assertEqual(scan.sampled_blocks, 16)
+        # a block type boundary is off by half of the sampling interval (~2 blocks) at most
+        self.assertAlmostEqual(scan.nodes, 4000, delta=2 * 100)
+        self.assertAlmostEqual(scan.ways, 1000, delta=2 * 2 * 50)
+        self.assertAlmostEqual(scan.relations, 56, delta=2 * 7)
+
+    def test_invalid_file(self):
+        path = os.path.join(self.path, "invalid.osm.pbf")
+        with open(path, "wb") as f:
+            f.write("\xff" * 1024)
+        self.assertRaises(ValueError, pbf.scan, path)
+
+
+if __name__ == "__main__":
+    unittest.main()
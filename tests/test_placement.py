@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import tempfile
+import unittest
+
+from core import placement
+from core import watchdog
+
+
+class CpuListTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        self.assertEqual(placement.parse_cpu_list("0-3,8,10-11\n"), [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(placement.format_cpu_list([11, 0, 1, 2, 3, 8, 10]), "0-3,8,10-11")
+
+
+class CpuPlacementTest(unittest.TestCase):
+
+    def test_allocate_prefers_single_node(self):
+        cpu_placement = placement.CpuPlacement([[0, 1], [2, 3]])
+        first, first_node = cpu_placement.allocate(2)
+        second, second_node = cpu_placement.allocate(2)
+        self.assertEqual(sorted(first + second), [0, 1, 2, 3])
+        self.assertNotEqual(first_node, second_node)
+        cpu_placement.release(first)
+        cpu_placement.release(second)
+
+
+class AffinityTest(unittest.TestCase):
+
+    def test_watched_command_is_bound(self):
+        cpu = placement.read_allowed_cpus()[0]
+        output = tempfile.TemporaryFile()
+        rc, reason = watchdog.run_watched(["grep", "Cpus_allowed_list", "/proc/self/status"],
+                                          cpus=[cpu], stdout=output)
+        self.assertEqual((rc, reason), (0, None))
+        output.seek(0)
+        self.assertEqual(placement.parse_cpu_list(output.read().split(":")[1]), [cpu])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+import Queue
+import unittest
+
+from core import engine
+from core import catalog
+from core import history
+from core import schedule
+from core.repo import Repository, _PackageTasks
+
+
+def _items(sizes):
+    return [schedule.WorkItem("region%d" % i, size, "source%d" % i) for i, size in enumerate(sizes)]
+
+
+class OrderWorkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.history = history.PackageHistory(os.path.join(self.path, "history.json"))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _keys(self, items):
+        return [item.key for item in items]
+
+    def test_fifo(self):
+        items = _items([10, 30, 20])
+        self.assertEqual(schedule.order_work(items, schedule.SCHEDULE_FIFO), items)
+
+    def test_ascending_unknown_size_last(self):
+        items = _items([30, None, 10])
+        self.assertEqual(self._keys(schedule.order_work(items, schedule.SCHEDULE_ASCENDING)),
+                         ["region2", "region0", "region1"])
+
+    def test_longest_predicted_time_first(self):
+        # region0 is small but was slow to process last time
+        self.history.record("region0", processing_time=1000, source_size=10)
+        self.history.record("region1", processing_time=100, source_size=100)
+        self.history.record("other", processing_time=10, source_size=10)
+        # region2 has no record -> median speed (1 s per byte) is used
+        items = _items([20, 100, 50])
+        ordered = schedule.order_work(items, schedule.SCHEDULE_LPT, self.history)
+        self.assertEqual(self._keys(ordered), ["region0", "region1", "region2"])
+        self.assertEqual(ordered[2].predicted_time, 50)
+        # scaled by the source data size change
+        self.assertEqual(ordered[0].predicted_time, 2000)
+
+    def test_longest_size_first_without_history(self):
+        items = _items([20, None, 50])
+        ordered = schedule.order_work(items, schedule.SCHEDULE_LPT)
+        self.assertEqual(self._keys(ordered), ["region2", "region0", "region1"])
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, schedule.order_work, [], "random")
+
+
+class _Package(object):
+
+    def __init__(self, name, priority=schedule.PRIORITY_NORMAL):
+        self.name = name
+        self.priority = priority
+
+
+class _Repository(Repository):
+    """just the task scheduler package selection"""
+
+    def __init__(self):
+        pass
+
+
+class PriorityTest(unittest.TestCase):
+
+    def test_match_priority(self):
+        patterns = ["europe/germany/*", "asia/japan"]
+        self.assertEqual(schedule.match_priority("europe/germany", patterns), schedule.PRIORITY_HIGH)
+        self.assertEqual(schedule.match_priority("europe/germany/bayern", patterns), schedule.PRIORITY_HIGH)
+        self.assertEqual(schedule.match_priority("asia/japan", patterns), schedule.PRIORITY_HIGH)
+        self.assertEqual(schedule.match_priority("europe/france", patterns), schedule.PRIORITY_NORMAL)
+
+    def test_order_by_priority_is_stable(self):
+        items = _items([10, 20, 30, 40])
+        items[1].priority = schedule.PRIORITY_HIGH
+        items[3].priority = schedule.PRIORITY_HIGH
+        self.assertEqual([i.key for i in schedule.order_by_priority(items)],
+                         ["region1", "region3", "region0", "region2"])
+
+    def test_effective_priority(self):
+        interval = schedule.PRIORITY_AGING_INTERVAL
+        self.assertEqual(schedule.effective_priority(schedule.PRIORITY_NORMAL, 0), schedule.PRIORITY_NORMAL)
+        self.assertEqual(schedule.effective_priority(schedule.PRIORITY_NORMAL, interval - 1), schedule.PRIORITY_NORMAL)
+        self.assertEqual(schedule.effective_priority(schedule.PRIORITY_NORMAL, interval), schedule.PRIORITY_HIGH)
+        self.assertEqual(schedule.effective_priority(schedule.PRIORITY_HIGH, 2 * interval), schedule.PRIORITY_HIGH + 2)
+
+    def test_load_url_priorities(self):
+        path = tempfile.mkdtemp()
+        try:
+            csv_path = os.path.join(path, "urls.csv")
+            with open(csv_path, "w") as f:
+                f.write("http://a/malta.osm.pbf,1\n"
+                        "http://a/egypt.osm.pbf\n"
+                        "http://a/andorra.osm.pbf,\n"
+                        "http://a/japan.osm.pbf,high\n")
+            self.assertEqual(catalog.load_url_priorities(csv_path), {"http://a/malta.osm.pbf": 1})
+        finally:
+            shutil.rmtree(path)
+
+
+class LaneQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = schedule.LaneQueue(engine.create_engine(engine.ENGINE_THREADS, 1), 10)
+
+    def test_priority_lane_goes_first(self):
+        items = _items([1, 2, 3])
+        items[2].priority = schedule.PRIORITY_HIGH
+        for item in items:
+            self.queue.put(item)
+        taken = []
+        for i in range(3):
+            taken.append(self.queue.get(timeout=1).key)
+            self.queue.task_done()
+        self.assertEqual(taken, ["region2", "region0", "region1"])
+        # all the items are done in both lanes
+        self.queue.join()
+
+    def test_get_priority_nowait(self):
+        self.queue.put(_items([1])[0])
+        self.assertRaises(Queue.Empty, self.queue.get_priority_nowait)
+        self.assertEqual(self.queue.get(timeout=1).key, "region0")
+
+    def test_get_timeout(self):
+        start = time.time()
+        self.assertRaises(Queue.Empty, self.queue.get, 0.3)
+        self.assertTrue(0.25 <= time.time() - start < 2)
+
+
+class NextTaskPackageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repository = _Repository()
+
+    def _packages(self, *packages):
+        return dict([(package.name, _PackageTasks(package, ["car"], 1)) for package in packages])
+
+    def test_highest_priority_first(self):
+        packages = self._packages(_Package("malta"), _Package("andorra", schedule.PRIORITY_HIGH))
+        self.assertEqual(self.repository._next_task_package(packages).package.name, "andorra")
+
+    def test_first_admitted_first_within_priority(self):
+        packages = self._packages(_Package("malta"), _Package("andorra"))
+        packages["malta"].admitted -= 10
+        self.assertEqual(self.repository._next_task_package(packages).package.name, "malta")
+        packages["andorra"].admitted -= 20
+        self.assertEqual(self.repository._next_task_package(packages).package.name, "andorra")
+
+    def test_aging(self):
+        packages = self._packages(_Package("malta"), _Package("andorra", schedule.PRIORITY_HIGH))
+        # malta waited long enough to catch up with the priority package admitted before it
+        packages["andorra"].admitted -= schedule.PRIORITY_AGING_INTERVAL + 20
+        packages["malta"].admitted -= schedule.PRIORITY_AGING_INTERVAL + 10
+        self.assertEqual(self.repository._next_task_package(packages).package.name, "andorra")
+        # and overtakes it once it waited one more interval
+        packages["malta"].admitted -= 2 * schedule.PRIORITY_AGING_INTERVAL
+        self.assertEqual(self.repository._next_task_package(packages).package.name, "malta")
+
+    def test_nothing_to_start(self):
+        packages = self._packages(_Package("malta"))
+        packages["malta"].running = 1
+        self.assertEqual(self.repository._next_task_package(packages), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from core import simulate
+
+CONFIG = {
+    'processing_pool_size': 1,
+    'packaging_pool_size': 1,
+    'source_queue_size': 10,
+    'packaging_queue_size': 10,
+    'cpu_count': 1,
+    'memory_budget': None,
+    'disk_budget': None
+}
+
+
+def _packages(count, task_count=3, duration=100.0, packaging_time=0, threads=1):
+    packages = []
+    for i in range(count):
+        tasks = [simulate.SimulatedTask("task%d" % t, duration, 2 ** 20, 2 ** 20, threads)
+                 for t in range(task_count)]
+        packages.append(simulate.SimulatedPackage("package%d" % i, 1000, tasks, task_count,
+                                                  packaging_time, 2 ** 20))
+    return packages
+
+
+def _run(packages, **settings):
+    config = dict(CONFIG)
+    config.update(settings)
+    return simulate.simulate(packages, config)
+
+
+class SimulateTest(unittest.TestCase):
+
+    def test_more_processes_than_cores_give_no_speedup(self):
+        packages = _packages(4)
+        single = _run(packages, processing_pool_size=1, cpu_count=1)
+        for pool_size in (2, 4, 8):
+            result = _run(packages, processing_pool_size=pool_size, cpu_count=1)
+            self.assertAlmostEqual(result.makespan, single.makespan, places=3)
+        self.assertAlmostEqual(single.makespan, 1200.0, places=3)
+
+    def test_processes_scale_up_to_cores(self):
+        packages = _packages(4)
+        result = _run(packages, processing_pool_size=4, cpu_count=4)
+        self.assertAlmostEqual(result.makespan, 300.0, places=3)
+        self.assertAlmostEqual(result.idle_core_time, 0.0, places=3)
+        # more processes than cores don't help
+        oversubscribed = _run(packages, processing_pool_size=8, cpu_count=4)
+        self.assertAlmostEqual(oversubscribed.makespan, 300.0, places=3)
+
+    def test_multithreaded_tasks_use_more_cores(self):
+        packages = _packages(2, threads=2)
+        result = _run(packages, processing_pool_size=2, cpu_count=2)
+        # two 2 thread tasks share 2 cores
+        self.assertAlmostEqual(result.makespan, 600.0, places=3)
+
+    def test_idle_cores_counted(self):
+        result = _run(_packages(1, task_count=1), processing_pool_size=1, cpu_count=4)
+        self.assertAlmostEqual(result.makespan, 100.0, places=3)
+        self.assertAlmostEqual(result.idle_core_time, 300.0, places=3)
+        self.assertAlmostEqual(result.idle_fraction, 0.75, places=3)
+
+    def test_memory_budget_limits_parallel_tasks(self):
+        packages = _packages(1, task_count=4)
+        result = _run(packages, processing_pool_size=4, cpu_count=4, memory_budget=2)
+        self.assertAlmostEqual(result.makespan, 200.0, places=3)
+        self.assertEqual(result.peak_memory, 2 * 2 ** 20)
+
+    def test_expand_candidates(self):
+        keys, candidates = simulate.expand_candidates(CONFIG, ["processing_pool_size=1,2",
+                                                               "memory-budget=none,100"])
+        self.assertEqual(keys, ["processing_pool_size", "memory_budget"])
+        self.assertEqual([(c['processing_pool_size'], c['memory_budget']) for c in candidates],
+                         [(1, None), (1, 100), (2, None), (2, 100)])
+        self.assertRaises(ValueError, simulate.expand_candidates, CONFIG, ["unknown=1"])
+
+
+if __name__ == "__main__":
+    unittest.main()